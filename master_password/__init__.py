@@ -16,16 +16,18 @@ USAGE:
 "ni fabna kaf luregwi"
 """
 
-import hmac
-import hashlib
+import struct
 
 import master_password.helpers as helpers
 import master_password.datatypes as datatypes
+import master_password.instrument as instrument
 
-from master_password.helpers import encode_if, decode_if, uint8_list
-from master_password.datatypes import MPWNameSpace, MPWTemplate
+from master_password.helpers import (
+    encode_if, decode_if, uint8_list, hmac_sha256
+)
+from master_password.datatypes import MPWNameSpace, MPWTemplate, KDFProfile
 
-from master_password._get_scrypt import scrypt
+from master_password._get_scrypt import scrypt, implementation, maxmem
 
 
 __author__ = 'Mital Ashok'
@@ -37,19 +39,26 @@ __maintainer__ = 'Mital Ashok'
 __author_email__ = __email__ = 'mital.vaja@googlemail.com'
 __status__ = 'Production'
 
-__all__ = ('MPWNameSpace', 'MPWTemplate', 'MPW_DEFAULT_NAMESPACE', 'MPW')
+__all__ = (
+    'MPWNameSpace', 'MPWTemplate', 'KDFProfile', 'MPW_DEFAULT_NAMESPACE', 'MPW'
+)
 
 MPW_DEFAULT_NAMESPACE = datatypes.default
 
-SCRYPT_N = 32768
-SCRYPT_r = 8
-SCRYPT_p = 2
-SCRYPT_dk_len = 64
+SCRYPT_N, SCRYPT_r, SCRYPT_p, SCRYPT_dk_len = datatypes.DEFAULT_KDF
+
+_uint32 = struct.Struct('>I').pack
 
 
 class MPW(tuple):
     """Represents information to do the Master Password algorithm"""
 
+    # Set to a master_password.keycache.KeyCache to reuse calculated keys
+    key_cache = None
+    # Set to a master_password.scheduler.DerivationScheduler to limit the
+    # memory used by keys being calculated at once
+    scheduler = None
+
     def __new__(
             cls, full_name, master_password, namespace=MPW_DEFAULT_NAMESPACE,
             version=3, keep_name=True
@@ -66,7 +75,7 @@ class MPW(tuple):
         keep_name: Whether or not to store the full_name in the class
         """
         salt = MPW.calculate_salt(encode_if(full_name), namespace)
-        key = MPW.calculate_key(master_password, salt)
+        key = cls.get_key(master_password, salt, MPW.kdf_profile(namespace))
         del master_password
         if not keep_name:
             full_name = None
@@ -92,35 +101,180 @@ class MPW(tuple):
 
     @staticmethod
     def calculate_salt(full_name, namespace=MPW_DEFAULT_NAMESPACE):
+        observer = instrument.observer
+        if observer is not None:
+            start = instrument.clock()
         salt = bytearray(encode_if(getattr(namespace, 'name', namespace)))
         salt.extend(uint8_list(len(full_name)))
         salt.extend(encode_if(full_name))
+        if observer is not None:
+            observer('salt', instrument.clock() - start, {})
         return bytes(salt)
 
     @staticmethod
-    def calculate_key(master_password, salt):
-        return bytearray(scrypt(
-            encode_if(master_password), salt,
-            SCRYPT_N, SCRYPT_r, SCRYPT_p, SCRYPT_dk_len
+    def kdf_profile(namespace):
+        """The KDFProfile of namespace (DEFAULT_KDF if it doesn't have one)"""
+        return getattr(namespace, 'kdf', datatypes.DEFAULT_KDF)
+
+    @staticmethod
+    def calculate_key(master_password, salt, profile=None):
+        """
+        Calculate the key with scrypt, with the parameters from profile
+        (A KDFProfile, default SCRYPT_N, SCRYPT_r, SCRYPT_p and SCRYPT_dk_len)
+
+        If MPW.scheduler is set, waits for it to admit the calculation first.
+        """
+        if profile is None:
+            profile = datatypes.DEFAULT_KDF
+        scheduler = MPW.scheduler
+        if scheduler is not None:
+            size = maxmem(profile[0], profile[1], profile[2])
+            scheduler.acquire(size)
+        observer = instrument.observer
+        if observer is not None:
+            start = instrument.clock()
+        try:
+            key = bytearray(scrypt(
+                encode_if(master_password), salt, *profile
+            ))
+        finally:
+            if scheduler is not None:
+                scheduler.release(size)
+        if observer is not None:
+            observer('scrypt', instrument.clock() - start, {
+                'backend': implementation(),
+                'N': profile[0], 'r': profile[1], 'p': profile[2]
+            })
+        return key
+
+    @classmethod
+    def cached_key(cls, master_password, salt, profile=None):
+        """The key from cls.key_cache, or None if it isn't cached (or set)"""
+        key_cache = cls.key_cache
+        if key_cache is None:
+            return None
+        observer = instrument.observer
+        if observer is not None:
+            start = instrument.clock()
+        key = key_cache.get(salt, master_password, profile)
+        if observer is not None:
+            observer('key_cache', instrument.clock() - start, {
+                'hit': key is not None
+            })
+        return key
+
+    @classmethod
+    def get_key(cls, master_password, salt, profile=None):
+        """calculate_key, but using cls.key_cache if it is set"""
+        key = cls.cached_key(master_password, salt, profile)
+        if key is None:
+            key = cls.calculate_key(master_password, salt, profile)
+            if cls.key_cache is not None:
+                cls.key_cache.put(salt, master_password, key, profile)
+        return key
+
+    @staticmethod
+    def _seed_data(site, namespace, counter, context):
+        if type(namespace) is not bytes:
+            namespace = encode_if(getattr(namespace, 'name', namespace))
+        site = encode_if(site)
+        if context:  # is not None:
+            context = encode_if(context)
+            return b''.join((
+                namespace, _uint32(len(site)), site,
+                _uint32(counter & 0xffffffff), _uint32(len(context)), context
+            ))
+        return b''.join((
+            namespace, _uint32(len(site)), site, _uint32(counter & 0xffffffff)
         ))
 
+    def _resolve_namespace(self, namespace):
+        if namespace is None:
+            return self.namespace.name
+        # The prefixes of the namespace are already encoded
+        scope = self.namespace.scope(namespace)
+        if scope is not None:
+            return scope
+        try:
+            namespace = getattr(
+                self.namespace, decode_if(namespace), decode_if(namespace)
+            )
+        except TypeError:
+            pass
+        except ValueError:
+            pass
+        return encode_if(getattr(namespace, 'name', namespace))
+
+    def _compile(self, template, extended=False):
+        return MPWTemplate.compile(template, self.version == 0, extended)
+
+    @staticmethod
+    def _render(seed, compiled, extended=False):
+        tables = compiled[seed[0]]
+        if extended:
+            # This is the only non-standard portion. The seed is used in the
+            # order seed[1:] + seed[:1], and slicing it to the correct
+            # length makes it compatible.
+            seed = seed[1:] + seed[:1]
+        else:
+            seed = seed[1:]
+        return ''.join([table[c] for table, c in zip(tables, seed)])
+
+    def _seed(self, site, namespace, counter, context):
+        observer = instrument.observer
+        if observer is not None:
+            start = instrument.clock()
+        h = self._keyed_hmac()
+        h.update(self._seed_data(site, namespace, counter, context))
+        seed = bytearray(h.digest())
+        if observer is not None:
+            observer('hmac', instrument.clock() - start, {})
+        return seed
+
+    def _hmac_key(self):
+        return self.key
+
+    def _keyed_hmac(self):
+        """
+        A new HMAC-SHA256 with the key, copied from one that is kept, so
+        the key schedule is only calculated once
+        """
+        keyed = getattr(self, '_keyed', None)
+        if keyed is None:
+            keyed = self._keyed = hmac_sha256(self._hmac_key())
+        return keyed.copy()
+
     def seed(self, site, namespace=None, counter=1, context=None):
         if namespace is None:
             namespace = self.namespace.name
-        site = encode_if(site)
-        data = bytearray(encode_if(getattr(namespace, 'name', namespace)))
-        data.extend(uint8_list(len(site)))
-        data.extend(site)
-        data.extend(uint8_list(counter))
-
-        if context:  # is not None:
-            context = encode_if(context)
-            data.extend(uint8_list(len(context)))
-            data.extend(context)
+        memo = getattr(self, '_memo', None)
+        if memo is None:
+            return self._seed(site, namespace, counter, context)
+        key = ('seed', site, namespace, counter, context)
+        seed = memo.get(key)
+        observer = instrument.observer
+        if observer is not None:
+            observer('memo', 0.0, {'hit': seed is not None, 'kind': 'seed'})
+        if seed is None:
+            seed = self._seed(site, namespace, counter, context)
+            memo.put(key, seed)
+        # The memo only hands out and keeps copies, so this is the caller's
+        return seed
+
+    def seed_many(self, sites, namespace=None, counter=1, context=None):
+        """
+        Lazily calculate the seed for every site in sites
 
-        return bytearray(
-            hmac.new(self.key, bytes(data), hashlib.sha256).digest()
-        )
+        The HMAC key schedule is only calculated once and copied for every
+        site, instead of being recalculated by every call to seed.
+        """
+        if namespace is None:
+            namespace = self.namespace.name
+        keyed = self._keyed_hmac()
+        for site in sites:
+            h = keyed.copy()
+            h.update(self._seed_data(site, namespace, counter, context))
+            yield bytearray(h.digest())
 
     def generate(self, site, counter=1, context=None,
                  template='long', namespace=None, extended=False):
@@ -131,40 +285,118 @@ class MPW(tuple):
         generating a password that is 32 characters long, where the first
         characters equal the password generated with extended = False.
         """
+        namespace = self._resolve_namespace(namespace)
+        compiled = self._compile(template, extended)
+        memo = getattr(self, '_memo', None)
+        if memo is None:
+            seed = self._seed(site, namespace, counter, context)
+            return self._observed_render(seed, compiled, extended)
+        key = ('generate', site, counter, context, template, namespace,
+               extended)
+        cached = memo.get(key)
+        # Templates can be changed, which changes what they compile to
+        hit = cached is not None and cached[0] is compiled
+        observer = instrument.observer
+        if observer is not None:
+            observer('memo', 0.0, {'hit': hit, 'kind': 'generate'})
+        if hit:
+            return cached[1]
+        seed = self._seed(site, namespace, counter, context)
+        password = self._observed_render(seed, compiled, extended)
+        memo.put(key, (compiled, password))
+        return password
+
+    def _observed_render(self, seed, compiled, extended):
+        observer = instrument.observer
+        if observer is None:
+            return self._render(seed, compiled, extended)
+        start = instrument.clock()
+        password = self._render(seed, compiled, extended)
+        observer('render', instrument.clock() - start, {'extended': extended})
+        return password
+
+    def generate_many(self, sites, counter=1, context=None,
+                      template='long', namespace=None, extended=False):
+        """
+        Lazily generate a password for every site in sites
+
+        Equivalent to (self.generate(site, ...) for site in sites), but the
+        namespace, template and HMAC key are only prepared once.
+        """
+        namespace = self._resolve_namespace(namespace)
+        compiled = self._compile(template, extended)
+        for seed in self.seed_many(sites, namespace, counter, context):
+            yield self._render(seed, compiled, extended)
+
+    def seed_sweep(self, site, counters=(1,), contexts=(None,),
+                   namespace=None):
+        """
+        Lazily calculate (counter, context, seed) for every counter in
+        counters and context in contexts of one site
+
+        The namespace and site are only hashed once, and the HMAC state is
+        copied for every counter, and again for every context.
+        """
         if namespace is None:
             namespace = self.namespace.name
-        else:
-            try:
-                namespace = getattr(
-                    self.namespace, decode_if(namespace), decode_if(namespace)
-                )
-            except TypeError:
-                pass
-            except ValueError:
-                pass
-            namespace = encode_if(getattr(namespace, 'name', namespace))
-        seed = self.seed(site, namespace, counter, context)
-        if self.version == 0:
-            seed = [(0xff if c > 127 else 0) | (c << 8)
-                    for i, c in enumerate(seed)]
-        template = MPWTemplate.get(template)
-        template = template[seed[0] % len(template)]
-        chars = MPWTemplate.chars
-        password = []
-        if extended:
-            # This is the only non-standard portion. Slicing it to the correct
-            # length makes it compatible.
-            i = -1
-            for i, s in enumerate(seed[1:]):
-                chrs = chars[template[i % len(template)]]
-                password.append(chrs[s % len(chrs)])
-            chrs = chars[template[(i + 1) % len(template)]]
-            password.append(chrs[seed[0] % len(chrs)])
-        else:
-            for i, c in enumerate(template, 1):
-                chrs = chars[c]
-                password.append(chrs[seed[i] % len(chrs)])
-        return ''.join(password)
+        site = encode_if(site)
+        prefixed = self._keyed_hmac()
+        prefixed.update(encode_if(getattr(namespace, 'name', namespace)))
+        prefixed.update(uint8_list(len(site)))
+        prefixed.update(site)
+        contexts = [
+            (context, encode_if(context) if context else None)
+            for context in contexts
+        ]
+        for counter in counters:
+            counted = prefixed.copy()
+            counted.update(uint8_list(counter))
+            for context, data in contexts:
+                h = counted.copy()
+                if data is not None:
+                    h.update(uint8_list(len(data)))
+                    h.update(data)
+                yield counter, context, bytearray(h.digest())
+
+    def generate_sweep(self, site, counters=(1,), contexts=(None,),
+                       template='long', namespace=None, extended=False):
+        """
+        Lazily generate (counter, context, password) for every counter in
+        counters and context in contexts of one site, e.g., to see every
+        password a site has had, or the answer to many security questions.
+
+        Equivalent to generate(site, counter, context, ...) for every pair,
+        but see seed_sweep.
+        """
+        namespace = self._resolve_namespace(namespace)
+        compiled = self._compile(template, extended)
+        for counter, context, seed in self.seed_sweep(
+                site, counters, contexts, namespace
+        ):
+            yield counter, context, self._render(seed, compiled, extended)
+
+    def enable_memo(self, maxsize=1024, ttl=None):
+        """
+        Remember the last maxsize seeds and passwords for at most ttl
+        seconds, so asking for the same one again doesn't recalculate it.
+        Returns the master_password.memo.Memo, which counts hits and misses.
+        """
+        from master_password.memo import Memo
+        self.disable_memo()
+        self._memo = Memo(maxsize, ttl)
+        return self._memo
+
+    def disable_memo(self):
+        """Stop remembering seeds and passwords, wiping the remembered ones"""
+        memo = getattr(self, '_memo', None)
+        if memo is not None:
+            self._memo = None
+            memo.clear()
+
+    @property
+    def memo(self):
+        """The Memo from enable_memo, or None"""
+        return getattr(self, '_memo', None)
 
     def password(self, site, counter=1, template='long'):
         return self.generate(
@@ -227,8 +459,8 @@ class MPW(tuple):
 
     @classmethod
     def identicon(cls, full_name, master_password):
-        seed = bytearray(hmac.new(
-            encode_if(master_password), encode_if(full_name), hashlib.sha256
+        seed = bytearray(hmac_sha256(
+            encode_if(master_password), encode_if(full_name)
         ).digest())
         return ''.join(
             c[seed[i] % len(c)] for i, c in enumerate(cls.identicon_characters)
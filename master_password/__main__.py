@@ -3,7 +3,6 @@
 import os
 import sys
 import argparse
-import getpass
 
 _PACKAGE_DIR = os.path.abspath(
     os.path.join(os.path.abspath(os.path.dirname(__file__)), os.pardir)
@@ -20,7 +19,10 @@ _ENV = {
     'name': 'MP_FULLNAME',
     'template': 'MP_SITETYPE',
     'counter': 'MP_SITECOUNTER',
-    'version': 'MP_ALGORITHM'
+    'version': 'MP_ALGORITHM',
+    'cache': 'MP_KEYCACHE',
+    'socket': 'MP_SOCKET',
+    'verifier': 'MP_VERIFIER'
 }
 
 if sys.version_info < (3,):
@@ -29,6 +31,7 @@ if sys.version_info < (3,):
 
 def _getpass(prompt='Your master password: ', confirm_prompt=None,
              error='Does not match!\n'):
+    import getpass
     if confirm_prompt is None:
         confirm_prompt = 'Confirm ' + prompt.lower()
     while True:
@@ -86,6 +89,54 @@ _HELP = {
         '        the most significant word(s) of the question.'
     ),
     'site': 'The site to generate a password for.',
+    'batch': (
+        'R|'
+        'Generate for every line of a file (Or - for stdin) instead\n'
+        'of a single site, only asking for the password once.\n'
+        'Each line is either CSV or a JSON object, with the fields\n'
+        '    site,counter,template,variant,context\n'
+        'Missing fields default to the other arguments. Results are\n'
+        'written as each line is read, as CSV (site,result) for CSV\n'
+        'lines or as the JSON object with a "result" for JSON lines.'
+    ),
+    'cache': (
+        'R|'
+        'Cache the key (encrypted) for this many seconds, so\n'
+        'running again with the same name and password is fast.\n'
+        'Only cached in $XDG_RUNTIME_DIR, if there is one.\n'
+        '    Defaults to {env[cache]} in env or no caching.\n'
+        '    Without a value, caches for 300 seconds.'
+    ).format(env=_ENV),
+    'daemon': (
+        'R|'
+        'Run a daemon that keeps unlocked keys in memory and\n'
+        'generates passwords for clients using --socket.'
+    ),
+    'idle': (
+        'R|'
+        'Forget keys in the daemon after they are unused for\n'
+        'this many seconds.\n'
+        '    Defaults to 600.'
+    ),
+    'socket': (
+        'R|'
+        'Generate using the daemon, only asking for the\n'
+        'password if the daemon does not have the key.\n'
+        '    Defaults to true if {env[socket]} is in env.'
+    ).format(env=_ENV),
+    'socket_path': (
+        'R|'
+        'The socket of the daemon to listen on or to use.\n'
+        '    Defaults to {env[socket]} in env or\n'
+        '    $XDG_RUNTIME_DIR/master_password/daemon.sock.'
+    ).format(env=_ENV),
+    'verifier': (
+        'R|'
+        'A file of key fingerprints. The first time a name is used\n'
+        'its key is remembered, and after that a wrong master\n'
+        'password is an error.\n'
+        '    Defaults to {env[verifier]} in env or no checking.'
+    ).format(env=_ENV),
     'identicon': (
         'Disables the identicon, which are 4 characters generated from '
         'your full name and password which are different for different '
@@ -101,6 +152,17 @@ _TYPE_CHOICES = (
 
 _VERSION_CHOICES = (0, 1, 2, 3)
 
+_VARIANTS = {
+    'p': 'password', 'password': 'password', 'l': 'login', 'login': 'login',
+    'a': 'answer', 'answer': 'answer'
+}
+
+_VARIANT_TEMPLATES = {
+    'password': 'long', 'login': 'name', 'answer': 'phrase'
+}
+
+_BATCH_FIELDS = ('site', 'counter', 'template', 'variant', 'context')
+
 
 class RawFormatter(argparse.HelpFormatter):
     def _split_lines(self, text, width):
@@ -109,6 +171,70 @@ class RawFormatter(argparse.HelpFormatter):
         return argparse.HelpFormatter._split_lines(self, text, width)
 
 
+def _batch(mpw, lines, out, defaults):
+    """
+    Write a result for every line, and an error for lines that can't be
+    used to stderr. Returns how many lines couldn't be used.
+    """
+    import csv
+    import json
+
+    writer = csv.writer(out, lineterminator='\n')
+    errors = 0
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        is_json = line.startswith('{')
+        try:
+            if is_json:
+                spec = json.loads(line)
+            else:
+                row = next(csv.reader([line]))
+                spec = dict(
+                    (k, v) for k, v in zip(_BATCH_FIELDS, row) if v != ''
+                )
+            variant = _VARIANTS[spec.get('variant') or defaults['variant']]
+            template = spec.get('template') or defaults['template']
+            if template is None:
+                template = _VARIANT_TEMPLATES[variant]
+            result = mpw.generate(
+                spec['site'], int(spec.get('counter', defaults['counter'])),
+                spec.get('context', defaults['context']), template, variant
+            )
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            errors += 1
+            sys.stderr.write('line {}: {}: {}\n'.format(
+                number, type(e).__name__, e
+            ))
+            continue
+        if is_json:
+            spec['result'] = result
+            out.write(json.dumps(spec) + '\n')
+        else:
+            writer.writerow([spec['site'], result])
+        out.flush()
+    return errors
+
+
+def _check_response(response, allow_locked=False):
+    if not response['ok'] and not (
+            allow_locked and response['error'] == 'locked'
+    ):
+        sys.stderr.write('Daemon error: {}\n'.format(response['error']))
+        sys.exit(1)
+
+
+def _unlock(verifier, full_name, password, version):
+    if verifier is None:
+        return master_password.MPW(full_name, password, version=version)
+    try:
+        return verifier.unlock(full_name, password, version=version)
+    except ValueError as e:
+        sys.stderr.write('\n{}\n'.format(e))
+        sys.exit(1)
+
+
 def main(argv=sys.argv[1:]):
     parser = argparse.ArgumentParser(description='Master Password CLI',
                                      prog='master_password',
@@ -145,6 +271,25 @@ def main(argv=sys.argv[1:]):
                         default=None)
     parser.add_argument('site', help=_HELP['site'], nargs='?', default=None)
     parser.add_argument('-i', help=_HELP['identicon'], action='store_false')
+    parser.add_argument('--batch', metavar='file', help=_HELP['batch'],
+                        default=None)
+    cache_default = os.environ.get(_ENV['cache'])
+    try:
+        cache_default = int(cache_default)
+    except (TypeError, ValueError):
+        cache_default = None
+    parser.add_argument('--cache', metavar='ttl', help=_HELP['cache'],
+                        type=int, nargs='?', const=300, default=cache_default)
+    parser.add_argument('--daemon', help=_HELP['daemon'], action='store_true')
+    parser.add_argument('--idle', metavar='seconds', help=_HELP['idle'],
+                        type=int, default=600)
+    parser.add_argument('--socket', help=_HELP['socket'], action='store_true',
+                        default=_ENV['socket'] in os.environ)
+    parser.add_argument('--socket-path', metavar='path',
+                        help=_HELP['socket_path'],
+                        default=os.environ.get(_ENV['socket']) or None)
+    parser.add_argument('--verifier', metavar='file', help=_HELP['verifier'],
+                        default=os.environ.get(_ENV['verifier']) or None)
 
     parser.add_argument('-P', metavar='password', help=argparse.SUPPRESS,
                         default=None)
@@ -161,20 +306,87 @@ def main(argv=sys.argv[1:]):
 
     mpw = args.P  # Do not use. Insecure. For testing purposes only.
 
+    if args.cache:
+        from master_password.keycache import KeyCache
+        try:
+            master_password.MPW.key_cache = KeyCache(ttl=args.cache)
+        except ValueError as e:
+            sys.stderr.write('Not caching the key: {}\n'.format(e))
+
+    verifier = None
+    if args.verifier:
+        from master_password.verifier import VerifierStore
+        verifier = VerifierStore(args.verifier)
+
+    if args.daemon:
+        from master_password.daemon import serve
+        try:
+            serve(args.socket_path, args.idle, verifier)
+        except ValueError as e:
+            sys.stderr.write('{}\n'.format(e))
+            sys.exit(1)
+        return
+
     if full_name is None:
         full_name = input('Your full name: ')
+
+    if args.batch is not None:
+        if mpw is None:
+            mpw = _getpass()
+        if args.i:
+            identicon = master_password.MPW.identicon(full_name, mpw)
+            sys.stderr.write(u'[ {} ]\n'.format(identicon))
+        mpw = _unlock(verifier, full_name, mpw, version)
+        defaults = {
+            'counter': counter, 'template': template,
+            'variant': _VARIANTS[namespace], 'context': context
+        }
+        if args.batch == '-':
+            errors = _batch(mpw, sys.stdin, sys.stdout, defaults)
+        else:
+            with open(args.batch) as f:
+                errors = _batch(mpw, f, sys.stdout, defaults)
+        if errors:
+            sys.exit(1)
+        return
+
     if site is None:
         site = input('Site name: ')
 
-    namespace = {
-        'p': 'password', 'password': 'password', 'l': 'login', 'login': 'login',
-        'a': 'answer', 'answer': 'answer'
-    }[namespace]
+    namespace = _VARIANTS[namespace]
 
     if template is None:
-        template = {
-            'password': 'long', 'login': 'name', 'answer': 'phrase'
-        }[namespace]
+        template = _VARIANT_TEMPLATES[namespace]
+
+    client = None
+    if args.socket:
+        from master_password.daemon import Client, default_socket_path
+        request = {
+            'full_name': full_name, 'version': version, 'site': site,
+            'counter': counter, 'context': context, 'template': template,
+            'variant': namespace
+        }
+        try:
+            client = Client(args.socket_path)
+            response = client.request('generate', **request)
+        except (IOError, OSError, EOFError) as e:
+            sys.stderr.write(
+                'Could not use the daemon at {}: {}\n'
+                'Calculating the key without it.\n'.format(
+                    args.socket_path or default_socket_path(), e
+                )
+            )
+            if client is not None:
+                client.close()
+            client = None
+            response = {'ok': False, 'error': 'locked'}
+        if response['ok']:
+            sys.stdout.write(
+                '{}\'s password for {}:\n'.format(full_name, site)
+            )
+            print(response['result'])
+            return
+        _check_response(response, allow_locked=True)
 
     debug = mpw is not None
     if debug:
@@ -208,7 +420,17 @@ def main(argv=sys.argv[1:]):
             )
         sys.stdout.flush()
 
-    mpw = master_password.MPW(full_name, mpw, version=version)
+    if client is not None:
+        response = client.request(
+            'unlock', full_name=full_name, master_password=mpw, version=version
+        )
+        _check_response(response)
+        response = client.request('generate', **request)
+        _check_response(response)
+        print(response['result'])
+        return
+
+    mpw = _unlock(verifier, full_name, mpw, version)
 
     print(mpw.generate(site, counter, context, template, namespace))
 
@@ -0,0 +1,84 @@
+"""
+Authenticated encryption using only HMAC-SHA256, so that no extra
+dependencies are needed to store keys and sites.
+
+The keystream is HMAC-SHA256(enc_key, nonce | counter) and the tag is
+HMAC-SHA256(mac_key, associated_data | nonce | ciphertext) (Encrypt-then-MAC)
+"""
+
+import os
+import hmac
+import hashlib
+
+from master_password.helpers import encode_if, uint8_list
+
+__all__ = ('seal', 'unseal', 'NONCE_SIZE', 'TAG_SIZE')
+
+NONCE_SIZE = 16
+TAG_SIZE = 32
+
+
+def _hmac(key, *parts):
+    h = hmac.new(key, None, hashlib.sha256)
+    for part in parts:
+        h.update(part)
+    return h.digest()
+
+
+def _keys(key):
+    return _hmac(key, b'enc'), _hmac(key, b'mac')
+
+
+def _keystream(key, nonce, size):
+    keyed = hmac.new(key, nonce, hashlib.sha256)
+    blocks = []
+    for block in range((size + 31) // 32):
+        h = keyed.copy()
+        h.update(uint8_list(block))
+        blocks.append(h.digest())
+    return b''.join(blocks)[:size]
+
+
+if hasattr(int, 'from_bytes'):
+    def _xor_keystream(key, nonce, data):
+        size = len(data)
+        stream = _keystream(key, nonce, size)
+        return (
+            int.from_bytes(data, 'big') ^ int.from_bytes(stream, 'big')
+        ).to_bytes(size, 'big')
+else:
+    def _xor_keystream(key, nonce, data):
+        data = bytearray(data)
+        for i, k in enumerate(bytearray(_keystream(key, nonce, len(data)))):
+            data[i] ^= k
+        return bytes(data)
+
+
+def seal(key, plaintext, associated_data=b''):
+    """Encrypt and authenticate plaintext as nonce | ciphertext | tag"""
+    enc_key, mac_key = _keys(encode_if(key))
+    nonce = os.urandom(NONCE_SIZE)
+    ciphertext = _xor_keystream(enc_key, nonce, plaintext)
+    tag = _hmac(mac_key, encode_if(associated_data), nonce, ciphertext)
+    return nonce + ciphertext + tag
+
+
+def unseal(key, sealed, associated_data=b''):
+    """
+    Decrypt something encrypted with seal
+
+    sealed can be any bytes-like object. Raises ValueError if the key or
+    associated_data are wrong or sealed was modified.
+    """
+    if len(sealed) < NONCE_SIZE + TAG_SIZE:
+        raise ValueError('Sealed data is too short')
+    enc_key, mac_key = _keys(encode_if(key))
+    # Slices of a memoryview (e.g., of an mmap) are not copied
+    sealed = memoryview(sealed)
+    nonce = bytes(sealed[:NONCE_SIZE])
+    ciphertext = sealed[NONCE_SIZE:-TAG_SIZE]
+    tag = bytes(sealed[-TAG_SIZE:])
+    expected = _hmac(mac_key, encode_if(associated_data), nonce, ciphertext)
+    if not hmac.compare_digest(tag, expected):
+        raise ValueError('Could not authenticate sealed data')
+    return _xor_keystream(enc_key, nonce, ciphertext)
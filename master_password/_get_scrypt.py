@@ -1,47 +1,240 @@
-__all__ = ('scrypt',)
+"""
+A registry of scrypt implementations
 
-try:
+By default, the first available fast implementation is used (hashlib,
+cryptography then scrypt). The pure Python implementations ("python" from
+master_password._scrypt, then pyscrypt) are only used if nothing else is
+available, with a RuntimeWarning, or if they are selected explicitly.
+"parallel" is "python" with the p lanes of scrypt calculated in parallel
+processes, and is only used if it is selected.
+
+Set MP_SCRYPT_BACKEND in env to the name of an implementation to use it,
+or MP_SCRYPT_AUTOTUNE to time the available implementations and use the
+fastest.
+
+Nothing is imported until scrypt is first needed.
+"""
+
+import os
+
+__all__ = (
+    'scrypt', 'maxmem', 'register', 'unregister', 'get', 'available',
+    'is_slow', 'use', 'autotune', 'implementation'
+)
+
+
+def maxmem(N, r, p):
+    """The number of bytes scrypt needs for the given parameters"""
+    return 128 * r * (N + p + 2)
+
+
+def _hashlib():
     from hashlib import scrypt as hash
 
-    _IMPLEMENTATION = 'hashlib'
+    def scrypt(password, salt, N, r, p, dk_len):
+        return hash(password, salt=salt, n=N, r=r, p=p, dklen=dk_len, maxmem=maxmem(N, r, p))
+    return scrypt
+
+
+def _cryptography():
+    from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+    from cryptography.hazmat.backends import default_backend
+    backend = default_backend()
 
     def scrypt(password, salt, N, r, p, dk_len):
-        return hash(password, salt=salt, n=N, r=r, p=p, dklen=dk_len, maxmem=(128 * r * (N + p + 2)))
-except ImportError:
-    try:
-        from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
-        from cryptography.hazmat.backends import default_backend
-        backend = default_backend()
+        kdf = Scrypt(salt, dk_len, N, r, p, backend)
+        return kdf.derive(password)
+    return scrypt
+
+
+def _scrypt():
+    from scrypt import hash
+
+    def scrypt(password, salt, N, r, p, dk_len):
+        return hash(password, salt, N, r, p, dk_len)
+    return scrypt
+
+
+def _python():
+    from master_password._scrypt import scrypt
+    return scrypt
+
+
+def _pyscrypt():
+    from pyscrypt import hash
+
+    def scrypt(password, salt, N, r, p, dk_len):
+        return hash(password, salt, N, r, p, dk_len)
+    return scrypt
+
+
+def _parallel():
+    from master_password._scrypt import scrypt_parallel
+    return scrypt_parallel
+
 
-        _IMPLEMENTATION = 'cryptography'
+# [name, loader, slow]. Earlier implementations are preferred.
+_registry = [
+    ['hashlib', _hashlib, False],
+    ['cryptography', _cryptography, False],
+    ['scrypt', _scrypt, False],
+    ['python', _python, True],
+    ['pyscrypt', _pyscrypt, True],
+    ['parallel', _parallel, True]
+]
+# name -> scrypt function, or the ImportError from loading it
+_loaded = {}
 
-        def scrypt(password, salt, N, r, p, dk_len):
-            kdf = Scrypt(salt, dk_len, N, r, p, backend)
-            return kdf.derive(password)
-    except ImportError:
+
+def register(name, loader, slow=False, preferred=False):
+    """
+    Register a new scrypt implementation
+
+    loader: Called with no arguments the first time the implementation is
+      used. Returns a function scrypt(password, salt, N, r, p, dk_len) or
+      raises ImportError if it is not available.
+    slow: Slow implementations are never chosen by default unless there is
+      nothing else.
+    preferred: Prefer this to the already registered implementations.
+    """
+    unregister(name)
+    if preferred:
+        _registry.insert(0, [name, loader, slow])
+    else:
+        _registry.append([name, loader, slow])
+
+
+def unregister(name):
+    _registry[:] = [entry for entry in _registry if entry[0] != name]
+    _loaded.pop(name, None)
+
+
+def get(name):
+    """The scrypt function of the implementation called name"""
+    try:
+        f = _loaded[name]
+    except KeyError:
+        for entry in _registry:
+            if entry[0] == name:
+                break
+        else:
+            raise ValueError('Unknown scrypt implementation {!r}'.format(name))
         try:
-            from scrypt import hash
+            f = entry[1]()
+        except ImportError as e:
+            f = e
+        _loaded[name] = f
+    if isinstance(f, ImportError):
+        raise f
+    return f
 
-            _IMPLEMENTATION = 'scrypt'
 
-            def scrypt(password, salt, N, r, p, dk_len):
-                return hash(password, salt, N, r, p, dk_len)
+def available(slow=True):
+    """The names of the implementations that can be used, preferred first"""
+    names = []
+    for name, loader, is_slow in _registry:
+        if is_slow and not slow:
+            continue
+        try:
+            get(name)
         except ImportError:
-            try:
-                from pyscrypt import hash
+            continue
+        names.append(name)
+    return names
+
+
+def is_slow(name):
+    for entry in _registry:
+        if entry[0] == name:
+            return entry[2]
+    raise ValueError('Unknown scrypt implementation {!r}'.format(name))
+
+
+_IMPLEMENTATION = None
+_current = None
+
+
+def use(name):
+    """Use the implementation called name for all future scrypt calls"""
+    global _IMPLEMENTATION, _current
+    _current = get(name)
+    _IMPLEMENTATION = name
+
+
+def autotune(names=None, N=1024, r=8, p=2, repeat=3):
+    """
+    Time the available implementations (Excluding slow ones unless they are
+    in names) with cheap parameters and use the fastest one.
+
+    Returns the name of the implementation now being used.
+    """
+    import timeit
+    if names is None:
+        names = available(slow=False)
+        if not names:
+            names = available()[:1]
+            for name in names:
+                _warn_slow(name)
+    timings = []
+    for name in names:
+        f = get(name)
+        t = min(timeit.repeat(
+            lambda: f(b'password', b'salt', N, r, p, 64),
+            number=1, repeat=repeat
+        ))
+        timings.append((t, name))
+    if not timings:
+        raise _no_implementation()
+    name = min(timings)[1]
+    use(name)
+    return name
+
+
+def _no_implementation():
+    msg = "No module named 'cryptography', 'scrypt' or 'pyscrypt'"
+    try:
+        return ModuleNotFoundError(msg)
+    except NameError:
+        return ImportError(msg)
+
+
+def _warn_slow(name):
+    import warnings
+    warnings.warn(
+        'Using the slow scrypt implementation {!r}. Install cryptography or '
+        'scrypt, or select it explicitly with MP_SCRYPT_BACKEND={}'.format(
+            name, name
+        ), RuntimeWarning
+    )
+
+
+def _use_default():
+    env = os.environ.get('MP_SCRYPT_BACKEND')
+    if env:
+        use(env)
+    elif os.environ.get('MP_SCRYPT_AUTOTUNE') and available():
+        autotune()
+    else:
+        names = available(slow=False)
+        if names:
+            use(names[0])
+            return
+        names = available()
+        if names:
+            _warn_slow(names[0])
+            use(names[0])
 
-                _IMPLEMENTATION = 'pyscrypt'
 
-                def scrypt(password, salt, N, r, p, dk_len):
-                    return hash(password, salt, N, r, p, dk_len)
-            except ImportError:
-                _IMPLEMENTATION = None
+def implementation():
+    """The name of the implementation being used, or None if there is none"""
+    if _current is None:
+        _use_default()
+    return _IMPLEMENTATION
 
-                msg = "No module named 'cryptography', 'scrypt' or 'pyscrypt'"
-                try:
-                    error = ModuleNotFoundError(msg)
-                except NameError:
-                    error = ImportError(msg)
 
-                def scrypt(password, salt, N, r, p, dk_len):
-                    raise error
+def scrypt(password, salt, N, r, p, dk_len):
+    if _current is None:
+        _use_default()
+        if _current is None:
+            raise _no_implementation()
+    return _current(password, salt, N, r, p, dk_len)
@@ -0,0 +1,312 @@
+"""
+scrypt (RFC 7914) in pure Python
+
+scrypt(P, S, N, r, p) is PBKDF2-HMAC-SHA256(P, B, 1) where B is the p lanes
+of PBKDF2-HMAC-SHA256(P, S, 1, p * 128 * r), each put through ROMix. Only
+ROMix is slow, and the lanes don't depend on each other, so they can be
+calculated at the same time in different processes (parallel_scrypt).
+
+Salsa20/8 works on many words at once, like SIMD implementations do: each
+diagonal of a 64 byte sub-block is packed into an int with every word in
+its own 64 bit slot (The gaps catch carries and rotations, and are
+masked). Up to PACK ROMix lanes are packed side by side into the same ints,
+as Python takes barely longer to work on a 512 bit int than a 256 bit one.
+The N blocks of V are preallocated in a single bytearray, with the gaps
+squeezed out.
+
+This is much slower than a C implementation, so it is only used if nothing
+else is available ("python") or if it is selected ("parallel", which uses
+processes for the lanes).
+"""
+
+import struct
+import hashlib
+
+if not hasattr(int, 'from_bytes'):
+    raise ImportError('master_password._scrypt needs int.from_bytes')
+
+__all__ = ('scrypt', 'romix', 'parallel_scrypt', 'PACK')
+
+M = 0xffffffff
+
+# The most ROMix lanes to calculate together. Each one needs its own V.
+PACK = 2
+
+_words = struct.Struct('<16I')
+# The words of a 64 byte sub-block in each packed diagonal
+_DIAGONALS = ((0, 5, 10, 15), (4, 9, 14, 3), (8, 13, 2, 7), (12, 1, 6, 11))
+
+# Masks to spread a squeezed diagonal (4 words in 128 bits) to 64 bit slots
+_SPREAD_HIGH = M << 64 | M << 96
+_SPREAD_LOW = M | M << 128
+_SPREAD_ODD = M << 32 | M << 160
+
+_masks_cache = {}
+
+
+def _masks(lanes):
+    """
+    (lane mask, rotation masks, squeeze steps) for lanes ROMix lanes, where
+    word k of a diagonal of lane g is at bit 256 * g + 64 * k
+    """
+    masks = _masks_cache.get(lanes)
+    if masks is not None:
+        return masks
+
+    def slots(*ks):
+        return sum(
+            M << (256 * g + 64 * k) for g in range(lanes) for k in ks
+        )
+    # Rotating by 1, 2 and 3 words within each lane
+    rotations = (
+        slots(0, 1, 2), slots(3), slots(0, 1), slots(2, 3),
+        slots(0), slots(1, 2, 3)
+    )
+    # Each step moves every odd unit next to the even unit before it
+    steps = []
+    width = 32
+    units = 4 * lanes
+    while units > 1:
+        even = odd = 0
+        for unit in range(0, units, 2):
+            even |= ((1 << width) - 1) << (unit * 2 * width)
+            odd |= ((1 << width) - 1) << ((unit * 2 + 1) * width)
+        steps.append((width, even, odd))
+        width *= 2
+        units = (units + 1) // 2
+    masks = _masks_cache[lanes] = (slots(0, 1, 2, 3), rotations, steps)
+    return masks
+
+
+def _pack(words):
+    """Sub-block words -> its 4 diagonals, each packed into an int"""
+    return [
+        words[a] | (words[b] << 64) | (words[c] << 128) | (words[d] << 192)
+        for a, b, c, d in _DIAGONALS
+    ]
+
+
+def _unpack(diagonals):
+    words = [0] * 16
+    for indices, lanes in zip(_DIAGONALS, diagonals):
+        for i, shift in zip(indices, (0, 64, 128, 192)):
+            words[i] = (lanes >> shift) & M
+    return words
+
+
+def _to_diagonals(blocks, r):
+    """Lanes (128 * r byte blocks) -> list of 2 * r (4 diagonals)"""
+    x = []
+    for i in range(0, 128 * r, 64):
+        packed = [0, 0, 0, 0]
+        for g, block in enumerate(blocks):
+            for d, lanes in enumerate(_pack(_words.unpack_from(block, i))):
+                packed[d] |= lanes << (256 * g)
+        x.append(tuple(packed))
+    return x
+
+
+def _from_diagonals(x, lanes):
+    mask = (1 << 256) - 1
+    return [
+        b''.join(
+            _words.pack(*_unpack([(d >> (256 * g)) & mask for d in diagonals]))
+            for diagonals in x
+        ) for g in range(lanes)
+    ]
+
+
+def _blockmix(x, order, L, rotations):
+    """
+    scryptBlockMix of x (A list of 2 * r sub-blocks, each 4 packed
+    diagonals). order is where each Salsa20/8 output goes.
+
+    Salsa20/8 is calculated on the 4 diagonals, rotating the words of each
+    between the column and row rounds so the rows line up.
+    """
+    r1a, r1b, r2a, r2b, r3a, r3b = rotations
+    out = [None] * len(x)
+    p0, p1, p2, p3 = x[-1]
+    for (b0, b1, b2, b3), i in zip(x, order):
+        x0 = j0 = p0 ^ b0
+        x1 = j1 = p1 ^ b1
+        x2 = j2 = p2 ^ b2
+        x3 = j3 = p3 ^ b3
+        for _ in range(4):
+            # Columns
+            t = (x0 + x3) & L
+            x1 ^= ((t << 7) | (t >> 25)) & L
+            t = (x1 + x0) & L
+            x2 ^= ((t << 9) | (t >> 23)) & L
+            t = (x2 + x1) & L
+            x3 ^= ((t << 13) | (t >> 19)) & L
+            t = (x3 + x2) & L
+            x0 ^= ((t << 18) | (t >> 14)) & L
+            # Rows
+            y1 = ((x3 >> 64) & r1a) | ((x3 << 192) & r1b)
+            y2 = ((x2 >> 128) & r2a) | ((x2 << 128) & r2b)
+            y3 = ((x1 >> 192) & r3a) | ((x1 << 64) & r3b)
+            t = (x0 + y3) & L
+            y1 ^= ((t << 7) | (t >> 25)) & L
+            t = (y1 + x0) & L
+            y2 ^= ((t << 9) | (t >> 23)) & L
+            t = (y2 + y1) & L
+            y3 ^= ((t << 13) | (t >> 19)) & L
+            t = (y3 + y2) & L
+            x0 ^= ((t << 18) | (t >> 14)) & L
+            x1 = ((y3 >> 64) & r1a) | ((y3 << 192) & r1b)
+            x2 = ((y2 >> 128) & r2a) | ((y2 << 128) & r2b)
+            x3 = ((y1 >> 192) & r3a) | ((y1 << 64) & r3b)
+        p0 = (x0 + j0) & L
+        p1 = (x1 + j1) & L
+        p2 = (x2 + j2) & L
+        p3 = (x3 + j3) & L
+        out[i] = (p0, p1, p2, p3)
+    return out
+
+
+def _order(r):
+    # Even sub-blocks go to the first half of the output, odd to the second
+    return [i // 2 + (i % 2) * r for i in range(2 * r)]
+
+
+def romix(blocks, N, r):
+    """
+    scryptROMix of each 128 * r byte block in blocks, calculated together.
+    Returns a list of the mixed blocks.
+    """
+    lanes = len(blocks)
+    L, rotations, steps = _masks(lanes)
+    order = _order(r)
+    x = _to_diagonals(blocks, r)
+    # Every diagonal is stored as 16 bytes for each lane
+    stride = 16 * lanes
+    row = 128 * r * lanes
+    v = bytearray(N * row)
+    view = memoryview(v)
+    offset = 0
+    for _ in range(N):
+        for diagonals in x:
+            for packed in diagonals:
+                for width, even, odd in steps:
+                    packed = (packed & even) | ((packed >> width) & odd)
+                view[offset:offset + stride] = packed.to_bytes(
+                    stride, 'little'
+                )
+                offset += stride
+        x = _blockmix(x, order, L, rotations)
+    mask = N - 1
+    from_bytes = int.from_bytes
+    shifts = [256 * g for g in range(lanes)]
+    for _ in range(N):
+        # Integerify: The first word of the last sub-block of each lane
+        last = x[-1][0]
+        starts = [
+            ((last >> shift) & mask) * row + 16 * g
+            for g, shift in enumerate(shifts)
+        ]
+        xored = []
+        offset = 0
+        for diagonals in x:
+            mixed = []
+            for packed in diagonals:
+                for start, shift in zip(starts, shifts):
+                    start += offset
+                    word = from_bytes(view[start:start + 16], 'little')
+                    word = (word & ~_SPREAD_HIGH) | (
+                        (word & _SPREAD_HIGH) << 64
+                    )
+                    word = (word & _SPREAD_LOW) | ((word & _SPREAD_ODD) << 32)
+                    packed ^= word << shift
+                mixed.append(packed)
+                offset += stride
+            xored.append(mixed)
+        x = _blockmix(xored, order, L, rotations)
+    return _from_diagonals(x, lanes)
+
+
+def _romix_job(job):
+    return romix(*job)
+
+
+_executor = None
+_executor_workers = 0
+_registered = False
+
+
+def _shutdown_executor():
+    global _executor, _executor_workers
+    if _executor is not None:
+        _executor.shutdown()
+    _executor = None
+    _executor_workers = 0
+
+
+def _get_executor(workers):
+    global _executor, _executor_workers, _registered
+    if _executor is None or _executor_workers < workers:
+        from concurrent.futures import ProcessPoolExecutor
+        _shutdown_executor()
+        if not _registered:
+            import atexit
+            atexit.register(_shutdown_executor)
+            _registered = True
+        _executor = ProcessPoolExecutor(workers)
+        _executor_workers = workers
+    return _executor
+
+
+def _cpu_count():
+    try:
+        import os
+        return os.cpu_count() or 1
+    except AttributeError:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+
+
+def parallel_scrypt(password, salt, N, r, p, dk_len, workers=None):
+    """
+    scrypt, with the lanes calculated in up to workers processes (Default
+    the number of CPUs, or at most p). With 1 worker, or if processes can't
+    be used, the lanes are calculated in the current process, PACK at a
+    time.
+    """
+    if N < 2 or N & (N - 1):
+        raise ValueError('N must be a power of 2 greater than 1')
+    size = 128 * r
+    b = hashlib.pbkdf2_hmac('sha256', password, salt, 1, p * size)
+    blocks = [b[i:i + size] for i in range(0, p * size, size)]
+    if workers is None:
+        workers = _cpu_count()
+    workers = max(1, min(workers, p))
+    # Spread the lanes over the workers, packing any left over
+    pack = max(1, min(PACK, -(-p // workers)))
+    jobs = [(blocks[i:i + pack], N, r) for i in range(0, p, pack)]
+    mixed = None
+    if workers > 1:
+        try:
+            from concurrent.futures.process import BrokenProcessPool
+            mixed = list(_get_executor(workers).map(_romix_job, jobs))
+        except (ImportError, NotImplementedError, OSError):
+            mixed = None
+        except BrokenProcessPool:
+            # A worker died, so new ones are needed next time
+            _shutdown_executor()
+            mixed = None
+    if mixed is None:
+        mixed = [_romix_job(job) for job in jobs]
+    return hashlib.pbkdf2_hmac(
+        'sha256', password, b''.join(b''.join(lanes) for lanes in mixed), 1,
+        dk_len
+    )
+
+
+def scrypt(password, salt, N, r, p, dk_len):
+    """scrypt in the current process"""
+    return parallel_scrypt(password, salt, N, r, p, dk_len, 1)
+
+
+def scrypt_parallel(password, salt, N, r, p, dk_len):
+    """scrypt with the lanes in a process for each CPU"""
+    return parallel_scrypt(password, salt, N, r, p, dk_len)
@@ -0,0 +1,141 @@
+"""
+asyncio support, calculating keys in a bounded pool of threads so that the
+event loop is not blocked by scrypt
+
+USAGE:
+
+>>> mpw = await AsyncMPW.create('Your Full Name', 'Your secret password')
+>>> await mpw.password('example.org')
+"Yoha4'DofsDevo"
+"""
+
+import asyncio
+import hashlib
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+
+from master_password import MPW, MPW_DEFAULT_NAMESPACE
+from master_password.helpers import encode_if, uint8_list
+
+__all__ = ('AsyncMPW',)
+
+# Each key calculation uses about 32 MiB, so don't run too many at once
+DEFAULT_MAX_WORKERS = 4
+
+
+class AsyncMPW(object):
+    """Wraps a MPW, making the methods awaitable"""
+
+    executor = None
+    max_workers = DEFAULT_MAX_WORKERS
+    # (loop, salt, password digest) -> future of key being calculated
+    _in_flight = {}
+
+    def __init__(self, mpw):
+        self.mpw = mpw
+
+    @classmethod
+    def get_executor(cls):
+        if cls.executor is None:
+            cls.executor = ThreadPoolExecutor(cls.max_workers)
+        return cls.executor
+
+    @classmethod
+    def get_key(cls, master_password, salt, profile=None):
+        """
+        Calculate the key in the executor. Requests for the same key at the
+        same time only calculate it once.
+        """
+        loop = asyncio.get_event_loop()
+        master_password = encode_if(master_password)
+        digest = hashlib.sha256(
+            uint8_list(len(salt)) + salt + master_password
+        ).digest()
+        in_flight_key = (loop, salt, digest, profile)
+        future = cls._in_flight.get(in_flight_key)
+        if future is None:
+            future = loop.run_in_executor(
+                cls.get_executor(),
+                functools.partial(MPW.get_key, master_password, salt, profile)
+            )
+            cls._in_flight[in_flight_key] = future
+            future.add_done_callback(
+                lambda _: cls._in_flight.pop(in_flight_key, None)
+            )
+        return asyncio.shield(future)
+
+    @classmethod
+    async def create(cls, full_name, master_password,
+                     namespace=MPW_DEFAULT_NAMESPACE, version=3,
+                     keep_name=True):
+        """Like MPW(...), but doesn't block while calculating the key"""
+        full_name = encode_if(full_name)
+        salt = MPW.calculate_salt(full_name, namespace)
+        key = await cls.get_key(
+            master_password, salt, MPW.kdf_profile(namespace)
+        )
+        del master_password
+        if not keep_name:
+            full_name = None
+        return cls(MPW.from_key(key, full_name, namespace, version))
+
+    @classmethod
+    def from_key(cls, key, full_name=None, namespace=MPW_DEFAULT_NAMESPACE,
+                 version=3):
+        return cls(MPW.from_key(key, full_name, namespace, version))
+
+    # Generating is fast enough (A single HMAC) to do on the event loop
+
+    async def seed(self, site, namespace=None, counter=1, context=None):
+        return self.mpw.seed(site, namespace, counter, context)
+
+    async def generate(self, site, counter=1, context=None,
+                       template='long', namespace=None, extended=False):
+        return self.mpw.generate(
+            site, counter, context, template, namespace, extended
+        )
+
+    async def password(self, site, counter=1, template='long'):
+        return self.mpw.password(site, counter, template)
+
+    async def login(self, site, counter=1):
+        return self.mpw.login(site, counter)
+
+    async def answer(self, site, counter=1, context=''):
+        return self.mpw.answer(site, counter, context)
+
+    async def pin(self, site, counter=1):
+        return self.mpw.pin(site, counter)
+
+    @property
+    def key(self):
+        return self.mpw.key
+
+    @property
+    def namespace(self):
+        return self.mpw.namespace
+
+    @property
+    def version(self):
+        return self.mpw.version
+
+    @property
+    def full_name(self):
+        return self.mpw.full_name
+
+    def __repr__(self):
+        return '<{} {!r}>'.format(type(self).__name__, self.mpw)
+
+    def __eq__(self, other):
+        if isinstance(other, AsyncMPW):
+            return self.mpw == other.mpw
+        return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return NotImplemented
+        return not eq
+
+    __hash__ = None
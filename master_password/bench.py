@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for the Master Password algorithm
+
+USAGE:
+
+$ python -m master_password.bench > bench.json
+$ python -m master_password.bench --quick -o bench.json
+
+Writes a JSON document of the form
+{"python": ..., "version": ..., "implementation": ..., "results": {...}}
+where every result is {"best": seconds, "mean": seconds, "number": int,
+"repeat": int}, timed per call, "memory" is the bytes used per unlocked
+MPW and CompactMPW as {"bytes": float, "count": int} and "allocations" is
+the most memory allocated at once while calling seed, generate and login
+as {"bytes": int, "count": int}.
+"""
+
+import sys
+import json
+import timeit
+import argparse
+import platform
+
+import master_password
+from master_password import (
+    MPW, SCRYPT_N, SCRYPT_r, SCRYPT_p, SCRYPT_dk_len
+)
+from master_password.datatypes import DEFAULT_TEMPLATES
+from master_password.compact import CompactMPW
+from master_password import _get_scrypt
+
+__all__ = ('timed', 'run', 'main')
+
+FULL_NAME = 'name'
+PASSWORD = 'password'
+SITE = 'example.com'
+KEY = bytes(bytearray(range(64)))
+
+
+def timed(f, number, repeat):
+    """Time f(), returning the best and mean time per call in seconds"""
+    times = timeit.repeat(f, number=number, repeat=repeat)
+    return {
+        'best': min(times) / number,
+        'mean': sum(times) / (number * repeat),
+        'number': number,
+        'repeat': repeat
+    }
+
+
+def memory(factory, count):
+    """The bytes allocated per object by count calls to factory(key)"""
+    import os
+    import tracemalloc
+    keys = [os.urandom(SCRYPT_dk_len) for _ in range(count)]
+    tracemalloc.start()
+    try:
+        objects = [factory(key) for key in keys]
+        del keys
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return {'bytes': size / float(len(objects)), 'count': len(objects)}
+
+
+def allocated(f, count):
+    """
+    The most bytes that count calls to f() allocate at once (More than
+    what was allocated before), measured with tracemalloc
+    """
+    import tracemalloc
+    # So caches (e.g., compiled templates) are already filled
+    f()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for _ in range(count):
+            f()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'bytes': peak - before, 'count': count}
+
+
+def run(number=1000, repeat=5, scrypt_N=SCRYPT_N, scrypt_repeat=3,
+        memory_count=10000, slow=False):
+    """
+    Run every benchmark, returning the results as a dict. Slow (pure
+    Python) scrypt implementations are only timed if slow is true.
+    """
+    results = {}
+    salt = MPW.calculate_salt(FULL_NAME)
+    for name in _get_scrypt.available(slow):
+        f = _get_scrypt.get(name)
+        results['scrypt.' + name] = timed(
+            lambda: f(PASSWORD.encode(), salt, scrypt_N, SCRYPT_r, SCRYPT_p,
+                      SCRYPT_dk_len),
+            1, scrypt_repeat
+        )
+
+    mpw = MPW.from_key(KEY, FULL_NAME)
+    results['seed'] = timed(lambda: mpw.seed(SITE), number, repeat)
+    for version in range(4):
+        mpw = MPW.from_key(KEY, FULL_NAME, version=version)
+        for template in sorted(DEFAULT_TEMPLATES):
+            results['generate.v{}.{}'.format(version, template)] = timed(
+                lambda: mpw.generate(SITE, template=template), number, repeat
+            )
+        results['generate.v{}.extended'.format(version)] = timed(
+            lambda: mpw.generate(SITE, extended=True), number, repeat
+        )
+    sites = ['{}.{}'.format(i, SITE) for i in range(number)]
+    results['generate_many'] = timed(
+        lambda: list(mpw.generate_many(sites)), 1, repeat
+    )
+    results['generate_many']['best'] /= number
+    results['generate_many']['mean'] /= number
+    results['identicon'] = timed(
+        lambda: MPW.identicon(FULL_NAME, PASSWORD), number, repeat
+    )
+
+    # Including the key, which MPW keeps a reference to and CompactMPW copies
+    memory_results = {
+        'MPW': memory(
+            lambda key: MPW.from_key(bytearray(key), FULL_NAME), memory_count
+        ),
+        'CompactMPW': memory(
+            lambda key: CompactMPW.from_key(bytearray(key), FULL_NAME),
+            memory_count
+        )
+    }
+    mpw = MPW.from_key(KEY, FULL_NAME)
+    allocation_results = {
+        'seed': allocated(lambda: mpw.seed(SITE), number),
+        'generate': allocated(lambda: mpw.generate(SITE), number),
+        'login': allocated(lambda: mpw.login(SITE), number)
+    }
+    return {
+        'python': platform.python_implementation() + ' ' +
+        platform.python_version(),
+        'version': master_password.__version__,
+        'implementation': _get_scrypt.implementation(),
+        'scrypt_N': scrypt_N,
+        'results': results,
+        'memory': memory_results,
+        'allocations': allocation_results
+    }
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description='Master Password benchmarks',
+        prog='master_password.bench'
+    )
+    parser.add_argument('-n', '--number', type=int, default=1000,
+                        help='Calls per timing (Default 1000)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Timings per benchmark (Default 5)')
+    parser.add_argument('-q', '--quick', action='store_true',
+                        help='Time scrypt with N=1024 instead of the real N')
+    parser.add_argument('-s', '--slow', action='store_true',
+                        help='Also time the pure Python scrypt '
+                             'implementations')
+    parser.add_argument('-m', '--memory-count', type=int, default=10000,
+                        help='Objects to create to measure memory '
+                             '(Default 10000)')
+    parser.add_argument('-o', '--output', default=None,
+                        help='File to write the JSON to (Default stdout)')
+    args = parser.parse_args(argv)
+
+    results = run(
+        args.number, args.repeat, 1024 if args.quick else SCRYPT_N,
+        memory_count=args.memory_count, slow=args.slow
+    )
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,83 @@
+"""
+Derive the keys for many users at once
+
+USAGE:
+
+>>> mpws = derive_keys([('Name', 'password'), ('Other', 'secret')], workers=4)
+>>> mpws[0].password('example.org')
+"""
+
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+from master_password import MPW, MPW_DEFAULT_NAMESPACE
+from master_password.helpers import encode_if
+
+__all__ = ('derive_keys', 'max_workers')
+
+
+def _cpu_count():
+    try:
+        return os.cpu_count() or 1
+    except AttributeError:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+
+
+def max_workers(workers=None, maxmem=None, profile=None):
+    """
+    The number of worker processes to use so that at most maxmem bytes are
+    used by concurrent scrypt calls (Each of which uses profile.maxmem
+    bytes, 128 * SCRYPT_r * (SCRYPT_N + SCRYPT_p + 2) by default)
+    """
+    if workers is None:
+        workers = _cpu_count()
+    if maxmem is not None:
+        workers = min(workers, maxmem // MPW.kdf_profile(profile).maxmem)
+    return max(1, workers)
+
+
+def _derive(job):
+    master_password, salt, profile = job
+    return bytes(MPW.calculate_key(master_password, salt, profile))
+
+
+def _derive_in_worker(job):
+    # A forked worker has a copy of the parent's MPW.scheduler, which could
+    # wait forever for releases that only happen in the parent. maxmem
+    # already limits the memory used by the workers.
+    MPW.scheduler = None
+    return _derive(job)
+
+
+def derive_keys(pairs, workers=None, namespace=MPW_DEFAULT_NAMESPACE,
+                version=3, keep_name=True, maxmem=None):
+    """
+    Calculate a MPW for every (full_name, master_password) in pairs, running
+    the key calculations in parallel in a pool of processes.
+
+    Returns a list of MPW objects in the same order as pairs.
+
+    workers: The number of processes to use. Defaults to the number of CPUs.
+    maxmem: If not None, the maximum number of bytes all the processes can
+      use at once for scrypt. Limits the number of workers used.
+    """
+    profile = MPW.kdf_profile(namespace)
+    names = []
+    jobs = []
+    for full_name, master_password in pairs:
+        full_name = encode_if(full_name)
+        names.append(full_name if keep_name else None)
+        salt = MPW.calculate_salt(full_name, namespace)
+        jobs.append((encode_if(master_password), salt, profile))
+    workers = min(max_workers(workers, maxmem, profile), max(len(jobs), 1))
+    if workers == 1:
+        keys = map(_derive, jobs)
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            keys = list(executor.map(_derive_in_worker, jobs))
+    return [
+        MPW.from_key(key, full_name, namespace, version)
+        for key, full_name in zip(keys, names)
+    ]
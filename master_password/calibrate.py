@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+"""
+Find scrypt parameters for a namespace that take about as long as wanted on
+this machine without using too much memory
+
+USAGE:
+
+$ python -m master_password.calibrate --target 0.25 --maxmem 16M
+Backend: hashlib
+Recommended: KDFProfile(N=8192, r=8, p=3, dk_len=64)
+  0.238 seconds, 8.0 MiB
+
+MPWNameSpace.create('your.namespace', kdf=KDFProfile(8192, 8, 3))
+
+Keys calculated with anything other than the default profile can not be
+calculated by other Master Password implementations.
+"""
+
+import sys
+import json
+import timeit
+import argparse
+
+from master_password.datatypes import KDFProfile
+from master_password import _get_scrypt
+
+__all__ = ('measure', 'calibrate', 'parse_size', 'main')
+
+_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+
+def parse_size(size):
+    """'64M' -> 67108864"""
+    size = size.strip().upper()
+    if size.endswith('B'):
+        size = size[:-1]
+    unit = size[-1:] if size[-1:] in _UNITS else ''
+    return int(float(size[:len(size) - len(unit)]) * _UNITS[unit])
+
+
+def measure(profile, repeat=3):
+    """The fastest time in seconds of scrypt with profile"""
+    return min(timeit.repeat(
+        lambda: _get_scrypt.scrypt(b'password', b'salt', *profile),
+        number=1, repeat=repeat
+    ))
+
+
+def calibrate(target=0.5, maxmem=64 << 20, r=8, max_p=16, dk_len=64,
+              repeat=3):
+    """
+    Recommend a KDFProfile that takes at most about target seconds and
+    maxmem bytes with the current scrypt implementation.
+
+    N is made as big as possible first, as memory is what makes scrypt
+    expensive to attack, and then any time left over is used by more
+    lanes (p), which take more time but barely any more memory.
+
+    Returns {"profile": KDFProfile, "seconds": float, "maxmem": int,
+    "backend": name}.
+    """
+    if KDFProfile(2, r, 1, dk_len).maxmem > maxmem:
+        raise ValueError('maxmem is too small for r={}'.format(r))
+    N = 2
+    while KDFProfile(N * 2, r, 1, dk_len).maxmem <= maxmem:
+        N *= 2
+    # scrypt takes time proportional to N, so estimate from a cheap run
+    base = min(N, 1024)
+    per_n = measure(KDFProfile(base, r, 1, dk_len), repeat) / base
+    while N > 2 and per_n * N > target:
+        N //= 2
+    seconds = measure(KDFProfile(N, r, 1, dk_len), repeat)
+    while N > 2 and seconds > target:
+        N //= 2
+        seconds = measure(KDFProfile(N, r, 1, dk_len), repeat)
+    p = max(1, min(max_p, int(target // seconds)))
+    while p > 1 and KDFProfile(N, r, p, dk_len).maxmem > maxmem:
+        p -= 1
+    profile = KDFProfile(N, r, p, dk_len)
+    if p > 1:
+        seconds = measure(profile, repeat)
+    return {
+        'profile': profile, 'seconds': seconds, 'maxmem': profile.maxmem,
+        'backend': _get_scrypt.implementation()
+    }
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description='Recommend scrypt parameters for this machine',
+        prog='master_password.calibrate'
+    )
+    parser.add_argument('-t', '--target', type=float, default=0.5,
+                        help='Seconds a key should take (Default 0.5)')
+    parser.add_argument('-m', '--maxmem', type=parse_size, default='64M',
+                        help='Memory a key can use, e.g. 16M (Default 64M)')
+    parser.add_argument('-r', type=int, default=8,
+                        help='The scrypt block size (Default 8)')
+    parser.add_argument('--max-p', type=int, default=16,
+                        help='The most lanes to recommend (Default 16)')
+    parser.add_argument('--backend', default=None,
+                        help='The scrypt implementation to use')
+    parser.add_argument('--json', action='store_true',
+                        help='Write the recommendation as JSON')
+    args = parser.parse_args(argv)
+
+    if args.backend is not None:
+        _get_scrypt.use(args.backend)
+    result = calibrate(args.target, args.maxmem, args.r, args.max_p)
+    profile = result['profile']
+    if args.json:
+        print(json.dumps({
+            'N': profile.N, 'r': profile.r, 'p': profile.p,
+            'dk_len': profile.dk_len, 'seconds': result['seconds'],
+            'maxmem': result['maxmem'], 'backend': result['backend']
+        }, indent=2, sort_keys=True))
+        return
+    print('Backend: {}'.format(result['backend']))
+    print('Recommended: {!r}'.format(profile))
+    print('  {:.3f} seconds, {:.1f} MiB'.format(
+        result['seconds'], result['maxmem'] / float(1 << 20)
+    ))
+    print('')
+    print("MPWNameSpace.create('your.namespace', kdf=KDFProfile({}, {}, {}))"
+          .format(profile.N, profile.r, profile.p))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
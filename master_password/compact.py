@@ -0,0 +1,230 @@
+"""
+A smaller MPW for holding many unlocked users at once, which stores its key
+in itself (A bytearray) so it can be wiped from memory
+
+USAGE:
+
+>>> mpw = CompactMPW('Your Full Name', 'Your secret password', lock=True)
+>>> mpw.password('example.org')
+"Yoha4'DofsDevo"
+>>> mpw.wipe()  # The key is now all zeros
+"""
+
+from master_password import MPW, MPW_DEFAULT_NAMESPACE
+from master_password.helpers import encode_if, decode_if, hmac_sha256
+
+__all__ = ('CompactMPW',)
+
+
+def _call_libc(name, buffer):
+    """libc's name(buffer address, length). Returns True if it worked."""
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        address = ctypes.addressof(ctypes.c_char.from_buffer(buffer))
+        return getattr(libc, name)(
+            ctypes.c_void_p(address), ctypes.c_size_t(len(buffer))
+        ) == 0
+    except (ImportError, OSError, AttributeError, TypeError, ValueError):
+        return False
+
+
+def _mlock(buffer):
+    """Try to stop buffer being swapped to disk. Returns True if it worked."""
+    return _call_libc('mlock', buffer)
+
+
+def _munlock(buffer):
+    """Undo _mlock, so the locked memory limit isn't used up"""
+    return _call_libc('munlock', buffer)
+
+
+def _borrow(name):
+    return MPW.__dict__[name]
+
+
+class CompactMPW(bytearray):
+    """
+    Like a MPW, but without a __dict__ and with the key stored in the object
+    itself (It is a bytearray), so it can be wiped with wipe().
+
+    The key is wiped (And unlocked) when the object is garbage collected.
+    """
+
+    __slots__ = ('namespace', 'version', 'full_name', '_memo', '_locked')
+
+    def __new__(
+            cls, full_name, master_password, namespace=MPW_DEFAULT_NAMESPACE,
+            version=3, keep_name=True, lock=False
+    ):
+        """
+        Create a new CompactMPW by calculating the key from the full_name and
+        master_password. Takes the same arguments as MPW.
+
+        lock: Try to mlock the key, so it is never swapped to disk.
+        """
+        salt = MPW.calculate_salt(encode_if(full_name), namespace)
+        key = MPW.get_key(master_password, salt, MPW.kdf_profile(namespace))
+        del master_password
+        try:
+            return cls.from_key(
+                key, full_name if keep_name else None, namespace, version,
+                lock
+            )
+        finally:
+            key[:] = bytearray(len(key))
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    @classmethod
+    def from_key(cls, key, full_name=None, namespace=MPW_DEFAULT_NAMESPACE,
+                 version=3, lock=False):
+        """Create a new CompactMPW from a pre-calculated key"""
+        self = bytearray.__new__(cls)
+        bytearray.__init__(self, encode_if(key))
+        if full_name is not None:
+            full_name = decode_if(full_name)
+        self.namespace = namespace
+        self.version = version
+        self.full_name = full_name
+        self._locked = lock and _mlock(self)
+        return self
+
+    @classmethod
+    def from_mpw(cls, mpw, lock=False):
+        return cls.from_key(
+            mpw.key, mpw.full_name, mpw.namespace, mpw.version, lock
+        )
+
+    def to_mpw(self):
+        return MPW.from_key(
+            self.key, self.full_name, self.namespace, self.version
+        )
+
+    @property
+    def key(self):
+        """A copy of the key as bytes"""
+        return bytes(self)
+
+    @property
+    def locked(self):
+        """Whether the key is mlocked"""
+        return getattr(self, '_locked', False)
+
+    def wipe(self):
+        """
+        Overwrite the key (And any remembered seeds) with zeros, and munlock
+        it
+        """
+        bytearray.__setitem__(self, slice(None), bytearray(len(self)))
+        self.disable_memo()
+        if self.locked:
+            _munlock(self)
+            self._locked = False
+
+    def __del__(self):
+        self.wipe()
+
+    def _hmac_key(self):
+        return self
+
+    def _keyed_hmac(self):
+        # Not kept, as it couldn't be wiped
+        return hmac_sha256(self)
+
+    def seed_many(self, sites, namespace=None, counter=1, context=None):
+        if namespace is None:
+            namespace = self.namespace.name
+        keyed = hmac_sha256(self)
+        for site in sites:
+            h = keyed.copy()
+            h.update(self._seed_data(site, namespace, counter, context))
+            yield bytearray(h.digest())
+
+    seed = _borrow('seed')
+    _seed = _borrow('_seed')
+    _seed_data = _borrow('_seed_data')
+    _resolve_namespace = _borrow('_resolve_namespace')
+    _compile = _borrow('_compile')
+    _render = _borrow('_render')
+    _observed_render = _borrow('_observed_render')
+    generate = _borrow('generate')
+    generate_many = _borrow('generate_many')
+    seed_sweep = _borrow('seed_sweep')
+    generate_sweep = _borrow('generate_sweep')
+    password = _borrow('password')
+    login = _borrow('login')
+    answer = _borrow('answer')
+    pin = _borrow('pin')
+    enable_memo = _borrow('enable_memo')
+    disable_memo = _borrow('disable_memo')
+    memo = _borrow('memo')
+    identicon = staticmethod(MPW.identicon)
+
+    def __repr__(self):
+        if self.full_name is None:
+            info = '<anonymous>'
+        else:
+            info = repr(self.full_name)
+        return '<{} for {} with namespace {!r}>'.format(
+            type(self).__name__, info, self.namespace.name.decode()
+        )
+
+    __str__ = __repr__
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if isinstance(other, (MPW, CompactMPW)):
+            if (
+                bytearray.__eq__(self, other.key) and
+                self.namespace == other.namespace and
+                self.version == other.version
+            ):
+                if self.full_name is None or other.full_name is None:
+                    return True
+                if self.full_name == other.full_name:
+                    return True
+            return False
+        return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return NotImplemented
+        return not eq
+
+    __hash__ = None
+
+    def __ge__(self, other):
+        return NotImplemented
+
+    def __gt__(self, other):
+        return NotImplemented
+
+    def __le__(self, other):
+        return NotImplemented
+
+    def __lt__(self, other):
+        return NotImplemented
+
+    __add__ = None
+    __iadd__ = None
+    __contains__ = None
+    __getitem__ = None
+    __setitem__ = None
+    __delitem__ = None
+    __iter__ = None
+    __mul__ = None
+    __imul__ = None
+    __rmul__ = None
+    append = None
+    extend = None
+    insert = None
+    pop = None
+    remove = None
+    clear = None
+    count = None
+    index = None
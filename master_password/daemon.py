@@ -0,0 +1,325 @@
+"""
+A daemon that keeps unlocked MPW objects in memory and generates passwords
+for clients over a Unix domain socket, so the key is only calculated once.
+
+The socket is only accessible by the current user. Each request and
+response is a line of JSON, and a connection can send any number of
+requests. Every request has an "op", and the user is identified by
+"full_name" (and optionally "version" and "namespace"):
+
+{"op": "unlock", "full_name": ..., "master_password": ...}
+{"op": "generate", "full_name": ..., "site": ..., "counter": 1,
+ "context": null, "template": "long", "variant": "password"}
+ (The variant picks the scope within the user's namespace)
+{"op": "password" / "login" / "answer" / "pin", "full_name": ...,
+ "site": ..., ...}  (The same arguments as the MPW methods)
+{"op": "lock", "full_name": ...}
+{"op": "ping"}
+
+Responses are {"ok": true, "result": ...} or {"ok": false, "error": ...}.
+The error is "locked" if the user needs to be unlocked first. With a
+verifier, unlocking with the wrong master password is an error.
+
+USAGE:
+
+$ python -m master_password --daemon &
+$ python -m master_password --socket example.org  # Or set MP_SOCKET
+"""
+
+import os
+import sys
+import json
+import stat
+import time
+import socket
+import struct
+import threading
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from master_password import MPW, MPWNameSpace, MPW_DEFAULT_NAMESPACE
+from master_password.keycache import default_directory
+
+__all__ = (
+    'KeyRing', 'dispatch', 'Daemon', 'Client', 'serve', 'default_socket_path'
+)
+
+DEFAULT_IDLE_TIMEOUT = 600
+
+
+def default_socket_path():
+    return os.path.join(default_directory(), 'daemon.sock')
+
+
+class KeyRing(object):
+    """
+    Unlocked MPW objects, which are forgotten after not being used for
+    idle_timeout seconds. If verifier (A VerifierStore) is given, unlocking
+    with the wrong master password raises ValueError.
+    """
+
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT, verifier=None):
+        self.idle_timeout = idle_timeout
+        self.verifier = verifier
+        self._lock = threading.Lock()
+        # (full_name, namespace name, version) -> [mpw, last used]
+        self._mpws = {}
+
+    @staticmethod
+    def _namespace(namespace):
+        if namespace is None:
+            return MPW_DEFAULT_NAMESPACE
+        if isinstance(namespace, MPWNameSpace):
+            return namespace
+        return MPWNameSpace(namespace)
+
+    @classmethod
+    def user(cls, full_name, namespace=None, version=3):
+        """The key that a user is stored under"""
+        return full_name, cls._namespace(namespace).name, version
+
+    def add(self, mpw):
+        user = self.user(mpw.full_name, mpw.namespace, mpw.version)
+        with self._lock:
+            self._mpws[user] = [mpw, time.time()]
+        return user
+
+    def unlock(self, full_name, master_password, namespace=None, version=3):
+        if self.verifier is not None:
+            return self.add(self.verifier.unlock(
+                full_name, master_password, self._namespace(namespace),
+                version
+            ))
+        return self.add(MPW(
+            full_name, master_password, self._namespace(namespace), version
+        ))
+
+    def get(self, user):
+        """The MPW for the user, or None if it is locked"""
+        now = time.time()
+        with self._lock:
+            entry = self._mpws.get(user)
+            if entry is None:
+                return None
+            if now - entry[1] >= self.idle_timeout:
+                del self._mpws[user]
+                return None
+            entry[1] = now
+            return entry[0]
+
+    def lock(self, user=None):
+        """Forget the user, or every user if user is None"""
+        with self._lock:
+            if user is None:
+                self._mpws.clear()
+            else:
+                self._mpws.pop(user, None)
+
+    def expire(self):
+        """Forget every user that has been idle for too long"""
+        now = time.time()
+        with self._lock:
+            for user, entry in list(self._mpws.items()):
+                if now - entry[1] >= self.idle_timeout:
+                    del self._mpws[user]
+
+    def __len__(self):
+        return len(self._mpws)
+
+
+_VARIANTS = {
+    'p': 'password', 'password': 'password', 'l': 'login', 'login': 'login',
+    'a': 'answer', 'answer': 'answer'
+}
+
+_DEFAULT_TEMPLATES = {
+    'password': 'long', 'login': 'name', 'answer': 'phrase'
+}
+
+# op -> (method, argument names)
+_METHODS = {
+    'generate': (MPW.generate, (
+        'site', 'counter', 'context', 'template', 'extended'
+    )),
+    'password': (MPW.password, ('site', 'counter', 'template')),
+    'login': (MPW.login, ('site', 'counter')),
+    'answer': (MPW.answer, ('site', 'counter', 'context')),
+    'pin': (MPW.pin, ('site', 'counter'))
+}
+
+
+def dispatch(ring, request):
+    """Run a request (A dict) with the MPW objects in ring"""
+    try:
+        op = request.get('op')
+        if op == 'ping':
+            return {'ok': True, 'result': 'pong'}
+        user_args = (
+            request['full_name'], request.get('namespace'),
+            request.get('version', 3)
+        )
+        if op == 'unlock':
+            ring.unlock(
+                user_args[0], request['master_password'], *user_args[1:]
+            )
+            return {'ok': True, 'result': None}
+        user = ring.user(*user_args)
+        if op == 'lock':
+            ring.lock(user)
+            return {'ok': True, 'result': None}
+        if op not in _METHODS:
+            return {'ok': False, 'error': 'Unknown op: {!r}'.format(op)}
+        mpw = ring.get(user)
+        if mpw is None:
+            return {'ok': False, 'error': 'locked'}
+        method, names = _METHODS[op]
+        kwargs = dict(
+            (name, request[name]) for name in names if name in request
+        )
+        if op == 'generate':
+            # "namespace" is the user's, and the variant is the scope in it
+            variant = _VARIANTS[request.get('variant', 'password')]
+            kwargs['namespace'] = variant
+            kwargs.setdefault('template', _DEFAULT_TEMPLATES[variant])
+        return {'ok': True, 'result': method(mpw, **kwargs)}
+    except (KeyError, TypeError, ValueError, RuntimeError,
+            EnvironmentError) as e:
+        # RuntimeError and TimeoutError are from a busy MPW.scheduler
+        return {'ok': False, 'error': '{}: {}'.format(type(e).__name__, e)}
+
+
+def _peer_uid(sock):
+    """The uid of the other end of a Unix socket, or None if not known"""
+    so_peercred = getattr(socket, 'SO_PEERCRED', None)
+    if so_peercred is None:
+        return None
+    creds = sock.getsockopt(
+        socket.SOL_SOCKET, so_peercred, struct.calcsize('3i')
+    )
+    return struct.unpack('3i', creds)[1]
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        uid = _peer_uid(self.connection)
+        if uid is not None and uid != os.getuid():
+            return
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                if not isinstance(request, dict):
+                    raise ValueError('Request must be an object')
+            except ValueError as e:
+                response = {'ok': False, 'error': 'Invalid JSON: {}'.format(e)}
+            else:
+                response = dispatch(self.server.ring, request)
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+def _remove_stale_socket(path):
+    """
+    Remove a socket left at path by a daemon that is no longer running.
+    Raises ValueError if path is something else or a daemon is using it.
+    """
+    try:
+        mode = os.lstat(path).st_mode
+    except OSError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise ValueError('{!r} exists and is not a socket'.format(path))
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error:
+        os.remove(path)
+        return
+    finally:
+        probe.close()
+    raise ValueError('A daemon is already listening on {!r}'.format(path))
+
+
+class Daemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path=None, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 verifier=None):
+        if path is None:
+            path = default_socket_path()
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        _remove_stale_socket(path)
+        self.path = path
+        self.ring = KeyRing(idle_timeout, verifier)
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, _Handler)
+        finally:
+            os.umask(umask)
+
+    def _expire_forever(self):
+        while True:
+            time.sleep(min(self.ring.idle_timeout, 60))
+            self.ring.expire()
+
+    def serve_forever(self, poll_interval=0.5):
+        reaper = threading.Thread(target=self._expire_forever)
+        reaper.daemon = True
+        reaper.start()
+        try:
+            socketserver.UnixStreamServer.serve_forever(self, poll_interval)
+        finally:
+            self.ring.lock()
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class Client(object):
+    """A connection to a Daemon"""
+
+    def __init__(self, path=None):
+        if path is None:
+            path = default_socket_path()
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.file = self.socket.makefile('rwb')
+
+    def request(self, op, **kwargs):
+        """Send a request, returning the response as a dict"""
+        kwargs['op'] = op
+        self.file.write(json.dumps(kwargs).encode('utf-8') + b'\n')
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise EOFError('The daemon closed the connection')
+        return json.loads(line.decode('utf-8'))
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def serve(path=None, idle_timeout=DEFAULT_IDLE_TIMEOUT, verifier=None):
+    server = Daemon(path, idle_timeout, verifier)
+    sys.stderr.write('Listening on {}\n'.format(server.path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
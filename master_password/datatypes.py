@@ -1,6 +1,8 @@
 from master_password.helpers import encode_if, decode_if
 
-__all__ = ('MPWTemplate', 'MPWNameSpace', 'default')
+__all__ = (
+    'MPWTemplate', 'MPWNameSpace', 'KDFProfile', 'DEFAULT_KDF', 'default'
+)
 
 DEFAULT_CHARS = {
     ' ': ' ', 'A': 'AEIOUBCDFGHJKLMNPQRSTVWXYZ', 'C': 'BCDFGHJKLMNPQRSTVWXYZ',
@@ -43,10 +45,21 @@ ALIASES = {
 }
 
 
+def _seed_value(c, legacy=False):
+    if legacy:
+        # Version 0 used 16 bit characters for the seed
+        return (0xff if c > 127 else 0) | (c << 8)
+    return c
+
+
 class MPWTemplate(tuple):
+    # Only change these through create, char and reset, otherwise the
+    # compiled templates will be out of date
     reg = DEFAULT_TEMPLATES.copy()
     chars = DEFAULT_CHARS.copy()
     aliases = ALIASES.copy()
+    # (template, legacy, extended) -> compiled template
+    _compiled = {}
 
     def __new__(cls, name):
         name = decode_if(name)
@@ -63,6 +76,7 @@ class MPWTemplate(tuple):
             templates = (templates,)
         self = tuple.__new__(cls, map(decode_if, templates))
         cls.reg[name] = self
+        cls._compiled.clear()
         return self
 
     @classmethod
@@ -80,6 +94,7 @@ class MPWTemplate(tuple):
         if value is None:
             return cls.chars[c]
         cls.chars[c] = value
+        cls._compiled.clear()
         return value
 
     @classmethod
@@ -87,6 +102,96 @@ class MPWTemplate(tuple):
         cls.reg = DEFAULT_TEMPLATES.copy()
         cls.chars = DEFAULT_CHARS.copy()
         cls.aliases = ALIASES.copy()
+        cls._compiled.clear()
+
+    @classmethod
+    def compile(cls, template, legacy=False, extended=False):
+        """
+        Compile a template into lookup tables, so that generating a password
+        is just indexing tables with the seed.
+
+        Returns a tuple of 256 items, where item seed[0] is a tuple of
+        tables, one for each character of the password. Item i of the
+        tables is indexed with seed[i + 1] to get the character (Or
+        with seed[0] for the last character when extended).
+
+        legacy: Compile for version 0 of the algorithm
+        extended: Compile for 32 character extended passwords
+        """
+        try:
+            return cls._compiled[(template, legacy, extended)]
+        except (KeyError, TypeError):
+            pass
+        templates = cls.get(template)
+        char_tables = {}
+        for c in set(''.join(templates)):
+            chrs = cls.chars[c]
+            char_tables[c] = tuple(
+                chrs[_seed_value(i, legacy) % len(chrs)] for i in range(256)
+            )
+        if extended:
+            templates = [
+                [t[i % len(t)] for i in range(32)] for t in templates
+            ]
+        templates = [
+            tuple(char_tables[c] for c in t) for t in templates
+        ]
+        compiled = tuple(
+            templates[_seed_value(i, legacy) % len(templates)]
+            for i in range(256)
+        )
+        try:
+            cls._compiled[(template, legacy, extended)] = compiled
+        except TypeError:
+            pass
+        return compiled
+
+
+class KDFProfile(tuple):
+    """The scrypt parameters used to calculate keys"""
+
+    def __new__(cls, N=32768, r=8, p=2, dk_len=64):
+        N, r, p, dk_len = int(N), int(r), int(p), int(dk_len)
+        if N < 2 or N & (N - 1):
+            raise ValueError('N must be a power of 2 greater than 1')
+        if r < 1 or p < 1 or dk_len < 1:
+            raise ValueError('r, p and dk_len must be positive')
+        return tuple.__new__(cls, (N, r, p, dk_len))
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    @property
+    def N(self):
+        return self[0]
+
+    @property
+    def r(self):
+        return self[1]
+
+    @property
+    def p(self):
+        return self[2]
+
+    @property
+    def dk_len(self):
+        return self[3]
+
+    @property
+    def maxmem(self):
+        """The number of bytes scrypt needs with this profile"""
+        return 128 * self.r * (self.N + self.p + 2)
+
+    def __repr__(self):
+        return '{}(N={}, r={}, p={}, dk_len={})'.format(
+            getattr(type(self), '__qualname__', type(self).__name__), *self
+        )
+
+
+# The parameters of the Master Password algorithm. Other profiles can only
+# be used with namespaces that don't need to work with other
+# implementations.
+DEFAULT_KDF = KDFProfile()
 
 
 class MPWNameSpace(tuple):
@@ -96,23 +201,71 @@ class MPWNameSpace(tuple):
         return cls.reg[decode_if(name)]
 
     @classmethod
-    def create(cls, name, password=None, login=None, answer=None):
+    def create(cls, name, password=None, login=None, answer=None, kdf=None):
+        """
+        Register a namespace, or get it if it is already registered.
+
+        kdf: The KDFProfile to calculate keys with in this namespace
+          (Default DEFAULT_KDF). An already registered namespace is only
+          checked against it if it is given.
+        """
         name_e = encode_if(name)
         name_d = decode_if(name)
+        if kdf is not None and not isinstance(kdf, KDFProfile):
+            kdf = KDFProfile(*kdf)
         try:
-            return cls.reg[name_d]
+            existing = cls.reg[name_d]
         except KeyError:
             pass
+        else:
+            if kdf is not None and existing.kdf != kdf:
+                raise ValueError(
+                    'Namespace {!r} already has the KDF profile {!r}'.format(
+                        name_d, existing.kdf
+                    )
+                )
+            return existing
+        if kdf is None:
+            kdf = DEFAULT_KDF
         if password is None:
             password = name_e
         if login is None:
             login = name_e + b'.login'
         if answer is None:
             answer = name_e + b'.answer'
-        self = tuple.__new__(cls, (name_e, password, login, answer))
+        password, login, answer = map(encode_if, (password, login, answer))
+        self = tuple.__new__(cls, (name_e, password, login, answer, kdf))
+        # Everything that MPW.generate's namespace can be -> the encoded
+        # namespace, so it doesn't have to be worked out for every password
+        scopes = (
+            ('answer', answer), ('login', login), ('password', password),
+            ('name', name_e)
+        )
+        self._scopes = {}
+        for scope, prefix in scopes:
+            self._scopes[prefix] = prefix
+            try:
+                self._scopes[decode_if(prefix)] = prefix
+            except UnicodeDecodeError:
+                pass
+        # The names of scopes are used before namespaces with the same name
+        for scope, prefix in scopes:
+            self._scopes[scope] = self._scopes[encode_if(scope)] = prefix
         cls.reg[name_d] = self
         return self
 
+    def scope(self, namespace):
+        """
+        The encoded namespace for namespace, which is "password", "login",
+        "answer" or "name" or an already encoded namespace. None if it is
+        neither.
+        """
+        try:
+            return self._scopes.get(namespace)
+        except TypeError:
+            # Unhashable
+            return None
+
     @property
     def name(self):
         return self[0]
@@ -129,6 +282,10 @@ class MPWNameSpace(tuple):
     def answer(self):
         return self[3]
 
+    @property
+    def kdf(self):
+        return self[4]
+
     def __repr__(self):
         return '{}({!r})'.format(
             getattr(type(self), '__qualname__', type(self).__name__),
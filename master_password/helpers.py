@@ -1,4 +1,6 @@
-__all__ = ('encode_if', 'decode_if', 'uint8_list')
+__all__ = (
+    'encode_if', 'decode_if', 'uint8_list', 'hmac_sha256', 'write_private'
+)
 
 unicode = type(u'')
 
@@ -33,3 +35,45 @@ else:
             (uint_32 >> 0o10) & 0xff,
             (uint_32 >> 0o00) & 0xff
         ])
+
+
+_hmac = None
+_sha256 = None
+
+
+def hmac_sha256(key, msg=None):
+    """
+    hmac.new(key, msg, hashlib.sha256), but hmac and hashlib are only
+    imported the first time it is called (They take most of the time to
+    import master_password otherwise)
+    """
+    global _hmac, _sha256
+    if _hmac is None:
+        import hmac
+        import hashlib
+        _hmac = hmac
+        _sha256 = hashlib.sha256
+    return _hmac.new(key, msg, _sha256)
+
+
+def write_private(path, data):
+    """
+    Atomically replace the file at path with data (bytes), only readable and
+    writable by the current user
+    """
+    import os
+    import tempfile
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        os.chmod(tmp, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        try:
+            os.replace(tmp, path)
+        except AttributeError:
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
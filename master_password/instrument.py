@@ -0,0 +1,93 @@
+"""
+Hooks to see how long each part of the Master Password algorithm takes
+
+When an observer is set, it is called as observer(phase, seconds, info)
+after each phase, where info is a dict of details that are never secret
+(No names, passwords, keys, sites or seeds). The phases are:
+
+salt:      MPW.calculate_salt               info: {}
+key_cache: MPW.get_key with a key_cache     info: {"hit": bool}
+scrypt:    MPW.calculate_key                info: {"backend": name, "N": N,
+                                                   "r": r, "p": p}
+hmac:      Calculating a seed               info: {}
+memo:      A seed or password from a memo   info: {"hit": bool,
+                                                   "kind": "seed"/"generate"}
+render:    Turning a seed into a password   info: {"extended": bool}
+queue:     Waiting for MPW.scheduler        info: {"bytes": int,
+                                                   "queued": int}
+
+The *_many methods are not observed. When observer is None (The default),
+the only cost is checking that it is None.
+
+USAGE:
+
+>>> with Recorder() as recorder:
+...     mpw = MPW('Your Full Name', 'Your secret password')
+...     mpw.password('example.org')
+>>> recorder.summary()['scrypt']
+{'count': 1, 'total': 0.09, 'mean': 0.09, 'max': 0.09}
+"""
+
+import time
+
+__all__ = ('observer', 'set_observer', 'clock', 'Recorder')
+
+observer = None
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def set_observer(callback):
+    """
+    Call callback(phase, seconds, info) after every phase (Or stop if it is
+    None). Returns the previous observer.
+    """
+    global observer
+    previous = observer
+    observer = callback
+    return previous
+
+
+class Recorder(object):
+    """
+    An observer which counts and adds up the time of every phase. Can be
+    used as a context manager to observe while in the with block.
+    """
+
+    def __init__(self):
+        import threading
+        self._lock = threading.Lock()
+        # phase -> [count, total, max]
+        self._phases = {}
+        self._previous = None
+
+    def __call__(self, phase, seconds, info):
+        with self._lock:
+            stats = self._phases.get(phase)
+            if stats is None:
+                self._phases[phase] = [1, seconds, seconds]
+            else:
+                stats[0] += 1
+                stats[1] += seconds
+                if seconds > stats[2]:
+                    stats[2] = seconds
+
+    def summary(self):
+        """{phase: {"count": int, "total": s, "mean": s, "max": s}}"""
+        with self._lock:
+            return dict((phase, {
+                'count': count, 'total': total, 'mean': total / count,
+                'max': max_
+            }) for phase, (count, total, max_) in self._phases.items())
+
+    def clear(self):
+        with self._lock:
+            self._phases.clear()
+
+    def __enter__(self):
+        self._previous = set_observer(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        set_observer(self._previous)
+        self._previous = None
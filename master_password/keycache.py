@@ -0,0 +1,205 @@
+"""
+An encrypted on-disk cache of calculated keys, so that the key does not have
+to be recalculated with scrypt every time.
+
+Entries are found by HMAC(session secret, salt | master password) (So a
+wrong master password is just a cache miss) and encrypted with a different
+key derived from the same values, so a cached key can only be read with the
+right master password. The session secret is stored next to the cache,
+readable only by the current user.
+
+Anyone with a copy of the directory can check guesses of the master
+password with one HMAC-SHA256 each instead of scrypt, so by default the
+cache is only kept in $XDG_RUNTIME_DIR (Which is in memory and cleared on
+logout), and KeyCache() raises ValueError if there isn't one. Passing a
+directory explicitly accepts the risk for that directory.
+
+USAGE:
+
+>>> MPW.key_cache = KeyCache(ttl=300)
+>>> mpw = MPW('Your Full Name', 'Your secret password')  # Calculates the key
+>>> mpw = MPW('Your Full Name', 'Your secret password')  # Uses the cache
+"""
+
+import os
+import time
+import json
+import base64
+
+from master_password.helpers import encode_if, uint8_list, write_private
+from master_password.datatypes import DEFAULT_KDF
+from master_password._crypto import seal, unseal, _hmac
+
+__all__ = ('KeyCache', 'default_directory', 'runtime_directory')
+
+SECRET_SIZE = 32
+
+
+def default_directory():
+    """
+    $XDG_RUNTIME_DIR/master_password if it exists (Cleared on logout),
+    otherwise ~/.cache/master_password
+    """
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime and os.path.isdir(runtime):
+        return os.path.join(runtime, 'master_password')
+    return os.path.join(os.path.expanduser('~'), '.cache', 'master_password')
+
+
+def runtime_directory():
+    """
+    $XDG_RUNTIME_DIR/master_password, or None if there is no
+    $XDG_RUNTIME_DIR
+    """
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime and os.path.isdir(runtime):
+        return os.path.join(runtime, 'master_password')
+    return None
+
+
+def _well_formed(entry):
+    return isinstance(entry, dict) and all(
+        isinstance(entry.get(k), (int, float)) and
+        not isinstance(entry.get(k), bool) for k in ('created', 'used')
+    ) and isinstance(entry.get('key'), type(u''))
+
+
+class KeyCache(object):
+    """
+    Caches keys for at most ttl seconds, keeping at most max_entries.
+    directory defaults to runtime_directory().
+    """
+
+    def __init__(self, directory=None, ttl=300, max_entries=16):
+        if directory is None:
+            directory = runtime_directory()
+            if directory is None:
+                raise ValueError(
+                    'There is no $XDG_RUNTIME_DIR to keep the key cache in. '
+                    'Pass a directory to keep it somewhere else.'
+                )
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = os.path.join(directory, 'keycache.json')
+        self.secret_path = os.path.join(directory, 'session.key')
+
+    def _secret(self, create=False):
+        try:
+            with open(self.secret_path, 'rb') as f:
+                secret = f.read()
+            if len(secret) == SECRET_SIZE:
+                return secret
+        except (IOError, OSError):
+            pass
+        if not create:
+            return None
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0o700)
+        secret = os.urandom(SECRET_SIZE)
+        write_private(self.secret_path, secret)
+        # Entries encrypted with the old secret can't be read any more
+        write_private(self.path, b'{}')
+        return secret
+
+    def _read(self):
+        try:
+            with open(self.path, 'rb') as f:
+                entries = json.loads(f.read().decode('ascii'))
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def _load(self):
+        """The entries of the file, without malformed ones"""
+        return dict(
+            (k, v) for k, v in self._read().items() if _well_formed(v)
+        )
+
+    def _save(self, entries, now):
+        entries = dict(
+            (k, v) for k, v in entries.items() if now - v['created'] < self.ttl
+        )
+        if len(entries) > self.max_entries:
+            lru = sorted(entries, key=lambda k: entries[k]['used'])
+            for k in lru[:len(entries) - self.max_entries]:
+                del entries[k]
+        write_private(self.path, json.dumps(entries).encode('ascii'))
+
+    @staticmethod
+    def _derive(secret, label, salt, master_password, profile=None):
+        if profile is not None and profile != DEFAULT_KDF:
+            # Keys calculated with other scrypt parameters are different
+            label = label + b''.join(uint8_list(n) for n in profile)
+        return _hmac(
+            secret, label, uint8_list(len(salt)), salt,
+            encode_if(master_password)
+        )
+
+    def _id(self, secret, salt, master_password, profile=None):
+        return base64.b16encode(
+            self._derive(secret, b'id', salt, master_password, profile)
+        ).decode('ascii')
+
+    def get(self, salt, master_password, profile=None):
+        """
+        The cached key as a bytearray, or None if it is not cached. profile
+        is the KDFProfile the key was calculated with.
+        """
+        secret = self._secret()
+        if secret is None:
+            return None
+        stored = self._read()
+        entries = dict((k, v) for k, v in stored.items() if _well_formed(v))
+        id_ = self._id(secret, salt, master_password, profile)
+        now = time.time()
+        # Expired and malformed entries are removed on every access, even
+        # misses
+        expired = [
+            k for k, v in entries.items() if now - v['created'] >= self.ttl
+        ]
+        entry = entries.get(id_)
+        if entry is None or id_ in expired:
+            if expired or len(entries) != len(stored):
+                self._save(entries, now)
+            return None
+        try:
+            key = unseal(
+                self._derive(secret, b'key', salt, master_password, profile),
+                base64.b64decode(entry['key'].encode('ascii')), id_
+            )
+        except (TypeError, ValueError):
+            # Corrupted entry
+            del entries[id_]
+            self._save(entries, now)
+            return None
+        entry['used'] = now
+        self._save(entries, now)
+        return bytearray(key)
+
+    def put(self, salt, master_password, key, profile=None):
+        """Cache the key calculated from salt and master_password"""
+        secret = self._secret(create=True)
+        entries = self._load()
+        id_ = self._id(secret, salt, master_password, profile)
+        entry_key = self._derive(
+            secret, b'key', salt, master_password, profile
+        )
+        sealed = seal(entry_key, bytes(key), id_)
+        now = time.time()
+        entries[id_] = {
+            'created': now,
+            'used': now,
+            'key': base64.b64encode(sealed).decode('ascii')
+        }
+        self._save(entries, now)
+
+    def clear(self):
+        """Remove every cached key and the session secret"""
+        for path in (self.path, self.secret_path):
+            try:
+                os.remove(path)
+            except (IOError, OSError):
+                pass
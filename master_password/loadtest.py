@@ -0,0 +1,460 @@
+#!/usr/bin/env python
+
+"""
+A load generator which simulates many users unlocking and generating at
+once, reporting throughput, latency percentiles and peak memory
+
+Operations are a weighted mix of "unlock" (Calculating a key again, like a
+user logging in) and "password", "login", "answer" and "pin" for users who
+are already unlocked. They are started at a target rate (Or as fast as
+possible), by threads in this process or in several processes. With a
+target rate, latency is measured from when an operation should have
+started, so falling behind shows up as latency instead of being hidden.
+
+Everything runs offline, either against the library in the worker
+processes ("library", the default), a running master_password.server
+(http://host:port), a running daemon (unix:/path/to/socket), or a
+master_password.server started just for the test (--serve).
+
+--kdf N,r,p uses cheap scrypt parameters (In their own namespace), so
+unlocks don't dominate. A service that is already running only knows that
+namespace if it was registered there too.
+
+USAGE:
+
+$ python -m master_password.loadtest --users 500 --operations 20000 \\
+    --rate 2000 --threads 16 --mix unlock=1,password=20,login=5 \\
+    --kdf 1024,8,1
+$ python -m master_password.loadtest --serve 4 --processes 4 --kdf 1024,8,1
+$ python -m master_password.loadtest --target http://127.0.0.1:8437
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import collections
+
+from master_password import MPW, MPW_DEFAULT_NAMESPACE
+from master_password.datatypes import MPWNameSpace, KDFProfile
+
+__all__ = ('percentile', 'parse_mix', 'schedule', 'peak_rss', 'run', 'main')
+
+OPS = ('unlock', 'password', 'login', 'answer', 'pin')
+
+DEFAULT_MIX = {'unlock': 1, 'password': 10, 'login': 3, 'answer': 1,
+               'pin': 1}
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+def percentile(values, q):
+    """The q-th percentile (0 to 100) of sorted values, by nearest rank"""
+    if not values:
+        return None
+    index = max(0, int(-(-q * len(values) // 100)) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def parse_mix(mix):
+    """'unlock=1,password=10' -> {'unlock': 1.0, 'password': 10.0}"""
+    weights = {}
+    for part in mix.split(','):
+        op, _, weight = part.partition('=')
+        op = op.strip()
+        if op not in OPS:
+            raise ValueError('Unknown operation {!r}'.format(op))
+        weights[op] = float(weight) if weight else 1.0
+    return weights
+
+
+def _user(index):
+    return 'Load Test User {}'.format(index), 'password {}'.format(index)
+
+
+def _namespace(kdf):
+    """The namespace to use for kdf (A tuple of N, r, p or None)"""
+    if kdf is None:
+        return MPW_DEFAULT_NAMESPACE
+    kdf = KDFProfile(*kdf)
+    return MPWNameSpace.create(
+        'master_password.loadtest.{}.{}.{}'.format(kdf.N, kdf.r, kdf.p),
+        kdf=kdf
+    )
+
+
+def schedule(operations, users, mix=None, rate=None, seed=0):
+    """
+    The operations to run, as (start offset in seconds or None, op, user
+    index, site index), in order
+    """
+    if mix is None:
+        mix = DEFAULT_MIX
+    ops = sorted(op for op in mix if mix[op] > 0)
+    if not ops:
+        raise ValueError('The mix must have an operation with a weight')
+    total = float(sum(mix[op] for op in ops))
+    thresholds = []
+    cumulative = 0.0
+    for op in ops:
+        cumulative += mix[op] / total
+        thresholds.append((cumulative, op))
+    rng = random.Random(seed)
+    jobs = []
+    for i in range(operations):
+        x = rng.random()
+        op = next((op for limit, op in thresholds if x < limit), ops[-1])
+        jobs.append((
+            None if rate is None else i / float(rate), op,
+            rng.randrange(users), rng.randrange(100)
+        ))
+    return jobs
+
+
+class _Library(object):
+    """Runs operations with MPW objects in this process"""
+
+    def __init__(self, kdf):
+        self.namespace = _namespace(kdf)
+        self._mpws = {}
+
+    def unlock(self, user):
+        full_name, master_password = _user(user)
+        self._mpws[user] = MPW(full_name, master_password, self.namespace)
+
+    def call(self, op, user, site):
+        if op == 'unlock':
+            return self.unlock(user)
+        mpw = self._mpws[user]
+        site = 'site{}.example'.format(site)
+        if op == 'answer':
+            return mpw.answer(site, context='Question {}?'.format(user))
+        return getattr(mpw, op)(site)
+
+    def close(self):
+        pass
+
+
+class _Service(object):
+    """Runs operations with a master_password.server or daemon"""
+
+    def __init__(self, url, token, kdf):
+        self.url = url
+        self.token = token
+        self.namespace = None
+        if kdf is not None:
+            self.namespace = _namespace(kdf).name.decode('utf-8')
+        self._local = threading.local()
+        self._clients = []
+        self._lock = threading.Lock()
+
+    def _client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            if self.url.startswith('unix:'):
+                from master_password.daemon import Client
+                client = Client(self.url[len('unix:'):])
+            else:
+                from master_password.server import Client
+                address = self.url.split('://', 1)[-1].rstrip('/')
+                host, _, port = address.rpartition(':')
+                client = Client(host, int(port), self.token)
+            self._local.client = client
+            with self._lock:
+                self._clients.append(client)
+        return client
+
+    def _request(self, op, user, **kwargs):
+        kwargs['full_name'] = _user(user)[0]
+        if self.namespace is not None:
+            kwargs['namespace'] = self.namespace
+        response = self._client().request(op, **kwargs)
+        if not response['ok']:
+            raise RuntimeError(response['error'])
+        return response['result']
+
+    def unlock(self, user):
+        self._request('unlock', user, master_password=_user(user)[1])
+
+    def call(self, op, user, site):
+        if op == 'unlock':
+            return self.unlock(user)
+        kwargs = {'site': 'site{}.example'.format(site)}
+        if op == 'answer':
+            kwargs['context'] = 'Question {}?'.format(user)
+        return self._request(op, user, **kwargs)
+
+    def close(self):
+        for client in self._clients:
+            client.close()
+
+
+def _run_threads(threads, f, items):
+    """Call f(item) for every item in items with threads threads"""
+    items = collections.deque(items)
+
+    def work():
+        while True:
+            try:
+                item = items.popleft()
+            except IndexError:
+                return
+            f(item)
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def _work(target, token, kdf, jobs, users, threads):
+    """
+    Unlock users, then run jobs with threads threads. Returns
+    {"warmup": seconds, "seconds": seconds, "latencies": {op: [seconds]},
+    "errors": {op: count}, "error": The first error or None}
+    """
+    if target == 'library':
+        runner = _Library(kdf)
+    else:
+        runner = _Service(target, token, kdf)
+    try:
+        start = _clock()
+        _run_threads(threads, runner.unlock, users)
+        warmup = _clock() - start
+        latencies = dict((op, []) for op in OPS)
+        errors = dict((op, 0) for op in OPS)
+        # The first error, to see why operations are failing
+        first_error = []
+        errors_lock = threading.Lock()
+        start = _clock()
+
+        def run_job(job):
+            offset, op, user, site = job
+            if offset is None:
+                began = _clock()
+            else:
+                began = start + offset
+                delay = began - _clock()
+                if delay > 0:
+                    time.sleep(delay)
+            try:
+                runner.call(op, user, site)
+            except Exception as e:
+                with errors_lock:
+                    errors[op] += 1
+                    if not first_error:
+                        first_error.append('{}: {}'.format(
+                            type(e).__name__, e
+                        ))
+            else:
+                latencies[op].append(_clock() - began)
+
+        _run_threads(threads, run_job, jobs)
+        seconds = _clock() - start
+    finally:
+        runner.close()
+    return {
+        'warmup': warmup, 'seconds': seconds, 'latencies': latencies,
+        'errors': errors, 'error': first_error[0] if first_error else None
+    }
+
+
+def _work_job(args):
+    return _work(*args)
+
+
+def peak_rss():
+    """
+    The peak resident memory of this process and of its finished child
+    processes in bytes, or (None, None) if it can't be measured
+    """
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    # Bytes on macOS, KiB elsewhere
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    )
+
+
+def run(target='library', users=50, operations=1000, rate=None, threads=8,
+        processes=1, mix=None, kdf=None, token=None, serve=None, seed=0):
+    """
+    Run a load test, returning the results as a dict
+
+    target: "library", "http://host:port" or "unix:/path/to/socket"
+    rate: Operations to start per second (As fast as possible if None)
+    threads: Threads running operations in each process
+    processes: The operations are split between this many processes by
+      user (So each process only unlocks its own users)
+    kdf: (N, r, p) of cheap scrypt parameters to use
+    serve: Start a master_password.server with this many workers for the
+      test, and use it as the target
+    """
+    server = None
+    if serve is not None:
+        from master_password import server as server_module
+        # Registered before the workers are started, so they know it
+        _namespace(kdf)
+        server = server_module.Server(port=0, workers=serve, token=token)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.start()
+        target = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    try:
+        jobs = schedule(operations, users, mix, rate, seed)
+        parts = [(
+            target, token, kdf,
+            [job for job in jobs if job[2] % processes == i],
+            list(range(i, users, processes)), threads
+        ) for i in range(processes)]
+        start = _clock()
+        if processes == 1:
+            outcomes = [_work(*parts[0])]
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(processes) as executor:
+                outcomes = list(executor.map(_work_job, parts))
+        elapsed = _clock() - start
+    finally:
+        if server is not None:
+            server.shutdown()
+            server_thread.join()
+            server.server_close()
+    return _summarize(
+        outcomes, elapsed, target, rate, threads, processes, kdf
+    )
+
+
+def _summarize(outcomes, elapsed, target, rate, threads, processes, kdf):
+    seconds = max(outcome['seconds'] for outcome in outcomes)
+    warmup = max(outcome['warmup'] for outcome in outcomes)
+    all_latencies = []
+    results = {}
+    for op in OPS:
+        latencies = sorted(
+            latency for outcome in outcomes
+            for latency in outcome['latencies'][op]
+        )
+        errors = sum(outcome['errors'][op] for outcome in outcomes)
+        if not latencies and not errors:
+            continue
+        all_latencies.extend(latencies)
+        results[op] = _stats(latencies, errors, seconds)
+    all_latencies.sort()
+    self_rss, children_rss = peak_rss()
+    return {
+        'target': target, 'rate': rate, 'threads': threads,
+        'processes': processes, 'kdf': None if kdf is None else list(kdf),
+        'warmup': warmup, 'seconds': seconds, 'elapsed': elapsed,
+        'total': _stats(all_latencies, sum(
+            result['errors'] for result in results.values()
+        ), seconds),
+        'operations': results, 'error': next((
+            outcome['error'] for outcome in outcomes if outcome['error']
+        ), None),
+        'peak_rss': self_rss, 'peak_rss_children': children_rss
+    }
+
+
+def _stats(latencies, errors, seconds):
+    return {
+        'count': len(latencies), 'errors': errors,
+        'throughput': len(latencies) / seconds if seconds else None,
+        'mean': sum(latencies) / len(latencies) if latencies else None,
+        'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1] if latencies else None
+    }
+
+
+def _ms(seconds):
+    return '-' if seconds is None else '{:.2f}'.format(seconds * 1000)
+
+
+def _mib(size):
+    return '-' if size is None else '{:.1f} MiB'.format(size / 1048576.0)
+
+
+def _report(results):
+    print('Target: {}, {} process(es) x {} thread(s), rate: {}'.format(
+        results['target'], results['processes'], results['threads'],
+        results['rate'] or 'unlimited'
+    ))
+    print('Unlocked users in {:.3f}s, ran for {:.3f}s'.format(
+        results['warmup'], results['seconds']
+    ))
+    print('{:<9} {:>7} {:>6} {:>9} {:>8} {:>8} {:>8} {:>8}'.format(
+        'op', 'count', 'errors', 'ops/s', 'p50 ms', 'p95 ms', 'p99 ms',
+        'max ms'
+    ))
+    rows = sorted(results['operations'].items())
+    rows.append(('total', results['total']))
+    for op, stats in rows:
+        print('{:<9} {:>7} {:>6} {:>9.1f} {:>8} {:>8} {:>8} {:>8}'.format(
+            op, stats['count'], stats['errors'], stats['throughput'] or 0,
+            _ms(stats['p50']), _ms(stats['p95']), _ms(stats['p99']),
+            _ms(stats['max'])
+        ))
+    if results['error'] is not None:
+        print('First error: {}'.format(results['error']))
+    print('Peak RSS: {} (Child processes: {})'.format(
+        _mib(results['peak_rss']), _mib(results['peak_rss_children'])
+    ))
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description='Simulate many users unlocking and generating at once',
+        prog='master_password.loadtest'
+    )
+    parser.add_argument('--target', default='library',
+                        help='"library" (Default), http://host:port of a '
+                             'server or unix:/path of a daemon socket')
+    parser.add_argument('--serve', type=int, default=None, metavar='WORKERS',
+                        help='Start a server with this many workers to test')
+    parser.add_argument('--token', default=None,
+                        help='The token of the server')
+    parser.add_argument('-u', '--users', type=int, default=50,
+                        help='Simulated users (Default 50)')
+    parser.add_argument('-n', '--operations', type=int, default=1000,
+                        help='Operations to run (Default 1000)')
+    parser.add_argument('-r', '--rate', type=float, default=None,
+                        help='Operations to start per second (Default as '
+                             'fast as possible)')
+    parser.add_argument('-t', '--threads', type=int, default=8,
+                        help='Threads per process (Default 8)')
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='Processes to split users between (Default 1)')
+    parser.add_argument('-m', '--mix', type=parse_mix, default=None,
+                        help='Weights of operations, e.g. '
+                             'unlock=1,password=10,login=3,answer=1,pin=1 '
+                             '(The default)')
+    parser.add_argument('--kdf', default=None, metavar='N,r,p',
+                        help='Cheap scrypt parameters to unlock with')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='The random seed of the operations')
+    parser.add_argument('--json', action='store_true',
+                        help='Write the results as JSON')
+    args = parser.parse_args(argv)
+
+    kdf = None
+    if args.kdf is not None:
+        kdf = tuple(int(n) for n in args.kdf.split(','))
+    results = run(
+        args.target, args.users, args.operations, args.rate, args.threads,
+        args.processes, args.mix, kdf, args.token, args.serve, args.seed
+    )
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        _report(results)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
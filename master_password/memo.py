@@ -0,0 +1,94 @@
+"""
+A thread-safe LRU cache with a time to live, used by MPW.enable_memo to
+remember seeds and generated passwords
+
+Cached seeds (bytearrays) are copied in and out while the lock is held, so
+another thread can't change the caller's copy, and the cached copy is
+overwritten with zeros when it is evicted, expires or is cleared.
+"""
+
+import time
+import threading
+import collections
+
+__all__ = ('Memo',)
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+def _wipe(value):
+    if isinstance(value, bytearray):
+        value[:] = bytearray(len(value))
+
+
+def _copy(value):
+    if isinstance(value, bytearray):
+        return bytearray(value)
+    return value
+
+
+class Memo(object):
+    """
+    Keeps at most maxsize values, each for at most ttl seconds (Forever if
+    ttl is None). Counts hits and misses.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> (value, expiry time), least recently used first
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        """The value for key (A copy if it is a bytearray), or None"""
+        with self._lock:
+            try:
+                entry = self._entries.pop(key, None)
+            except TypeError:
+                # Unhashable
+                entry = None
+            if entry is not None and (
+                    entry[1] is not None and _clock() >= entry[1]
+            ):
+                _wipe(entry[0])
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return _copy(entry[0])
+
+    def put(self, key, value):
+        """Cache value (A copy if it is a bytearray) for key"""
+        expires = None if self.ttl is None else _clock() + self.ttl
+        with self._lock:
+            try:
+                old = self._entries.pop(key, None)
+            except TypeError:
+                return
+            value = _copy(value)
+            if old is not None:
+                _wipe(old[0])
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.maxsize:
+                _wipe(self._entries.popitem(last=False)[1][0])
+
+    def clear(self):
+        """Forget (And wipe) every value. The counters are not reset."""
+        with self._lock:
+            for value, expires in self._entries.values():
+                _wipe(value)
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits, 'misses': self.misses,
+            'size': len(self._entries), 'maxsize': self.maxsize
+        }
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,86 +1,469 @@
-# Based on https://github.com/Lyndir/MasterPassword/issues/164#issuecomment-310868274
-# See https://github.com/Lyndir/MasterPassword/issues/164
+"""
+An encrypted store of the sites of Master Password users, which can be read
+and updated one site at a time.
 
-# Unfinished
-raise ImportError('Cannot import name \'mpsites\'')
+The file is MAGIC followed by records, each a 4 byte big endian length, a
+1 byte type and that many bytes of payload:
 
+USER:   key id | sealed({"full_name": ..., "version": ...})
+SITE:   key id | site id | sealed({"site": ..., "counter": ..., ...})
+DELETE: key id | site id
+
+The key id is the SHA-256 of the user's key (The same as the verifier) and
+the site id is an HMAC of the site name with a key derived from the user's
+key, so nothing about a user or site can be read without the master
+password. Later records replace earlier ones with the same ids, so updates
+are only appended. An index of where every record is is built when the
+file is opened, and compact() rewrites the file without replaced records.
+
+Stores can share the file: every operation holds a lock on path + ".lock"
+(Where fcntl is available), and first indexes the records that other
+stores appended, or the whole file again if another store compacted it.
+
+SiteReader reads a store without an index or loading it into memory, for
+importing large stores.
+
+USAGE:
+
+>>> with SiteStore('sites.mpsites') as store:
+...     store.put(mpw, 'example.org', counter=2, template='max')
+...     store.get(mpw, 'example.org')
+{'site': 'example.org', 'counter': 2, 'template': 'max'}
+"""
+
+import os
+import mmap
 import json
+import struct
+import hashlib
+import threading
+import contextlib
 import collections
-import base64
 
-from cryptography.hazmat.primitives.ciphers.algorithms import AES
+from master_password.helpers import encode_if, decode_if
+from master_password._crypto import seal, unseal, _hmac
 
+__all__ = (
+    'SiteStore', 'SiteReader', 'Record', 'MAGIC', 'USER', 'SITE', 'DELETE'
+)
+
+MAGIC = b'MPSITES\x01'
+
+USER = 1
+SITE = 2
+DELETE = 3
 
-try:
-    from master_password._get_scrypt import backend
-except ImportError:
-    from cryptography.hazmat.backends import default_backend
-    backend = default_backend()
+ID_SIZE = 32
 
-from master_password import (
-    SCRYPT_N, SCRYPT_r, SCRYPT_p, SCRYPT_dk_len, scrypt, encode_if
+_header = struct.Struct('>IB')
+
+# sealed is None for DELETE records and site_id is None for USER records
+Record = collections.namedtuple(
+    'Record', ('offset', 'type', 'key_id', 'site_id', 'sealed')
 )
 
 
-ENC_ALG = 'A256GCM'
-KEY_MGMT_ALG = 'dir'  # TODO: Verify this
+def _key_id(key):
+    return hashlib.sha256(bytes(key)).digest()
 
-_versions = {}
 
+def _user_keys(key):
+    """(key to seal records with, key to make site ids with)"""
+    key = bytes(key)
+    return _hmac(key, b'mpsites seal'), _hmac(key, b'mpsites site id')
 
-def _version(n):
-    def register(f):
-        _versions[n] = f
-        return f
-    return register
 
+def _unseal_json(seal_key, sealed, associated_data):
+    return json.loads(
+        unseal(seal_key, sealed, associated_data).decode('utf-8')
+    )
 
-def encode(users, default, version=1):
-    f = _versions.get(version, None)
-    if f is None:
-        raise ValueError('Invalid version: {!r}'.format(version))
-    return f(users, default)
 
+class SiteStore(object):
+    """The site store at path, which is created if it doesn't exist"""
 
-@_version(1)
-@_version(1.0)
-def _encode(users, default):
-    users_dict = {}
-    mpsites = {
-        'version': 2,
-        'default': getattr(default, 'full_name', default),
-        'users': users_dict
-    }
-    for user in users:
-        if not isinstance(user, User):
-            users_dict[user[0]] = user[1]
-            continue
-        user_dict = {}
-        users_dict[user.full_name] = user_dict
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            import fcntl
+        except ImportError:
+            self._flock = self._lock_fd = None
+        else:
+            self._flock = fcntl.flock, fcntl.LOCK_EX, fcntl.LOCK_UN
+            self._lock_fd = os.open(
+                path + '.lock', os.O_RDWR | os.O_CREAT, 0o600
+            )
+        self._file = None
+        try:
+            with self._locked():
+                self._file = self._open()
+                self._scan()
+        except BaseException:
+            self.close()
+            raise
 
-        keyhash = jwcrypto.common.base64url_encode(
-            scrypt(encode_if(user.key), encode_if(user.key),
-                   SCRYPT_N, SCRYPT_r, SCRYPT_p, SCRYPT_dk_len)
-        )
-        keyhash_version = 'v' + str(user.version)
-        user_dict['keyhash'] = keyhash
-        user_dict['keyhash_version'] = keyhash_version
-
-        plaintext = jwcrypto.common.json_encode(user.sites)
-        # TODO: salt and info.
-        kdf = HKDF(
-            hashes.SHA256(), 64, salt=b'???', info=b'???', backend=backend
+    def _open(self):
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        return os.fdopen(os.open(self.path, flags, 0o600), 'r+b')
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the lock of this store and of the file"""
+        with self._lock:
+            if self._flock is None:
+                yield
+                return
+            flock, exclusive, unlock = self._flock
+            flock(self._lock_fd, exclusive)
+            try:
+                yield
+            finally:
+                flock(self._lock_fd, unlock)
+
+    def _refresh(self):
+        """Index what other stores changed. The lock must be held."""
+        try:
+            replaced = os.stat(self.path).st_ino != os.fstat(
+                self._file.fileno()
+            ).st_ino
+        except OSError:
+            replaced = False
+        if replaced:
+            # Compacted
+            self._file.close()
+            self._file = self._open()
+            self._scan()
+            return
+        size = os.fstat(self._file.fileno()).st_size
+        if size > self._end:
+            self._scan(self._end)
+        elif size < self._end:
+            self._scan()
+
+    def _scan(self, offset=None):
+        """
+        Index every record header after offset (Every record if None). The
+        lock must be held, as the rest of an interrupted write is removed.
+        """
+        f = self._file
+        if offset is None:
+            # key id -> [user record offset, {site id -> site offset}]
+            self._index = {}
+            f.seek(0)
+            magic = f.read(len(MAGIC))
+            if not magic:
+                f.write(MAGIC)
+                f.flush()
+                self._end = len(MAGIC)
+                return
+            if magic != MAGIC:
+                raise ValueError(
+                    '{!r} is not a site store'.format(self.path)
+                )
+            offset = len(MAGIC)
+        size = os.fstat(f.fileno()).st_size
+        f.seek(offset)
+        while offset + _header.size + ID_SIZE <= size:
+            length, type_ = _header.unpack(f.read(_header.size))
+            end = offset + _header.size + length
+            if end > size:
+                break
+            ids = f.read(min(length, 2 * ID_SIZE))
+            self._index_record(type_, ids, offset)
+            f.seek(end)
+            offset = end
+        if offset < size:
+            # The rest is from an interrupted write
+            f.truncate(offset)
+        self._end = offset
+
+    def _index_record(self, type_, ids, offset):
+        key_id = ids[:ID_SIZE]
+        if type_ == USER:
+            self._index.setdefault(key_id, [None, {}])[0] = offset
+        elif type_ == SITE:
+            self._index.setdefault(key_id, [None, {}])[1][
+                ids[ID_SIZE:]
+            ] = offset
+        elif type_ == DELETE:
+            entry = self._index.get(key_id)
+            if entry is not None:
+                entry[1].pop(ids[ID_SIZE:], None)
+
+    def _append(self, type_, payload):
+        """Append a record. The lock must be held and _refresh called."""
+        f = self._file
+        f.seek(self._end)
+        f.write(_header.pack(len(payload), type_))
+        f.write(payload)
+        f.flush()
+        offset = self._end
+        self._end = f.tell()
+        self._index_record(type_, payload[:2 * ID_SIZE], offset)
+
+    def _write(self, type_, payload):
+        with self._locked():
+            self._refresh()
+            self._append(type_, payload)
+
+    def _read(self, offset):
+        """The type and payload of the record at offset (Under the lock)"""
+        f = self._file
+        f.seek(offset)
+        length, type_ = _header.unpack(f.read(_header.size))
+        return type_, f.read(length)
+
+    @contextlib.contextmanager
+    def _current(self):
+        """The lock, with what other stores changed indexed"""
+        with self._locked():
+            self._refresh()
+            yield self._index
+
+    @staticmethod
+    def _site_id(site_key, site):
+        return _hmac(site_key, encode_if(site))
+
+    def __contains__(self, mpw):
+        with self._current() as index:
+            return _key_id(mpw.key) in index
+
+    def __len__(self):
+        """The number of users"""
+        with self._current() as index:
+            return len(index)
+
+    def add_user(self, mpw, full_name=None):
+        """Store the full name and version of mpw"""
+        if full_name is None:
+            full_name = mpw.full_name
+        key_id = _key_id(mpw.key)
+        seal_key = _user_keys(mpw.key)[0]
+        data = json.dumps({
+            'full_name': decode_if(full_name), 'version': mpw.version
+        }).encode('utf-8')
+        self._write(USER, key_id + seal(seal_key, data, key_id))
+
+    def user(self, mpw):
+        """The stored {"full_name": ..., "version": ...} for mpw, or None"""
+        key_id = _key_id(mpw.key)
+        with self._current() as index:
+            entry = index.get(key_id)
+            if entry is None or entry[0] is None:
+                return None
+            payload = self._read(entry[0])[1]
+        seal_key = _user_keys(mpw.key)[0]
+        return _unseal_json(seal_key, payload[ID_SIZE:], key_id)
+
+    def get(self, mpw, site):
+        """The stored dict for site, or None if it isn't stored"""
+        key_id = _key_id(mpw.key)
+        seal_key, site_key = _user_keys(mpw.key)
+        site_id = self._site_id(site_key, site)
+        with self._current() as index:
+            entry = index.get(key_id)
+            if entry is None or site_id not in entry[1]:
+                return None
+            payload = self._read(entry[1][site_id])[1]
+        return self._open_site(seal_key, payload)
+
+    @staticmethod
+    def _open_site(seal_key, payload):
+        return _unseal_json(
+            seal_key, payload[2 * ID_SIZE:], payload[:2 * ID_SIZE]
         )
-        cipher = jwcrypto.jwe.JWE(plaintext=plaintext, protected={
-            'alg': KEY_MGMT_ALG,
-            'enc': ENC_ALG,
-            'keyhash': keyhash,
-            'keyhash_version': keyhash_version
-        }, algs=[ENC_ALG], recipient=kdf.derive(user.key))
 
-        user_dict['sites'] = cipher.serialize()
-    return json.dumps(mpsites)
+    def put(self, mpw, site, **fields):
+        """
+        Store site with fields (e.g., counter, template, login_name),
+        replacing anything stored for it before
+        """
+        key_id = _key_id(mpw.key)
+        seal_key, site_key = _user_keys(mpw.key)
+        ids = key_id + self._site_id(site_key, site)
+        fields['site'] = decode_if(site)
+        data = json.dumps(fields, sort_keys=True).encode('utf-8')
+        self._write(SITE, ids + seal(seal_key, data, ids))
+
+    def delete(self, mpw, site):
+        """Forget site. Returns whether it was stored."""
+        key_id = _key_id(mpw.key)
+        site_id = self._site_id(_user_keys(mpw.key)[1], site)
+        with self._current() as index:
+            entry = index.get(key_id)
+            if entry is None or site_id not in entry[1]:
+                return False
+            self._append(DELETE, key_id + site_id)
+        return True
+
+    def sites(self, mpw):
+        """Generate the stored dict of every site of mpw"""
+        key_id = _key_id(mpw.key)
+        seal_key = _user_keys(mpw.key)[0]
+        with self._current() as index:
+            entry = index.get(key_id)
+            if entry is None:
+                return
+            payloads = [
+                self._read(offset)[1] for offset in sorted(entry[1].values())
+            ]
+        for payload in payloads:
+            yield self._open_site(seal_key, payload)
+
+    def compact(self):
+        """Rewrite the file with only the records that are still used"""
+        with self._current():
+            tmp = self.path + '.tmp'
+            flags = os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(
+                os, 'O_BINARY', 0
+            )
+            new = os.fdopen(os.open(tmp, flags, 0o600), 'w+b')
+            try:
+                new.write(MAGIC)
+                offsets = []
+                for user_offset, sites in self._index.values():
+                    if user_offset is not None:
+                        offsets.append(user_offset)
+                    offsets.extend(sites.values())
+                for offset in sorted(offsets):
+                    self._file.seek(offset)
+                    header = self._file.read(_header.size)
+                    new.write(header)
+                    new.write(self._file.read(_header.unpack(header)[0]))
+                new.flush()
+                os.fsync(new.fileno())
+            except BaseException:
+                new.close()
+                os.remove(tmp)
+                raise
+            self._file.close()
+            try:
+                os.replace(tmp, self.path)
+            except AttributeError:
+                os.remove(self.path)
+                os.rename(tmp, self.path)
+            self._file = new
+            self._scan()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class SiteReader(object):
+    """
+    A read only view of the site store at path, which memory-maps the file
+    and only reads records as they are used. Sealed data is passed to
+    unseal as a memoryview into the file, without being copied.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < len(MAGIC):
+                raise ValueError('{!r} is not a site store'.format(path))
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        if self._view[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError('{!r} is not a site store'.format(path))
+
+    def _record(self, offset):
+        """The Record at offset and the offset after it, or None at the end"""
+        view = self._view
+        if offset + _header.size + ID_SIZE > len(view):
+            return None
+        length, type_ = _header.unpack_from(self._mmap, offset)
+        start = offset + _header.size
+        end = start + length
+        if end > len(view):
+            # Interrupted write
+            return None
+        key_id = bytes(view[start:start + ID_SIZE])
+        if type_ == USER:
+            return Record(
+                offset, type_, key_id, None, view[start + ID_SIZE:end]
+            ), end
+        site_id = bytes(view[start + ID_SIZE:start + 2 * ID_SIZE])
+        if type_ == DELETE:
+            return Record(offset, type_, key_id, site_id, None), end
+        return Record(
+            offset, type_, key_id, site_id, view[start + 2 * ID_SIZE:end]
+        ), end
+
+    def records(self):
+        """
+        Generate every Record in the file in order, including replaced and
+        deleted ones. record.sealed can only be used until close().
+        """
+        offset = len(MAGIC)
+        while True:
+            record = self._record(offset)
+            if record is None:
+                return
+            record, offset = record
+            yield record
+
+    def users(self):
+        """Generate every USER Record (Encrypted with each user's key)"""
+        for record in self.records():
+            if record.type == USER:
+                yield record
+
+    def _latest(self, key_id):
+        """The offset of the latest USER record and of each live SITE"""
+        user = None
+        sites = {}
+        for record in self.records():
+            if record.key_id != key_id:
+                continue
+            if record.type == USER:
+                user = record.offset
+            elif record.type == SITE:
+                sites[record.site_id] = record.offset
+            elif record.type == DELETE:
+                sites.pop(record.site_id, None)
+        return user, sites
+
+    def user(self, mpw):
+        """The latest {"full_name": ..., "version": ...} for mpw, or None"""
+        key_id = _key_id(mpw.key)
+        offset = self._latest(key_id)[0]
+        if offset is None:
+            return None
+        record = self._record(offset)[0]
+        return _unseal_json(_user_keys(mpw.key)[0], record.sealed, key_id)
+
+    def sites(self, mpw):
+        """
+        Generate the dict of every site of mpw, like SiteStore.sites, only
+        decrypting one site at a time
+        """
+        key_id = _key_id(mpw.key)
+        seal_key = _user_keys(mpw.key)[0]
+        for offset in sorted(self._latest(key_id)[1].values()):
+            record = self._record(offset)[0]
+            yield _unseal_json(
+                seal_key, record.sealed, record.key_id + record.site_id
+            )
+
+    def close(self):
+        """Unmap the file. Every record.sealed must have been released."""
+        self._view.release()
+        self._mmap.close()
 
-User = collections.namedtuple('User', ('key', 'full_name', 'sites', 'version'))
+    def __enter__(self):
+        return self
 
-# raise NotImplementedError
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
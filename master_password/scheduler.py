@@ -0,0 +1,164 @@
+"""
+Admission control for scrypt, so many keys being calculated at once can't
+use more memory than a budget
+
+Every key needs profile.maxmem bytes (128 * r * (N + p + 2), 32 MiB with
+the default parameters) while it is being calculated. With MPW.scheduler
+set, MPW.calculate_key waits until that much of the budget is free, in the
+order that calls arrived, so a burst of unlocks is queued instead of
+running out of memory.
+
+A key that needs more than the whole budget is calculated when nothing
+else is. If max_queue calls are already waiting, RuntimeError is raised
+straight away, and TimeoutError is raised after waiting for timeout
+seconds.
+
+The scheduler is per process (master_password.bulk limits its processes
+with maxmem instead).
+
+USAGE:
+
+>>> MPW.scheduler = DerivationScheduler(budget=128 << 20, timeout=30)
+>>> mpw = MPW('Your Full Name', 'Your secret password')
+>>> MPW.scheduler.stats()['admitted']
+1
+"""
+
+import time
+import threading
+import collections
+import contextlib
+
+from master_password import instrument
+
+__all__ = ('DerivationScheduler',)
+
+try:
+    _TimeoutError = TimeoutError
+except NameError:
+    _TimeoutError = OSError
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class DerivationScheduler(object):
+    """
+    Lets keys be calculated while they fit in budget bytes, queueing at
+    most max_queue (Unlimited if None) calls for at most timeout seconds
+    (Forever if None) each
+    """
+
+    def __init__(self, budget=256 << 20, max_queue=None, timeout=None):
+        if budget <= 0:
+            raise ValueError('budget must be positive')
+        self.budget = budget
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._condition = threading.Condition()
+        # [bytes] for every waiting call, first come first served
+        self._queue = collections.deque()
+        self._in_use = 0
+        self._running = 0
+        self._admitted = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._max_queued = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _fits(self, size):
+        return self._running == 0 or self._in_use + size <= self.budget
+
+    def acquire(self, size, timeout=None):
+        """
+        Wait until size bytes of the budget are free and take them. Returns
+        the seconds waited.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        start = _clock()
+        with self._condition:
+            if not self._queue and self._fits(size):
+                self._admit(size, 0.0)
+                return 0.0
+            if self.max_queue is not None and (
+                    len(self._queue) >= self.max_queue
+            ):
+                self._rejected += 1
+                raise RuntimeError(
+                    'Too many keys waiting to be calculated ({})'.format(
+                        len(self._queue)
+                    )
+                )
+            ticket = [size]
+            self._queue.append(ticket)
+            self._max_queued = max(self._max_queued, len(self._queue))
+            try:
+                while not (self._queue[0] is ticket and self._fits(size)):
+                    if timeout is None:
+                        self._condition.wait()
+                        continue
+                    remaining = start + timeout - _clock()
+                    if remaining <= 0:
+                        self._timed_out += 1
+                        raise _TimeoutError(
+                            'Waited {} seconds to calculate a key'.format(
+                                timeout
+                            )
+                        )
+                    self._condition.wait(remaining)
+            finally:
+                if self._queue[0] is ticket:
+                    self._queue.popleft()
+                else:
+                    self._queue.remove(ticket)
+                # The next call might fit now, or be first in the queue
+                self._condition.notify_all()
+            waited = _clock() - start
+            self._admit(size, waited)
+        return waited
+
+    def _admit(self, size, waited):
+        self._in_use += size
+        self._running += 1
+        self._admitted += 1
+        self._wait_total += waited
+        self._wait_max = max(self._wait_max, waited)
+        observer = instrument.observer
+        if observer is not None:
+            observer('queue', waited, {
+                'bytes': size, 'queued': len(self._queue)
+            })
+
+    def release(self, size):
+        """Give back size bytes taken by acquire"""
+        with self._condition:
+            self._in_use -= size
+            self._running -= 1
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def reserve(self, size, timeout=None):
+        """acquire(size, timeout) for the duration of a with block"""
+        self.acquire(size, timeout)
+        try:
+            yield
+        finally:
+            self.release(size)
+
+    def stats(self):
+        """
+        {"budget", "in_use" (bytes), "running", "queued", "max_queued",
+        "admitted", "rejected", "timed_out", "wait_total", "wait_mean",
+        "wait_max" (seconds)}
+        """
+        with self._condition:
+            return {
+                'budget': self.budget, 'in_use': self._in_use,
+                'running': self._running, 'queued': len(self._queue),
+                'max_queued': self._max_queued, 'admitted': self._admitted,
+                'rejected': self._rejected, 'timed_out': self._timed_out,
+                'wait_total': self._wait_total,
+                'wait_mean': self._wait_total / max(self._admitted, 1),
+                'wait_max': self._wait_max
+            }
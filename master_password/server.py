@@ -0,0 +1,467 @@
+#!/usr/bin/env python
+
+"""
+An HTTP/1.1 JSON service that keeps many users unlocked at once
+
+Unlocked MPW objects are sharded over worker processes by a hash of each
+user's salt (MPW.calculate_salt), so keys are calculated in parallel and
+every request for a user goes to the process that already has its key.
+Connections are kept alive, so clients can send many requests on one.
+
+Requests are POSTed to /<op> (Or to / with "op" in the body) with a JSON
+object body, and are the same as the requests of master_password.daemon:
+
+POST /unlock    {"full_name": ..., "master_password": ...}
+POST /password  {"full_name": ..., "site": ..., "counter": 1}
+POST /generate  {"full_name": ..., "site": ..., "variant": "login"}
+POST /lock      {"full_name": ...}
+GET  /ping
+
+Responses are {"ok": true, "result": ...} with status 200, or
+{"ok": false, "error": ...} with status 423 if the user needs to be
+unlocked first, 401 without the right token, 503 if the user's worker
+stopped or didn't respond within the timeout, or 400 otherwise. A worker
+that stopped is started again on the next request, and its users need to
+be unlocked again.
+
+Master passwords are sent in plain text, so only listen on localhost (The
+default), and set a token so other users on the machine can't use the
+service. Requests must then have the header "Authorization: Bearer <token>".
+
+USAGE:
+
+$ python -m master_password.server --port 8080 --workers 4 --token secret
+$ python -m master_password.server --load-test 1,2,4
+"""
+
+import sys
+import hmac
+import json
+import time
+import hashlib
+import argparse
+import threading
+import itertools
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from http.client import HTTPConnection
+    import socketserver
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from httplib import HTTPConnection
+    import SocketServer as socketserver
+
+from master_password import MPW
+from master_password.helpers import encode_if
+from master_password.daemon import KeyRing, dispatch, DEFAULT_IDLE_TIMEOUT
+
+__all__ = ('Server', 'Client', 'shard_of', 'serve', 'load_test', 'main')
+
+DEFAULT_PORT = 8437
+# Seconds to wait for a worker to respond
+DEFAULT_TIMEOUT = 120
+
+_STATUS = {'locked': 423, 'unauthorized': 401, 'unavailable': 503}
+
+
+def shard_of(full_name, namespace=None, shards=1):
+    """The index of the shard that the user belongs to"""
+    salt = MPW.calculate_salt(
+        encode_if(full_name), KeyRing.user(full_name, namespace)[1]
+    )
+    digest = bytearray(hashlib.sha256(salt).digest()[:8])
+    n = 0
+    for byte in digest:
+        n = (n << 8) | byte
+    return n % shards
+
+
+def _shard_main(conn, idle_timeout, verifier):
+    """Run requests from conn in a worker process until it sends None"""
+    ring = KeyRing(idle_timeout, verifier)
+    expire_every = min(idle_timeout, 60)
+    next_expire = time.time() + expire_every
+    while True:
+        if not conn.poll(max(0, next_expire - time.time())):
+            ring.expire()
+            next_expire = time.time() + expire_every
+            continue
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        request_id, request = message
+        conn.send((request_id, dispatch(ring, request)))
+    ring.lock()
+    conn.close()
+
+
+class _Shard(object):
+    """A worker process, and the requests waiting for it to respond"""
+
+    def __init__(self, idle_timeout, verifier, timeout=DEFAULT_TIMEOUT):
+        import multiprocessing
+        self.timeout = timeout
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_shard_main, args=(child, idle_timeout, verifier)
+        )
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self._send_lock = threading.Lock()
+        self._ids = itertools.count()
+        # request id -> [threading.Event, response]
+        self._pending = {}
+        self._reader = threading.Thread(target=self._read_forever)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _read_forever(self):
+        while True:
+            try:
+                request_id, response = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            waiting = self._pending.pop(request_id, None)
+            if waiting is not None:
+                waiting[1] = response
+                waiting[0].set()
+        for waiting in list(self._pending.values()):
+            waiting[0].set()
+
+    def request(self, request):
+        waiting = [threading.Event(), None]
+        with self._send_lock:
+            request_id = next(self._ids)
+            self._pending[request_id] = waiting
+            try:
+                self.conn.send((request_id, request))
+            except (EOFError, OSError, ValueError):
+                waiting[0].set()
+        waiting[0].wait(self.timeout)
+        if waiting[1] is None:
+            # The worker stopped, or didn't respond in time
+            self._pending.pop(request_id, None)
+            return {'ok': False, 'error': 'unavailable'}
+        return waiting[1]
+
+    def close(self):
+        with self._send_lock:
+            try:
+                self.conn.send(None)
+            except (OSError, ValueError):
+                pass
+        self.process.join()
+        self.conn.close()
+        self._reader.join()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # The headers and body are written separately, and Nagle's algorithm
+    # would hold back the body until the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _respond(self, response):
+        if response['ok']:
+            status = 200
+        else:
+            status = _STATUS.get(response['error'], 400)
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self):
+        token = self.server.token
+        if token is None:
+            return True
+        given = self.headers.get('Authorization', '')
+        return hmac.compare_digest(
+            given.encode('utf-8'), b'Bearer ' + token.encode('utf-8')
+        )
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/ping':
+            self._respond({'ok': True, 'result': 'pong'})
+        else:
+            self._respond({'ok': False, 'error': 'Unknown path'})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            if length < 0:
+                raise ValueError('must not be negative')
+        except ValueError as e:
+            # The body can't be found, so neither can the next request
+            self.close_connection = True
+            self._respond({
+                'ok': False, 'error': 'Invalid Content-Length: {}'.format(e)
+            })
+            return
+        body = self.rfile.read(length)
+        if not self._authorized():
+            self._respond({'ok': False, 'error': 'unauthorized'})
+            return
+        try:
+            request = json.loads(body.decode('utf-8')) if body else {}
+            if not isinstance(request, dict):
+                raise ValueError('Request must be an object')
+        except ValueError as e:
+            self._respond({
+                'ok': False, 'error': 'Invalid JSON: {}'.format(e)
+            })
+            return
+        op = self.path.strip('/')
+        if op:
+            request['op'] = op
+        self._respond(self.server.route(request))
+
+
+class Server(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    Listens on (host, port) (A free port if port is 0) with a shard for
+    each of workers processes, waiting at most timeout seconds (Forever if
+    None) for each response
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, workers=None,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, verifier=None,
+                 token=None, verbose=False, timeout=DEFAULT_TIMEOUT):
+        if workers is None:
+            import multiprocessing
+            workers = multiprocessing.cpu_count()
+        if workers < 1:
+            raise ValueError('There must be at least 1 worker')
+        self.token = token
+        self.verbose = verbose
+        self.idle_timeout = idle_timeout
+        self.verifier = verifier
+        self.timeout = timeout
+        self._shards_lock = threading.Lock()
+        self.shards = [
+            _Shard(idle_timeout, verifier, timeout) for _ in range(workers)
+        ]
+        try:
+            HTTPServer.__init__(self, (host, port), _Handler)
+        except BaseException:
+            self.close_shards()
+            raise
+
+    def route(self, request):
+        """Send a request (A dict) to the shard of its user"""
+        if request.get('op') == 'ping':
+            return {'ok': True, 'result': 'pong'}
+        try:
+            index = shard_of(
+                request['full_name'], request.get('namespace'),
+                len(self.shards)
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            return {'ok': False, 'error': '{}: {}'.format(
+                type(e).__name__, e
+            )}
+        shard = self.shards[index]
+        if not shard.process.is_alive():
+            shard = self._restart(index, shard)
+        return shard.request(request)
+
+    def _restart(self, index, shard):
+        """Replace a shard whose process stopped, returning the new one"""
+        with self._shards_lock:
+            if self.shards[index] is shard:
+                self.shards[index] = _Shard(
+                    self.idle_timeout, self.verifier, self.timeout
+                )
+                shard.close()
+            return self.shards[index]
+
+    def close_shards(self):
+        for shard in self.shards:
+            shard.close()
+        self.shards = []
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.close_shards()
+
+
+class Client(object):
+    """A keep-alive connection to a Server"""
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, token=None,
+                 timeout=None):
+        self.connection = HTTPConnection(host, port, timeout=timeout)
+        self.headers = {'Content-Type': 'application/json'}
+        if token is not None:
+            self.headers['Authorization'] = 'Bearer ' + token
+
+    def request(self, op, **kwargs):
+        """Send a request, returning the response as a dict"""
+        self.connection.request(
+            'POST', '/' + op, json.dumps(kwargs).encode('utf-8'),
+            self.headers
+        )
+        return json.loads(self.connection.getresponse().read().decode(
+            'utf-8'
+        ))
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def serve(host='127.0.0.1', port=DEFAULT_PORT, workers=None,
+          idle_timeout=DEFAULT_IDLE_TIMEOUT, verifier=None, token=None,
+          verbose=False, timeout=DEFAULT_TIMEOUT):
+    server = Server(
+        host, port, workers, idle_timeout, verifier, token, verbose, timeout
+    )
+    sys.stderr.write('Listening on http://{}:{} with {} workers\n'.format(
+        host, server.server_address[1], len(server.shards)
+    ))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def load_test(workers=(1, 2, 4), users=8, clients=8, requests=500):
+    """
+    Start a local Server with each number of workers, unlock users users
+    and send requests password requests from each of clients threads.
+
+    Returns [{"workers": n, "unlock": seconds, "seconds": seconds,
+    "requests_per_second": rate}] (unlock is the time to unlock every user
+    at once).
+    """
+    names = ['Load Test User {}'.format(i) for i in range(users)]
+    results = []
+    for count in workers:
+        server = Server(port=0, workers=count)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        port = server.server_address[1]
+        try:
+            def unlock(name):
+                with Client(port=port) as client:
+                    client.request(
+                        'unlock', full_name=name, master_password='password'
+                    )
+
+            def run(index, errors):
+                with Client(port=port) as client:
+                    for i in range(requests):
+                        response = client.request(
+                            'password', full_name=names[(index + i) % users],
+                            site='site{}.example'.format(i)
+                        )
+                        if not response['ok']:
+                            errors.append(response['error'])
+
+            start = time.time()
+            _run_threads([(unlock, (name,)) for name in names])
+            unlocked = time.time() - start
+            errors = []
+            start = time.time()
+            _run_threads([(run, (i, errors)) for i in range(clients)])
+            seconds = time.time() - start
+            if errors:
+                raise RuntimeError(errors[0])
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+        results.append({
+            'workers': count, 'unlock': unlocked, 'seconds': seconds,
+            'requests_per_second': clients * requests / seconds
+        })
+    return results
+
+
+def _run_threads(calls):
+    threads = [threading.Thread(target=f, args=args) for f, args in calls]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description='Serve Master Password over HTTP to many users',
+        prog='master_password.server'
+    )
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='The address to listen on (Default 127.0.0.1)')
+    parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT,
+                        help='The port to listen on (Default {})'.format(
+                            DEFAULT_PORT
+                        ))
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='The number of worker processes (Default the '
+                             'number of CPUs)')
+    parser.add_argument('-i', '--idle', type=float,
+                        default=DEFAULT_IDLE_TIMEOUT,
+                        help='Forget keys after they are unused for this '
+                             'many seconds')
+    parser.add_argument('--verifier', default=None,
+                        help='A key verifier file to check master passwords')
+    parser.add_argument('-t', '--timeout', type=float,
+                        default=DEFAULT_TIMEOUT,
+                        help='Seconds to wait for a worker to respond '
+                             '(Default {})'.format(DEFAULT_TIMEOUT))
+    parser.add_argument('--token', default=None,
+                        help='Require "Authorization: Bearer TOKEN"')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Log every request')
+    parser.add_argument('--load-test', default=None, metavar='WORKERS',
+                        help='Instead of serving, measure the throughput '
+                             'with each number of workers, e.g. 1,2,4')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='Requests per client in the load test')
+    parser.add_argument('--clients', type=int, default=8,
+                        help='Concurrent clients in the load test')
+    args = parser.parse_args(argv)
+
+    if args.load_test is not None:
+        workers = [int(n) for n in args.load_test.split(',')]
+        print('{:>7}  {:>10}  {:>12}'.format(
+            'workers', 'unlock (s)', 'requests/s'
+        ))
+        for result in load_test(workers, clients=args.clients,
+                                requests=args.requests):
+            print('{:>7}  {:>10.3f}  {:>12.1f}'.format(
+                result['workers'], result['unlock'],
+                result['requests_per_second']
+            ))
+        return
+    verifier = None
+    if args.verifier is not None:
+        from master_password.verifier import VerifierStore
+        verifier = VerifierStore(args.verifier)
+    serve(args.host, args.port, args.workers, args.idle, verifier,
+          args.token, args.verbose, args.timeout)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,8 +1,26 @@
+import io
 import os
+import json
+import hashlib
 import sys
+import socket
+import shutil
+import signal
+import subprocess
+import tempfile
+import time
 import unittest
+import threading
 
-__all__ = ('MPWTest',)
+__all__ = ('MPWTest', 'BulkTest', 'KeyCacheTest',
+           'AsyncMPWTest', 'BenchTest',
+           'ScryptRegistryTest', 'DaemonTest',
+           'BatchTest',
+           'ImportTimeTest', 'CompactMPWTest',
+           'VectorizedTest', 'VerifierTest',
+           'SiteStoreTest', 'MemoTest', 'InstrumentTest',
+           'KDFProfileTest', 'ParallelScryptTest', 'ServerTest',
+           'SchedulerTest', 'LoadTestTest')
 
 __dir__ = os.path.dirname(os.path.abspath(__file__))
 
@@ -10,6 +28,32 @@ sys.path.insert(0, os.path.abspath(os.path.join(__dir__, os.pardir)))
 
 try:
     from master_password import *
+    from master_password.datatypes import DEFAULT_TEMPLATES
+    from master_password.bulk import derive_keys, max_workers
+    from master_password.keycache import KeyCache
+    from master_password import bench
+    from master_password import _get_scrypt
+    from master_password import _scrypt
+    from master_password.daemon import Daemon, Client, KeyRing
+    from master_password.__main__ import _batch
+    from master_password.compact import CompactMPW
+    from master_password.verifier import VerifierStore, key_id
+    from master_password.mpsites import SiteStore, SiteReader, SITE
+    from master_password.memo import Memo
+    from master_password import instrument
+    from master_password.calibrate import calibrate, parse_size
+    from master_password import server
+    from master_password.scheduler import DerivationScheduler
+    from master_password import loadtest
+    try:
+        from master_password import vectorized
+    except ImportError:
+        vectorized = None
+    try:
+        import asyncio
+        from master_password.aio import AsyncMPW
+    except (ImportError, SyntaxError):
+        asyncio = AsyncMPW = None
 finally:
     sys.path.pop(0)
 
@@ -97,6 +141,1215 @@ class MPWTest(unittest.TestCase):
             'Incorrect password generated! (With context; Version 0)'
         )
 
+    def test_generate_many(self):
+        mpw = MPW.from_key(self.expected_key, self.full_name, self.namespace)
+        sites = [self.site, 'example.org', u'\xe9xample.net']
+        self.assertEqual(
+            list(mpw.seed_many(sites, self.namespace, self.counter)),
+            [mpw.seed(site, self.namespace, self.counter) for site in sites],
+            'Incorrect seeds calculated! (Batch)'
+        )
+        for version in (0, 3):
+            mpw = MPW.from_key(
+                self.expected_key, self.full_name, self.namespace, version
+            )
+            self.assertEqual(
+                list(mpw.generate_many(sites, self.counter, self.context,
+                                       self.template, self.namespace, True)),
+                [mpw.generate(site, self.counter, self.context,
+                              self.template, self.namespace, True)
+                 for site in sites],
+                'Incorrect passwords generated! (Batch)'
+            )
+
+    def test_namespace_scopes(self):
+        mpw = MPW.from_key(self.expected_key, self.full_name)
+        namespace = MPW_DEFAULT_NAMESPACE
+        for scope in ('login', b'login', namespace.login,
+                      namespace.login.decode('utf-8')):
+            self.assertEqual(namespace.scope(scope), namespace.login)
+            self.assertEqual(
+                mpw.generate(self.site, namespace=scope, template='name'),
+                mpw.login(self.site)
+            )
+        self.assertIsNone(namespace.scope('other'))
+        self.assertIsNone(namespace.scope([]))
+        self.assertEqual(
+            mpw.seed(self.site, b'other'), mpw.seed(self.site, 'other')
+        )
+
+    def test_sweep(self):
+        mpw = MPW.from_key(self.expected_key, self.full_name, self.namespace)
+        counters = [1, 2, self.counter]
+        contexts = [None, '', self.context, u'\xe9']
+        self.assertEqual(
+            list(mpw.generate_sweep(self.site, counters, contexts,
+                                    self.template, self.namespace)),
+            [(counter, context, mpw.generate(
+                self.site, counter, context, self.template, self.namespace
+            )) for counter in counters for context in contexts],
+            'Incorrect passwords generated! (Sweep)'
+        )
+        self.assertEqual(
+            list(mpw.seed_sweep(self.site, [self.counter])),
+            [(self.counter, None, mpw.seed(self.site, counter=self.counter))]
+        )
+
+    def test_template_changes(self):
+        mpw = MPW.from_key(self.expected_key, self.full_name, self.namespace)
+        try:
+            self.assertEqual(mpw.generate(self.site, template='nnnn'), '8066')
+            MPWTemplate.char('n', '01')
+            self.assertEqual(mpw.generate(self.site, template='nnnn'), '0000')
+            MPWTemplate.create('nnnn', 'aaaa')
+            self.assertEqual(mpw.generate(self.site, template='nnnn'), 'LXLB')
+        finally:
+            MPWTemplate.reset()
+        self.assertEqual(mpw.generate(self.site, template='nnnn'), '8066')
+
+
+class BulkTest(unittest.TestCase):
+    def test_derive_keys(self):
+        pairs = [(MPWTest.full_name, MPWTest.password), ('other', 'secret')]
+        mpws = derive_keys(pairs, workers=2)
+        self.assertEqual(len(mpws), 2)
+        self.assertEqual(mpws[0].key, MPWTest.expected_key,
+                         'Incorrect key calculated! (Bulk)')
+        self.assertEqual(mpws[0].full_name, MPWTest.full_name)
+        self.assertEqual(mpws[1], MPW('other', 'secret'))
+
+    def test_scheduler_in_workers(self):
+        namespace = MPWNameSpace.create(
+            'master_password.tests.bulk', kdf=KDFProfile(16, 1, 1)
+        )
+        scheduler = DerivationScheduler(budget=1)
+        # The workers are forked while the budget is used up
+        scheduler.acquire(1)
+        MPW.scheduler = scheduler
+        try:
+            mpws = derive_keys([('a', 'b'), ('c', 'd')], 2, namespace)
+        finally:
+            MPW.scheduler = None
+        self.assertEqual(mpws[0].key, MPW.calculate_key(
+            'b', MPW.calculate_salt(b'a', namespace), namespace.kdf
+        ))
+
+    def test_max_workers(self):
+        self.assertEqual(max_workers(8, maxmem=0), 1)
+        self.assertEqual(max_workers(8, maxmem=3 * 2 ** 25), 2)
+        self.assertEqual(max_workers(2, maxmem=2 ** 40), 2)
+
+
+class KeyCacheTest(unittest.TestCase):
+    salt = MPW.calculate_salt(MPWTest.full_name, MPWTest.namespace)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = KeyCache(self.directory, ttl=60, max_entries=2)
+
+    def tearDown(self):
+        MPW.key_cache = None
+        shutil.rmtree(self.directory)
+
+    def test_expired_pruned_on_miss(self):
+        self.cache.put(self.salt, MPWTest.password, MPWTest.expected_key)
+        expired = KeyCache(self.directory, ttl=0)
+        self.assertIsNone(expired.get(self.salt, 'other password'))
+        self.assertEqual(self.cache._load(), {})
+
+    def test_malformed_entries(self):
+        self.cache.put(self.salt, MPWTest.password, MPWTest.expected_key)
+        id_ = self.cache._id(
+            self.cache._secret(), self.salt, MPWTest.password
+        )
+        for entry in ([1, 2], {'created': time.time(), 'key': 'AA=='}):
+            with open(self.cache.path, 'w') as f:
+                json.dump({id_: entry, 'other': {'created': 'now'}}, f)
+            self.assertIsNone(self.cache.get(self.salt, MPWTest.password))
+            self.assertEqual(self.cache._read(), {})
+        with open(self.cache.path, 'w') as f:
+            json.dump({id_: {'used': 1}}, f)
+        MPW.key_cache = self.cache
+        # Calculated again, and cached again
+        mpw = MPW(MPWTest.full_name, MPWTest.password, MPWTest.namespace)
+        self.assertEqual(mpw.key, MPWTest.expected_key)
+        self.assertEqual(self.cache.get(self.salt, MPWTest.password),
+                         MPWTest.expected_key)
+
+    def test_runtime_directory_needed(self):
+        runtime = os.environ.pop('XDG_RUNTIME_DIR', None)
+        try:
+            self.assertRaises(ValueError, KeyCache)
+            os.environ['XDG_RUNTIME_DIR'] = self.directory
+            self.assertEqual(
+                KeyCache().directory,
+                os.path.join(self.directory, 'master_password')
+            )
+        finally:
+            if runtime is None:
+                os.environ.pop('XDG_RUNTIME_DIR', None)
+            else:
+                os.environ['XDG_RUNTIME_DIR'] = runtime
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get(self.salt, MPWTest.password))
+        self.cache.put(self.salt, MPWTest.password, MPWTest.expected_key)
+        self.assertEqual(self.cache.get(self.salt, MPWTest.password),
+                         MPWTest.expected_key)
+        self.assertIsNone(self.cache.get(self.salt, 'wrong password'))
+        with open(self.cache.path, 'rb') as f:
+            self.assertNotIn(bytes(MPWTest.expected_key), f.read())
+
+    def test_ttl_and_lru(self):
+        for password in ('a', 'b', 'c'):
+            self.cache.put(self.salt, password, MPWTest.expected_key)
+        self.assertIsNone(self.cache.get(self.salt, 'a'))
+        self.assertIsNotNone(self.cache.get(self.salt, 'c'))
+        self.cache.ttl = 0
+        self.assertIsNone(self.cache.get(self.salt, 'c'))
+
+    def test_mpw_uses_cache(self):
+        MPW.key_cache = self.cache
+        key = bytearray(range(64))
+        self.cache.put(self.salt, MPWTest.password, key)
+        mpw = MPW(MPWTest.full_name, MPWTest.password, MPWTest.namespace)
+        self.assertEqual(mpw.key, key)
+        mpw = MPW(MPWTest.full_name, 'other', MPWTest.namespace)
+        self.assertEqual(self.cache.get(self.salt, 'other'), mpw.key)
+
+
+@unittest.skipIf(AsyncMPW is None, 'asyncio is not available')
+class AsyncMPWTest(unittest.TestCase):
+    def test_create_coalesces(self):
+        calculate_key = MPW.__dict__['calculate_key']
+        calls = []
+
+        def counting_calculate_key(master_password, salt, profile=None):
+            calls.append(salt)
+            return calculate_key.__func__(master_password, salt, profile)
+
+        MPW.calculate_key = staticmethod(counting_calculate_key)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            mpws = loop.run_until_complete(asyncio.gather(*[
+                AsyncMPW.create(MPWTest.full_name, MPWTest.password)
+                for _ in range(3)
+            ]))
+            password = loop.run_until_complete(mpws[0].generate(
+                MPWTest.site, MPWTest.counter, None, MPWTest.template,
+                MPWTest.namespace, True
+            ))
+        finally:
+            MPW.calculate_key = calculate_key
+            asyncio.set_event_loop(None)
+            loop.close()
+        self.assertEqual(len(calls), 1)
+        for mpw in mpws:
+            self.assertEqual(mpw.key, MPWTest.expected_key)
+        self.assertEqual(password, MPWTest.expected_password)
+
+
+class BenchTest(unittest.TestCase):
+    def test_run(self):
+        results = bench.run(number=1, repeat=1, scrypt_N=16, scrypt_repeat=1)
+        self.assertIn(
+            'scrypt.' + results['implementation'], results['results']
+        )
+        for name in ('seed', 'generate.v0.long', 'generate.v3.pin',
+                     'generate.v3.extended', 'generate_many', 'identicon'):
+            self.assertGreater(results['results'][name]['best'], 0)
+
+
+class ScryptRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.implementation = _get_scrypt.implementation()
+
+    def tearDown(self):
+        _get_scrypt.unregister('test')
+        _get_scrypt.unregister('missing')
+        _get_scrypt.use(self.implementation)
+
+    def test_use(self):
+        def loader():
+            def scrypt(password, salt, N, r, p, dk_len):
+                return b'\0' * dk_len
+            return scrypt
+
+        def missing():
+            raise ImportError('missing')
+
+        _get_scrypt.register('test', loader)
+        _get_scrypt.register('missing', missing)
+        self.assertIn('test', _get_scrypt.available())
+        self.assertNotIn('missing', _get_scrypt.available())
+        self.assertRaises(ImportError, _get_scrypt.use, 'missing')
+        self.assertRaises(ValueError, _get_scrypt.use, 'unknown')
+        _get_scrypt.use('test')
+        self.assertEqual(_get_scrypt._IMPLEMENTATION, 'test')
+        self.assertEqual(MPW.calculate_key('', b''), bytearray(64))
+
+    def test_autotune(self):
+        _get_scrypt.register('test', lambda: _get_scrypt.get('hashlib'),
+                             slow=True)
+        name = _get_scrypt.autotune(N=16, repeat=1)
+        self.assertNotEqual(name, 'test')
+        self.assertEqual(_get_scrypt._IMPLEMENTATION, name)
+
+
+@unittest.skipIf(not hasattr(socket, 'AF_UNIX'), 'Unix sockets are needed')
+class DaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.daemon = Daemon(os.path.join(self.directory, 'daemon.sock'))
+        self.daemon.ring.add(MPW.from_key(
+            MPWTest.expected_key, MPWTest.full_name, MPWTest.namespace
+        ))
+        self.thread = threading.Thread(target=self.daemon.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.daemon.shutdown()
+        self.thread.join()
+        self.daemon.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_requests(self):
+        self.assertEqual(os.stat(self.daemon.path).st_mode & 0o077, 0)
+        with Client(self.daemon.path) as client:
+            response = client.request(
+                'generate', full_name=MPWTest.full_name, site=MPWTest.site,
+                context=MPWTest.context, extended=True
+            )
+            self.assertEqual(response, {
+                'ok': True, 'result': MPWTest.expected_password_w_context
+            })
+            response = client.request(
+                'pin', full_name=MPWTest.full_name, site=MPWTest.site
+            )
+            self.assertEqual(response, {'ok': True, 'result': '8066'})
+            response = client.request('lock', full_name=MPWTest.full_name)
+            self.assertTrue(response['ok'])
+            response = client.request(
+                'pin', full_name=MPWTest.full_name, site=MPWTest.site
+            )
+            self.assertEqual(response, {'ok': False, 'error': 'locked'})
+
+    def test_variant_namespace(self):
+        namespace = MPWNameSpace.create('master_password.tests.daemon')
+        mpw = MPW.from_key(MPWTest.expected_key, MPWTest.full_name, namespace)
+        self.daemon.ring.add(mpw)
+        with Client(self.daemon.path) as client:
+            for variant, expected in (
+                    ('login', mpw.login(MPWTest.site)),
+                    ('answer', mpw.answer(MPWTest.site, context=None))
+            ):
+                response = client.request(
+                    'generate', full_name=MPWTest.full_name,
+                    namespace=namespace.name.decode(), site=MPWTest.site,
+                    variant=variant
+                )
+                self.assertEqual(response, {'ok': True, 'result': expected})
+            self.assertNotEqual(
+                mpw.login(MPWTest.site), mpw.password(MPWTest.site)
+            )
+
+    def test_socket_path(self):
+        path = os.path.join(self.directory, 'notes.txt')
+        with open(path, 'w') as f:
+            f.write('notes')
+        self.assertRaises(ValueError, Daemon, path)
+        self.assertTrue(os.path.exists(path))
+        # The running daemon's socket
+        self.assertRaises(ValueError, Daemon, self.daemon.path)
+        stale = os.path.join(self.directory, 'stale.sock')
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(stale)
+        listener.close()
+        Daemon(stale).server_close()
+
+    def test_no_daemon(self):
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'master_password', '-u', 'name',
+             '-P', 'password', '-i', '--socket', '--socket-path',
+             os.path.join(self.directory, 'missing.sock'), 'example.org'],
+            cwd=os.path.join(__dir__, os.pardir),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        stdout, stderr = process.communicate()
+        self.assertEqual(process.returncode, 0, stderr)
+        self.assertIn(b'Could not use the daemon', stderr)
+        self.assertIn(
+            MPW('name', 'password').password('example.org').encode(), stdout
+        )
+
+    def test_idle_timeout(self):
+        ring = KeyRing(idle_timeout=0)
+        user = ring.add(MPW.from_key(MPWTest.expected_key, 'name'))
+        self.assertIsNone(ring.get(user))
+
+
+class BatchTest(unittest.TestCase):
+    def test_batch(self):
+        mpw = MPW.from_key(MPWTest.expected_key, MPWTest.full_name)
+        lines = [
+            u'example.com\n', u'\n', u'# Comment\n', u'example.com,1,pin\n',
+            u'{"site": "example.com", "variant": "login"}\n'
+        ]
+        out = io.StringIO() if str is not bytes else io.BytesIO()
+        _batch(mpw, lines, out, {
+            'counter': 1, 'template': None, 'variant': 'password',
+            'context': None
+        })
+        self.assertEqual(out.getvalue().splitlines(), [
+            'example.com,' + mpw.password('example.com'),
+            'example.com,8066',
+            '{"site": "example.com", "variant": "login", "result": "' +
+            mpw.login('example.com') + '"}'
+        ])
+
+    def test_bad_lines(self):
+        mpw = MPW.from_key(MPWTest.expected_key, MPWTest.full_name)
+        lines = [
+            u'{"site": \n', u',1\n', u'example.com,one\n',
+            u'example.com,1,pin,nope\n', u'example.com,1,pin\n'
+        ]
+        out = io.StringIO() if str is not bytes else io.BytesIO()
+        stderr = sys.stderr
+        sys.stderr = io.StringIO() if str is not bytes else io.BytesIO()
+        try:
+            errors = _batch(mpw, lines, out, {
+                'counter': 1, 'template': None, 'variant': 'password',
+                'context': None
+            })
+            messages = sys.stderr.getvalue().splitlines()
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(errors, 4)
+        self.assertEqual(
+            [message.split(':')[0] for message in messages],
+            ['line 1', 'line 2', 'line 3', 'line 4']
+        )
+        self.assertEqual(out.getvalue().splitlines(), ['example.com,8066'])
+
+
+@unittest.skipIf(sys.version_info < (3, 7), '-X importtime is needed')
+class ImportTimeTest(unittest.TestCase):
+    # Slow to import, so should only be imported when they are used
+    lazy = ('hmac', 'hashlib', '_hashlib', 'cryptography', 'scrypt',
+            'pyscrypt', 'warnings', 'getpass')
+    # argparse imports warnings itself
+    lazy_main = tuple(module for module in lazy if module != 'warnings')
+
+    def imported(self, module):
+        stderr = subprocess.Popen(
+            [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+            cwd=os.path.join(__dir__, os.pardir), stderr=subprocess.PIPE
+        ).communicate()[1].decode('utf-8')
+        modules = {}
+        for line in stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                modules[line.rsplit('|', 1)[1].strip()] = line
+        return modules
+
+    def test_import_master_password(self):
+        modules = self.imported('master_password')
+        self.assertIn('master_password', modules)
+        for module in self.lazy:
+            self.assertNotIn(module, modules)
+
+    def test_import_main(self):
+        modules = self.imported('master_password.__main__')
+        self.assertIn('master_password.__main__', modules)
+        for module in self.lazy_main:
+            self.assertNotIn(module, modules)
+
+
+class CompactMPWTest(unittest.TestCase):
+    def test_generation(self):
+        mpw = MPW.from_key(MPWTest.expected_key, MPWTest.full_name)
+        compact = CompactMPW.from_key(
+            MPWTest.expected_key, MPWTest.full_name, lock=True
+        )
+        self.assertEqual(compact, mpw)
+        self.assertEqual(mpw, compact)
+        self.assertEqual(compact.to_mpw(), mpw)
+        self.assertEqual(
+            compact.generate(MPWTest.site, MPWTest.counter, MPWTest.context,
+                             MPWTest.template, MPWTest.namespace, True),
+            MPWTest.expected_password_w_context
+        )
+        sites = [MPWTest.site, 'example.org']
+        self.assertEqual(list(compact.generate_many(sites)),
+                         list(mpw.generate_many(sites)))
+        self.assertEqual(list(compact.generate_sweep(sites[0], [1, 2])),
+                         list(mpw.generate_sweep(sites[0], [1, 2])))
+        self.assertNotIn(repr(bytes(MPWTest.expected_key)), repr(compact))
+        self.assertNotIn(repr(bytes(MPWTest.expected_key)), str(compact))
+
+    def test_wipe(self):
+        compact = CompactMPW.from_key(MPWTest.expected_key)
+        compact.wipe()
+        self.assertEqual(compact.key, bytes(bytearray(64)))
+        self.assertRaises(TypeError, lambda: compact[0])
+
+    @staticmethod
+    def locked_kb():
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmLck:'):
+                    return int(line.split()[1])
+
+    @unittest.skipUnless(os.path.exists('/proc/self/status'),
+                         '/proc/self/status is needed')
+    def test_munlock(self):
+        before = self.locked_kb()
+        compacts = [
+            CompactMPW.from_key(MPWTest.expected_key, lock=True)
+            for _ in range(100)
+        ]
+        if not all(compact.locked for compact in compacts):
+            self.skipTest('mlock is not allowed')
+        self.assertGreater(self.locked_kb(), before)
+        for compact in compacts:
+            compact.wipe()
+            self.assertFalse(compact.locked)
+        del compacts
+        self.assertEqual(self.locked_kb(), before)
+        self.assertFalse(CompactMPW.from_key(MPWTest.expected_key).locked)
+
+
+@unittest.skipIf(vectorized is None, 'numpy is not available')
+class VectorizedTest(unittest.TestCase):
+    sites = [MPWTest.site] + ['{}.example.org'.format(i) for i in range(200)]
+
+    def test_render(self):
+        for version in (0, 3):
+            mpw = MPW.from_key(
+                MPWTest.expected_key, MPWTest.full_name, version=version
+            )
+            seeds = vectorized.seed_array(mpw, self.sites)
+            self.assertEqual(seeds.shape, (len(self.sites), 32))
+            for template in DEFAULT_TEMPLATES:
+                for extended in (False, True):
+                    expected = list(mpw.generate_many(
+                        self.sites, template=template, extended=extended
+                    ))
+                    self.assertEqual(
+                        vectorized.render(seeds, template, version, extended),
+                        expected, 'Incorrect passwords rendered! '
+                        '({}, {}, {})'.format(version, template, extended)
+                    )
+
+    def test_generate_many(self):
+        mpw = MPW.from_key(MPWTest.expected_key, MPWTest.full_name)
+        self.assertEqual(
+            vectorized.generate_many(
+                mpw, self.sites, MPWTest.counter, MPWTest.context,
+                MPWTest.template, MPWTest.namespace, True
+            )[0], MPWTest.expected_password_w_context
+        )
+
+
+class VerifierTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.verifier = VerifierStore(
+            os.path.join(self.directory, 'verifier.json')
+        )
+        # Keys for the right and wrong password, so scrypt isn't needed
+        MPW.key_cache = KeyCache(self.directory)
+        salt = MPW.calculate_salt(MPWTest.full_name, MPWTest.namespace)
+        MPW.key_cache.put(salt, MPWTest.password, MPWTest.expected_key)
+        MPW.key_cache.put(salt, 'wrong', bytearray(64))
+
+    def tearDown(self):
+        MPW.key_cache = None
+        shutil.rmtree(self.directory)
+
+    def test_key_id(self):
+        self.assertEqual(
+            key_id(MPWTest.expected_key),
+            'CB0295C21BDD3C04DD6069D27F9DB1C21F8C3F4F859A115B9B6520468E5F1D06'
+        )
+
+    def test_unlock(self):
+        self.assertIsNone(self.verifier.get(MPWTest.full_name))
+        mpw = self.verifier.unlock(
+            MPWTest.full_name, MPWTest.password, MPWTest.namespace
+        )
+        self.assertEqual(mpw.key, MPWTest.expected_key)
+        self.assertTrue(self.verifier.check(mpw))
+        self.assertEqual(os.stat(self.verifier.path).st_mode & 0o077, 0)
+        with self.assertRaises(ValueError):
+            self.verifier.unlock(
+                MPWTest.full_name, 'wrong', MPWTest.namespace
+            )
+        self.assertFalse(self.verifier.check_key(
+            MPWTest.full_name, bytearray(64), MPWTest.namespace
+        ))
+        self.verifier.remove(MPWTest.full_name, MPWTest.namespace)
+        self.assertIsNone(self.verifier.check(mpw))
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'os.fork is needed')
+    def test_processes(self):
+        # Every process's users are kept, although they all write at once
+        pids = []
+        for i in range(8):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    verifier = VerifierStore(self.verifier.path)
+                    for j in range(5):
+                        verifier.enroll(MPW.from_key(
+                            bytearray([i * 5 + j]) * 64,
+                            'user {}'.format(i * 5 + j)
+                        ))
+                    status = 0
+                finally:
+                    os._exit(status)
+            pids.append(pid)
+        for pid in pids:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        for n in range(40):
+            self.assertEqual(
+                self.verifier.get('user {}'.format(n)),
+                key_id(bytearray([n]) * 64)
+            )
+
+    def test_wrong_key_not_cached(self):
+        calculated = []
+
+        class FakeScryptMPW(MPW):
+            @staticmethod
+            def calculate_key(master_password, salt, profile=None):
+                calculated.append(master_password)
+                if master_password == MPWTest.password:
+                    return bytearray(MPWTest.expected_key)
+                return bytearray(64)
+
+        salt = MPW.calculate_salt(MPWTest.full_name, MPWTest.namespace)
+        MPW.key_cache.clear()
+        self.verifier.enroll(
+            MPW.from_key(MPWTest.expected_key, MPWTest.full_name)
+        )
+        with self.assertRaises(ValueError):
+            self.verifier.unlock(
+                MPWTest.full_name, 'wrong', cls=FakeScryptMPW
+            )
+        self.assertIsNone(MPW.key_cache.get(salt, 'wrong'))
+        mpw = self.verifier.unlock(
+            MPWTest.full_name, MPWTest.password, cls=FakeScryptMPW
+        )
+        self.assertIsInstance(mpw, FakeScryptMPW)
+        self.assertEqual(calculated, ['wrong', MPWTest.password])
+        self.assertEqual(MPW.key_cache.get(salt, MPWTest.password),
+                         MPWTest.expected_key)
+
+    def test_key_ring(self):
+        ring = KeyRing(verifier=self.verifier)
+        ring.unlock(MPWTest.full_name, MPWTest.password)
+        with self.assertRaises(ValueError):
+            ring.unlock(MPWTest.full_name, 'wrong')
+
+
+class SiteStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'sites.mpsites')
+        self.mpw = MPW.from_key(MPWTest.expected_key, MPWTest.full_name)
+        self.other = MPW.from_key(bytearray(64), 'other')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_put_get_delete(self):
+        with SiteStore(self.path) as store:
+            store.add_user(self.mpw)
+            for i in range(10):
+                store.put(self.mpw, '{}.example.org'.format(i), counter=i)
+            store.put(self.other, '1.example.org', counter=100)
+            store.put(self.mpw, '1.example.org', counter=2, template='max')
+            self.assertTrue(store.delete(self.mpw, '2.example.org'))
+            self.assertFalse(store.delete(self.mpw, '2.example.org'))
+        with open(self.path, 'rb') as f:
+            self.assertNotIn(b'example.org', f.read())
+        with SiteStore(self.path) as store:
+            self.assertEqual(store.user(self.mpw), {
+                'full_name': MPWTest.full_name, 'version': 3
+            })
+            self.assertIsNone(store.user(self.other))
+            self.assertEqual(store.get(self.mpw, '1.example.org'), {
+                'site': '1.example.org', 'counter': 2, 'template': 'max'
+            })
+            self.assertEqual(
+                store.get(self.other, '1.example.org')['counter'], 100
+            )
+            self.assertIsNone(store.get(self.mpw, '2.example.org'))
+            self.assertEqual(len(list(store.sites(self.mpw))), 9)
+            size = os.path.getsize(self.path)
+            store.compact()
+            self.assertLess(os.path.getsize(self.path), size)
+            self.assertEqual(len(list(store.sites(self.mpw))), 9)
+            self.assertEqual(store.get(self.mpw, '3.example.org'), {
+                'site': '3.example.org', 'counter': 3
+            })
+
+    def test_interrupted_write(self):
+        with SiteStore(self.path) as store:
+            store.put(self.mpw, 'example.org')
+            size = os.path.getsize(self.path)
+            store.put(self.mpw, 'example.com')
+        with open(self.path, 'r+b') as f:
+            f.truncate(size + 10)
+        with SiteStore(self.path) as store:
+            self.assertEqual(os.path.getsize(self.path), size)
+            self.assertIsNone(store.get(self.mpw, 'example.com'))
+            store.put(self.mpw, 'example.com')
+        with SiteStore(self.path) as store:
+            self.assertEqual(len(list(store.sites(self.mpw))), 2)
+
+    def test_shared_file(self):
+        with SiteStore(self.path) as a, SiteStore(self.path) as b:
+            a.put(self.mpw, 'one.example')
+            b.put(self.mpw, 'two.example')
+            self.assertEqual(a.get(self.mpw, 'two.example'),
+                             {'site': 'two.example'})
+            a.compact()
+            b.put(self.mpw, 'three.example')
+            self.assertTrue(a.delete(self.mpw, 'one.example'))
+            self.assertEqual(len(list(b.sites(self.mpw))), 2)
+        with SiteStore(self.path) as store:
+            self.assertEqual(
+                [site['site'] for site in store.sites(self.mpw)],
+                ['two.example', 'three.example']
+            )
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'os.fork is needed')
+    def test_processes(self):
+        pids = []
+        for i in range(4):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    with SiteStore(self.path) as store:
+                        for j in range(10):
+                            store.put(
+                                self.mpw, '{}.example.org'.format(i * 10 + j)
+                            )
+                    status = 0
+                finally:
+                    os._exit(status)
+            pids.append(pid)
+        for pid in pids:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        with SiteStore(self.path) as store:
+            self.assertEqual(len(list(store.sites(self.mpw))), 40)
+
+    def test_reader(self):
+        with SiteStore(self.path) as store:
+            store.add_user(self.mpw)
+            for i in range(5):
+                store.put(self.mpw, '{}.example.org'.format(i), counter=i)
+            store.put(self.other, 'example.org')
+            store.put(self.mpw, '0.example.org', counter=10)
+            store.delete(self.mpw, '1.example.org')
+            expected = list(store.sites(self.mpw))
+        with SiteReader(self.path) as reader:
+            records = list(reader.records())
+            self.assertEqual(len(records), 9)
+            self.assertIsInstance(records[1].sealed, memoryview)
+            self.assertEqual(
+                sum(1 for record in records if record.type == SITE), 7
+            )
+            self.assertEqual(len(list(reader.users())), 1)
+            del records
+            self.assertEqual(list(reader.sites(self.mpw)), expected)
+            self.assertEqual(
+                reader.user(self.mpw)['full_name'], MPWTest.full_name
+            )
+            self.assertEqual(
+                [site['site'] for site in reader.sites(self.other)],
+                ['example.org']
+            )
+
+
+class MemoTest(unittest.TestCase):
+    def test_memo(self):
+        memo = Memo(maxsize=2, ttl=None)
+        seeds = [bytearray(b'a'), bytearray(b'b'), bytearray(b'c')]
+        memo.put(0, seeds[0])
+        # Only copies are kept and handed out, and they are wiped
+        cached = [memo._entries[0][0]]
+        self.assertIsNot(cached[0], seeds[0])
+        for i, seed in enumerate(seeds[1:], 1):
+            memo.put(i, seed)
+            cached.append(memo._entries[i][0])
+        self.assertEqual(cached[0], bytearray(1))
+        self.assertIsNone(memo.get(0))
+        seed = memo.get(1)
+        self.assertEqual(seed, b'b')
+        seed[:] = b'x'
+        self.assertEqual(memo.get(1), b'b')
+        memo.get([])
+        self.assertEqual((memo.hits, memo.misses), (2, 2))
+        memo.ttl = 0
+        memo.put(3, seeds[0])
+        self.assertIsNone(memo.get(3))
+        memo.clear()
+        self.assertEqual(cached, [bytearray(1)] * 3)
+        self.assertEqual(seeds, [b'a', b'b', b'c'])
+
+    def test_evicted_after_get(self):
+        class EvictingMemo(Memo):
+            # As if another thread put a seed as soon as get returned
+            def get(self, key):
+                value = Memo.get(self, key)
+                Memo.put(self, 'other', bytearray(b'other'))
+                return value
+
+        for cls in (MPW, CompactMPW):
+            mpw = cls.from_key(MPWTest.expected_key, MPWTest.full_name)
+            mpw._memo = EvictingMemo(maxsize=1)
+            for _ in range(2):
+                self.assertEqual(mpw.seed(MPWTest.site),
+                                 MPWTest.expected_seed)
+
+    @unittest.skipUnless(hasattr(sys, 'setswitchinterval'),
+                         'sys.setswitchinterval is needed')
+    def test_threads(self):
+        # Seeds being evicted by other threads are never handed out wiped
+        mpw = MPW.from_key(MPWTest.expected_key, MPWTest.full_name)
+        mpw.enable_memo(maxsize=1)
+        sites = ['{}.example.org'.format(i % 2) for i in range(8)]
+        expected = dict((site, mpw.seed(site)) for site in sites)
+        wrong = []
+        start = threading.Event()
+
+        def run(site):
+            start.wait()
+            for _ in range(2000):
+                seed = mpw.seed(site)
+                if seed != expected[site]:
+                    wrong.append(seed)
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-7)
+        try:
+            threads = [threading.Thread(target=run, args=(site,))
+                       for site in sites]
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(wrong, [])
+
+    def test_mpw_memo(self):
+        for cls in (MPW, CompactMPW):
+            mpw = cls.from_key(MPWTest.expected_key, MPWTest.full_name)
+            memo = mpw.enable_memo(maxsize=8)
+            for _ in range(3):
+                self.assertEqual(
+                    mpw.generate(MPWTest.site, context=MPWTest.context,
+                                 extended=True),
+                    MPWTest.expected_password_w_context
+                )
+                self.assertEqual(mpw.seed(MPWTest.site),
+                                 MPWTest.expected_seed)
+            self.assertEqual((memo.hits, memo.misses), (4, 2))
+            seed = mpw.seed(MPWTest.site)
+            seed[:] = bytearray(len(seed))
+            self.assertEqual(mpw.seed(MPWTest.site), MPWTest.expected_seed)
+            self.assertEqual(mpw.pin(MPWTest.site), '8066')
+            try:
+                MPWTemplate.char('n', '1')
+                self.assertEqual(mpw.pin(MPWTest.site), '1111')
+            finally:
+                MPWTemplate.reset()
+            mpw.disable_memo()
+            self.assertIsNone(mpw.memo)
+
+
+class InstrumentTest(unittest.TestCase):
+    def tearDown(self):
+        instrument.set_observer(None)
+
+    def test_observer(self):
+        events = []
+        instrument.set_observer(
+            lambda phase, seconds, info: events.append((phase, info))
+        )
+        mpw = CompactMPW.from_key(MPWTest.expected_key, MPWTest.full_name)
+        mpw.enable_memo()
+        mpw.generate(MPWTest.site)
+        mpw.generate(MPWTest.site)
+        MPW.calculate_salt(MPWTest.full_name)
+        self.assertEqual(events, [
+            ('memo', {'hit': False, 'kind': 'generate'}), ('hmac', {}),
+            ('render', {'extended': False}),
+            ('memo', {'hit': True, 'kind': 'generate'}), ('salt', {})
+        ])
+
+    def test_recorder(self):
+        mpw = MPW.from_key(MPWTest.expected_key, MPWTest.full_name)
+        with instrument.Recorder() as recorder:
+            for _ in range(3):
+                mpw.password(MPWTest.site)
+            MPW.calculate_key(MPWTest.password, b'salt')
+        self.assertIsNone(instrument.observer)
+        summary = recorder.summary()
+        self.assertEqual(summary['hmac']['count'], 3)
+        self.assertEqual(summary['render']['count'], 3)
+        self.assertEqual(summary['scrypt']['count'], 1)
+        self.assertGreater(summary['scrypt']['total'], 0)
+
+
+class KDFProfileTest(unittest.TestCase):
+    profile = KDFProfile(1024, 8, 1)
+    namespace = MPWNameSpace.create('test.kdf', kdf=profile)
+
+    def test_profile(self):
+        self.assertEqual(KDFProfile(), (32768, 8, 2, 64))
+        self.assertEqual(MPW_DEFAULT_NAMESPACE.kdf, KDFProfile())
+        self.assertEqual(self.profile.maxmem, 128 * 8 * 1027)
+        self.assertRaises(ValueError, KDFProfile, 1000)
+        self.assertIs(MPWNameSpace.create('test.kdf', kdf=(1024, 8, 1)),
+                      self.namespace)
+        self.assertIs(MPWNameSpace.create('test.kdf'), self.namespace)
+        self.assertRaises(
+            ValueError, MPWNameSpace.create, 'test.kdf', kdf=KDFProfile()
+        )
+
+    def test_namespace_profile(self):
+        mpw = MPW(MPWTest.full_name, MPWTest.password, self.namespace)
+        salt = MPW.calculate_salt(MPWTest.full_name, self.namespace)
+        self.assertEqual(
+            mpw.key, MPW.calculate_key(MPWTest.password, salt, self.profile)
+        )
+        self.assertNotEqual(mpw.key, MPW.calculate_key(MPWTest.password, salt))
+        mpws = derive_keys(
+            [(MPWTest.full_name, MPWTest.password)], 1, self.namespace
+        )
+        self.assertEqual(mpws[0].key, mpw.key)
+
+    def test_calibrate(self):
+        self.assertEqual(parse_size('64M'), 64 << 20)
+        self.assertEqual(parse_size('1.5k'), 1536)
+        result = calibrate(target=0.01, maxmem=256 << 10, repeat=1)
+        self.assertIsInstance(result['profile'], KDFProfile)
+        self.assertLessEqual(result['maxmem'], 256 << 10)
+
+
+class ParallelScryptTest(unittest.TestCase):
+    def test_rfc_7914(self):
+        self.assertEqual(
+            _scrypt.parallel_scrypt(b'', b'', 16, 1, 1, 64),
+            bytes(bytearray.fromhex(
+                '77d6576238657b203b19ca42c18a0497f16b4844e3074ae8dfdffa3fede2'
+                '1442fcd0069ded0948f8326a753a0fc81f17e8d3e0fb2e0d3628cf35e20c'
+                '38d18906'
+            ))
+        )
+
+    @unittest.skipIf(not hasattr(hashlib, 'scrypt'), 'hashlib.scrypt needed')
+    def test_same_as_hashlib(self):
+        for N, r, p in ((16, 1, 1), (16, 8, 2), (32, 2, 3)):
+            expected = hashlib.scrypt(
+                b'password', salt=b'salt', n=N, r=r, p=p, dklen=64
+            )
+            for workers in (1, 2):
+                self.assertEqual(_scrypt.parallel_scrypt(
+                    b'password', b'salt', N, r, p, 64, workers
+                ), expected)
+
+    @unittest.skipIf(not hasattr(hashlib, 'scrypt'), 'hashlib.scrypt needed')
+    def test_packed_lanes(self):
+        expected = hashlib.scrypt(
+            b'password', salt=b'salt', n=16, r=2, p=5, dklen=64
+        )
+        self.assertEqual(
+            _get_scrypt.get('python')(b'password', b'salt', 16, 2, 5, 64),
+            expected
+        )
+        blocks = [bytes(bytearray([i]) * 256) for i in range(3)]
+        self.assertEqual(
+            _scrypt.romix(blocks, 16, 2),
+            [_scrypt.romix([block], 16, 2)[0] for block in blocks]
+        )
+
+    def test_broken_pool(self):
+        expected = _scrypt.parallel_scrypt(b'password', b'salt', 16, 1, 2, 64)
+        # A worker dying breaks the pool
+        future = _scrypt._get_executor(2).submit(os._exit, 1)
+        self.assertRaises(Exception, future.result)
+        try:
+            self.assertEqual(_scrypt.parallel_scrypt(
+                b'password', b'salt', 16, 1, 2, 64, 2
+            ), expected)
+            self.assertIsNone(_scrypt._executor)
+            self.assertEqual(_scrypt.parallel_scrypt(
+                b'password', b'salt', 16, 1, 2, 64, 2
+            ), expected)
+            self.assertEqual(_scrypt._executor_workers, 2)
+        finally:
+            _scrypt._shutdown_executor()
+
+    @unittest.skipIf(not os.environ.get('MP_SLOW_TESTS'),
+                     'Takes minutes. Set MP_SLOW_TESTS=1 to run.')
+    def test_expected_key(self):
+        salt = MPW.calculate_salt(MPWTest.full_name, MPWTest.namespace)
+        self.assertEqual(_scrypt.scrypt(
+            MPWTest.password.encode(), salt, 32768, 8, 2, 64
+        ), bytes(MPWTest.expected_key))
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = server.Server(port=0, workers=2, token='token')
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def test_requests(self):
+        with server.Client(port=self.port, token='token') as client:
+            response = client.request(
+                'pin', full_name=MPWTest.full_name, site=MPWTest.site
+            )
+            self.assertEqual(response, {'ok': False, 'error': 'locked'})
+            response = client.request(
+                'unlock', full_name=MPWTest.full_name,
+                master_password=MPWTest.password
+            )
+            self.assertTrue(response['ok'])
+            # The same connection is kept alive for every request
+            for _ in range(3):
+                response = client.request(
+                    'pin', full_name=MPWTest.full_name, site=MPWTest.site
+                )
+                self.assertEqual(response, {'ok': True, 'result': '8066'})
+        with server.Client(port=self.port, token='wrong') as client:
+            response = client.request(
+                'pin', full_name=MPWTest.full_name, site=MPWTest.site
+            )
+            self.assertEqual(response['error'], 'unauthorized')
+
+    def test_variant_namespace(self):
+        # Registered (With cheap scrypt) before the workers started
+        namespace = MPWNameSpace('test.kdf')
+        mpw = MPW(MPWTest.full_name, MPWTest.password, namespace)
+        with server.Client(port=self.port, token='token') as client:
+            self.assertTrue(client.request(
+                'unlock', full_name=MPWTest.full_name,
+                master_password=MPWTest.password, namespace='test.kdf'
+            )['ok'])
+            for variant, expected in (
+                    ('login', mpw.login(MPWTest.site)),
+                    ('answer', mpw.answer(MPWTest.site, context=None))
+            ):
+                response = client.request(
+                    'generate', full_name=MPWTest.full_name,
+                    namespace='test.kdf', site=MPWTest.site, variant=variant
+                )
+                self.assertEqual(response, {'ok': True, 'result': expected})
+
+    def test_content_length(self):
+        for length in ('ten', '-1'):
+            connection = server.HTTPConnection('127.0.0.1', self.port)
+            try:
+                connection.putrequest('POST', '/ping')
+                connection.putheader('Content-Length', length)
+                connection.putheader('Authorization', 'Bearer token')
+                connection.endheaders()
+                response = connection.getresponse()
+                self.assertEqual(response.status, 400)
+                self.assertIn(
+                    'Content-Length',
+                    json.loads(response.read().decode('utf-8'))['error']
+                )
+            finally:
+                connection.close()
+
+    def test_shards(self):
+        names = ['User {}'.format(i) for i in range(20)]
+        shards = [server.shard_of(name, None, 2) for name in names]
+        self.assertEqual(set(shards), set([0, 1]))
+        self.assertEqual(shards, [server.shard_of(name, None, 2)
+                                  for name in names])
+        with server.Client(port=self.port, token='token') as client:
+            self.assertTrue(client.request(
+                'unlock', full_name=MPWTest.full_name,
+                master_password=MPWTest.password
+            )['ok'])
+        owner = server.shard_of(MPWTest.full_name, None, 2)
+        request = {'op': 'pin', 'full_name': MPWTest.full_name,
+                   'site': MPWTest.site}
+        # Only the owning shard has the key
+        self.assertTrue(self.server.shards[owner].request(request)['ok'])
+        self.assertEqual(
+            self.server.shards[1 - owner].request(request)['error'], 'locked'
+        )
+
+    def test_dead_shard(self):
+        with server.Client(port=self.port, token='token') as client:
+            self.assertTrue(client.request(
+                'unlock', full_name=MPWTest.full_name,
+                master_password=MPWTest.password
+            )['ok'])
+            owner = server.shard_of(MPWTest.full_name, None, 2)
+            shard = self.server.shards[owner]
+            shard.process.terminate()
+            shard.process.join()
+            request = {'op': 'pin', 'full_name': MPWTest.full_name,
+                       'site': MPWTest.site}
+            self.assertEqual(shard.request(request)['error'], 'unavailable')
+            # A new worker is started, without the key
+            response = client.request(
+                'pin', full_name=MPWTest.full_name, site=MPWTest.site
+            )
+            self.assertEqual(response, {'ok': False, 'error': 'locked'})
+            self.assertIsNot(self.server.shards[owner], shard)
+            self.assertTrue(client.request(
+                'unlock', full_name=MPWTest.full_name,
+                master_password=MPWTest.password
+            )['ok'])
+
+    @unittest.skipUnless(hasattr(signal, 'SIGSTOP'), 'SIGSTOP is needed')
+    def test_timeout(self):
+        shard = self.server.shards[0]
+        shard.timeout = 0.1
+        os.kill(shard.process.pid, signal.SIGSTOP)
+        try:
+            self.assertEqual(
+                shard.request({'op': 'lock', 'full_name': 'name'}),
+                {'ok': False, 'error': 'unavailable'}
+            )
+            self.assertEqual(shard._pending, {})
+        finally:
+            os.kill(shard.process.pid, signal.SIGCONT)
+
+    def test_verifier(self):
+        # Every shard enrolls its users in the same file at once
+        directory = tempfile.mkdtemp()
+        verifier = VerifierStore(os.path.join(directory, 'verifier.json'))
+        names = ['User {}'.format(i) for i in range(12)]
+        other = server.Server(port=0, workers=4, verifier=verifier)
+        try:
+            threads = [threading.Thread(target=other.route, args=({
+                'op': 'unlock', 'full_name': name,
+                'master_password': 'password', 'namespace': 'test.kdf'
+            },)) for name in names]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            for name in names:
+                self.assertIsNotNone(verifier.get(
+                    name, MPWNameSpace('test.kdf')
+                ))
+        finally:
+            other.server_close()
+            shutil.rmtree(directory)
+
+
+class SchedulerTest(unittest.TestCase):
+    def tearDown(self):
+        MPW.scheduler = None
+
+    def wait_for_queue(self, scheduler, queued):
+        while scheduler.stats()['queued'] != queued:
+            time.sleep(0.001)
+
+    def test_fifo(self):
+        scheduler = DerivationScheduler(budget=100)
+        admitted = []
+
+        def acquire(name, size):
+            scheduler.acquire(size)
+            admitted.append(name)
+
+        scheduler.acquire(60)
+        threads = []
+        for i, (name, size) in enumerate((('big', 60), ('small', 10))):
+            threads.append(threading.Thread(target=acquire, args=(name, size)))
+            threads[-1].start()
+            self.wait_for_queue(scheduler, i + 1)
+        # small fits, but has to wait for big, which arrived first
+        self.assertEqual(admitted, [])
+        scheduler.release(60)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(admitted, ['big', 'small'])
+        stats = scheduler.stats()
+        self.assertEqual(stats['in_use'], 70)
+        self.assertEqual(stats['admitted'], 3)
+        self.assertEqual(stats['max_queued'], 2)
+
+    def test_backpressure(self):
+        scheduler = DerivationScheduler(budget=10, max_queue=1)
+        # Bigger than the budget, but nothing else is running
+        scheduler.acquire(20)
+        self.assertRaises(EnvironmentError, scheduler.acquire, 5, 0.01)
+        thread = threading.Thread(target=scheduler.acquire, args=(5,))
+        thread.start()
+        self.wait_for_queue(scheduler, 1)
+        self.assertRaises(RuntimeError, scheduler.acquire, 5)
+        scheduler.release(20)
+        thread.join()
+        stats = scheduler.stats()
+        self.assertEqual((stats['rejected'], stats['timed_out']), (1, 1))
+
+    def test_calculate_key(self):
+        MPW.scheduler = DerivationScheduler(budget=1 << 20)
+        profile = KDFProfile(16, 1, 1)
+        key = MPW.calculate_key('password', b'salt', profile)
+        self.assertEqual(
+            bytes(key), _get_scrypt.scrypt(b'password', b'salt', *profile)
+        )
+        stats = MPW.scheduler.stats()
+        self.assertEqual((stats['admitted'], stats['in_use']), (1, 0))
+
+
+class LoadTestTest(unittest.TestCase):
+    def test_helpers(self):
+        values = list(range(1, 101))
+        self.assertEqual(loadtest.percentile(values, 50), 50)
+        self.assertEqual(loadtest.percentile(values, 99), 99)
+        self.assertIsNone(loadtest.percentile([], 50))
+        self.assertEqual(
+            loadtest.parse_mix('unlock=1,pin'), {'unlock': 1.0, 'pin': 1.0}
+        )
+        self.assertRaises(ValueError, loadtest.parse_mix, 'other=1')
+        jobs = loadtest.schedule(10, 3, {'pin': 1}, rate=100)
+        self.assertEqual([job[:2] for job in jobs[:2]],
+                         [(0.0, 'pin'), (0.01, 'pin')])
+
+    def check(self, results, operations):
+        self.assertEqual(results['total']['count'], operations)
+        self.assertEqual(results['total']['errors'], 0, results['error'])
+        self.assertLessEqual(
+            results['total']['p50'], results['total']['p99']
+        )
+
+    def test_library(self):
+        self.check(loadtest.run(
+            users=4, operations=40, threads=2, kdf=(16, 1, 1)
+        ), 40)
+
+    def test_server(self):
+        self.check(loadtest.run(
+            users=4, operations=40, threads=2, kdf=(16, 1, 1), serve=2
+        ), 40)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,111 @@
+"""
+Render passwords for many seeds at once with NumPy
+
+Needs numpy ($ pip install master_password[numpy])
+
+USAGE:
+
+>>> seeds = seed_array(mpw, sites)  # (len(sites), 32) uint8 array
+>>> render(seeds, 'long', mpw.version)
+['Dicd0!JoniLeza', ...]
+>>> generate_many(mpw, sites)  # The same thing
+['Dicd0!JoniLeza', ...]
+"""
+
+import numpy
+
+from master_password.datatypes import MPWTemplate
+
+__all__ = ('seed_array', 'render', 'generate_many')
+
+SEED_SIZE = 32
+
+# (template, legacy, extended) -> (compiled template, variant of seed[0],
+# (variant code point tables))
+_tables = {}
+
+
+def seed_array(mpw, sites, namespace=None, counter=1, context=None):
+    """The seeds of mpw.seed_many(...) as a (len(sites), 32) uint8 array"""
+    seeds = bytearray()
+    for seed in mpw.seed_many(sites, namespace, counter, context):
+        seeds.extend(seed)
+    return numpy.frombuffer(bytes(seeds), dtype=numpy.uint8).reshape(
+        -1, SEED_SIZE
+    )
+
+
+def _lookup_tables(template, legacy, extended):
+    compiled = MPWTemplate.compile(template, legacy, extended)
+    try:
+        cached = _tables.get((template, legacy, extended))
+    except TypeError:
+        cached = None
+    if cached is not None and cached[0] is compiled:
+        return cached[1:]
+    variants = []
+    variant_of = numpy.empty(256, dtype=numpy.intp)
+    for i, tables in enumerate(compiled):
+        for j, other in enumerate(variants):
+            if other is tables:
+                break
+        else:
+            j = len(variants)
+            variants.append(tables)
+        variant_of[i] = j
+    # Code point of the character for each (position, seed byte)
+    code_points = tuple(
+        numpy.array(
+            [[ord(c) for c in table] for table in tables], dtype=numpy.uint32
+        ) for tables in variants
+    )
+    try:
+        _tables[(template, legacy, extended)] = (
+            compiled, variant_of, code_points
+        )
+    except TypeError:
+        pass
+    return variant_of, code_points
+
+
+def render(seeds, template='long', version=3, extended=False):
+    """
+    Render every row of seeds (An (N, 32) uint8 array) into a password,
+    the same as MPW.generate would. Returns a list of N strings.
+    """
+    seeds = numpy.asarray(seeds, dtype=numpy.uint8)
+    if seeds.ndim != 2 or seeds.shape[1] != SEED_SIZE:
+        raise ValueError('seeds must be an (N, {}) array'.format(SEED_SIZE))
+    variant_of, code_points = _lookup_tables(
+        template, version == 0, extended
+    )
+    if extended:
+        # Every byte is used, with seed[0] last
+        columns = numpy.roll(numpy.arange(SEED_SIZE), -1)
+    else:
+        columns = numpy.arange(1, SEED_SIZE)
+    passwords = [None] * len(seeds)
+    variants = variant_of[seeds[:, 0]]
+    for variant, table in enumerate(code_points):
+        rows = numpy.flatnonzero(variants == variant)
+        if not len(rows):
+            continue
+        length = len(table)
+        codes = table[
+            numpy.arange(length), seeds[rows][:, columns[:length]]
+        ]
+        strings = numpy.ascontiguousarray(codes, dtype='<u4').view(
+            '<U{}'.format(length)
+        ).ravel()
+        for row, string in zip(rows.tolist(), strings.tolist()):
+            passwords[row] = string
+    return passwords
+
+
+def generate_many(mpw, sites, counter=1, context=None, template='long',
+                  namespace=None, extended=False):
+    """Like list(mpw.generate_many(...)), but rendered with NumPy"""
+    seeds = seed_array(
+        mpw, sites, mpw._resolve_namespace(namespace), counter, context
+    )
+    return render(seeds, template, mpw.version, extended)
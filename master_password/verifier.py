@@ -0,0 +1,167 @@
+"""
+A store of key fingerprints (The "keyID" of Master Password, the SHA-256 of
+the key) for each user, so a wrong master password can be rejected as soon
+as the key is calculated, instead of generating wrong passwords.
+
+Users are stored by the SHA-256 of their salt (Their full name and
+namespace), and the file is only readable by the current user. Changes are
+made while holding a lock on path + ".lock" (Where fcntl is available), so
+processes sharing the file don't lose each other's users.
+
+USAGE:
+
+>>> verifier = VerifierStore('~/.mpw-verifier.json')
+>>> mpw = verifier.unlock('Your Full Name', 'Your secret password')
+>>> verifier.unlock('Your Full Name', 'Wrong password')
+Traceback (most recent call last):
+  ...
+ValueError: Wrong master password for 'Your Full Name'
+"""
+
+import os
+import hmac
+import json
+import hashlib
+import contextlib
+
+from master_password import MPW, MPW_DEFAULT_NAMESPACE
+from master_password.helpers import encode_if, write_private
+
+__all__ = ('VerifierStore', 'key_id')
+
+
+def key_id(key):
+    """The fingerprint of a key, as upper case hex"""
+    return hashlib.sha256(bytes(key)).hexdigest().upper()
+
+
+class VerifierStore(object):
+    """The key fingerprint of every enrolled user, stored at path"""
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    @staticmethod
+    def _user_id(salt):
+        return hashlib.sha256(salt).hexdigest()
+
+    @staticmethod
+    def _salt(full_name, namespace):
+        return MPW.calculate_salt(encode_if(full_name), namespace)
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                users = json.loads(f.read().decode('ascii'))
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(users, dict):
+            return {}
+        return users
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold an exclusive lock on the store for a load and save"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        try:
+            import fcntl
+        except ImportError:
+            yield
+            return
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _save(self, users):
+        write_private(
+            self.path, json.dumps(users, sort_keys=True).encode('ascii')
+        )
+
+    def get(self, full_name, namespace=MPW_DEFAULT_NAMESPACE):
+        """The stored key fingerprint, or None if the user is not enrolled"""
+        entry = self._load().get(self._user_id(
+            self._salt(full_name, namespace)
+        ))
+        if entry is None:
+            return None
+        return entry['key_id']
+
+    def enroll(self, mpw, full_name=None):
+        """
+        Remember the key of mpw (Replacing any old key). full_name is needed
+        if mpw was created with keep_name=False.
+        """
+        if full_name is None:
+            full_name = mpw.full_name
+        if full_name is None:
+            raise ValueError('The full name is needed to enroll a key')
+        user_id = self._user_id(self._salt(full_name, mpw.namespace))
+        entry = {'key_id': key_id(mpw.key), 'version': mpw.version}
+        with self._locked():
+            users = self._load()
+            users[user_id] = entry
+            self._save(users)
+
+    def remove(self, full_name, namespace=MPW_DEFAULT_NAMESPACE):
+        user_id = self._user_id(self._salt(full_name, namespace))
+        with self._locked():
+            users = self._load()
+            if users.pop(user_id, None) is not None:
+                self._save(users)
+
+    def check_key(self, full_name, key, namespace=MPW_DEFAULT_NAMESPACE):
+        """
+        Whether an already calculated key is the enrolled key (None if the
+        user is not enrolled). Does not need scrypt.
+        """
+        expected = self.get(full_name, namespace)
+        if expected is None:
+            return None
+        return hmac.compare_digest(
+            expected.encode('ascii'), key_id(key).encode('ascii')
+        )
+
+    def check(self, mpw, full_name=None):
+        """check_key with the key, full_name and namespace of mpw"""
+        if full_name is None:
+            full_name = mpw.full_name
+        return self.check_key(full_name, mpw.key, mpw.namespace)
+
+    def unlock(self, full_name, master_password,
+               namespace=MPW_DEFAULT_NAMESPACE, version=3, enroll=True,
+               cls=MPW):
+        """
+        Create a MPW (Or cls), raising ValueError if the master password does
+        not match the enrolled key. Users who are not enrolled yet are
+        enrolled if enroll is true.
+
+        A key in the key_cache of cls (Of MPW if cls isn't a MPW) is checked
+        without calculating it again, and a calculated key is only cached
+        once it has been checked.
+        """
+        key_cls = cls if issubclass(cls, MPW) else MPW
+        salt = self._salt(full_name, namespace)
+        profile = key_cls.kdf_profile(namespace)
+        key = key_cls.cached_key(master_password, salt, profile)
+        cached = key is not None
+        if not cached:
+            key = key_cls.calculate_key(master_password, salt, profile)
+        matches = self.check_key(full_name, key, namespace)
+        if matches is False:
+            del master_password
+            key[:] = bytearray(len(key))
+            raise ValueError(
+                'Wrong master password for {!r}'.format(full_name)
+            )
+        if not cached and key_cls.key_cache is not None:
+            key_cls.key_cache.put(salt, master_password, key, profile)
+        del master_password
+        mpw = cls.from_key(key, full_name, namespace, version)
+        if matches is None and enroll:
+            self.enroll(mpw, full_name)
+        return mpw
@@ -70,10 +70,12 @@ setup_args = dict(
     # $ pip install master_password[scrypt]
     # $ pip install master_password[pyscrypt]
     # $ pip install master_password[crypto]
+    # $ pip install master_password[numpy]
     extras_require={
         'scrypt': ['scrypt'],
         'pyscrypt': ['pyscrypt'],
-        'crypto': ['cryptography']
+        'crypto': ['cryptography'],
+        'numpy': ['numpy']
     },
 
 